@@ -1,218 +1,920 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hmac
 import json
 import os
+import selectors
+import socket
 import shutil
 import tempfile
 from git import Repo
 import pylint.lint
 from pylint.reporters import JSONReporter
-from notify import GithubNotification
+from notify import GithubNotification, github_client
 from io import StringIO
-from clone import clone_check
-from syntax_check import syntax_check
-from runTests import run_tests
-from dotenv import load_dotenv
-import stat
-import errno
+from clone import clone_check, get_changed_files, mirror_cache, workspace_pool, TMP_PATH
+from syntax_check import syntax_check, flatten_details, lint_cache, lint_service
+from runTests import run_tests, venv_cache
 import re
-from build_history import log_build, get_github_commit_url, create_database, get_logs, get_log
+import time
+from urllib.parse import urlsplit, parse_qs, urlencode
+from build_history import (log_build, create_database, get_logs, get_log, BUILD_FIELDS,
+                           SUMMARY_FIELDS, record_stage, log_lint_messages, log_test_outcomes, history_version)
+from build_queue import BuildQueue, BuildCancelled, QueueStopped, FINISHED_STATES
+from coordinator import Coordinator, LeaseLost
+from build_log import BuildLog, log_exists, log_size, is_complete, read_log
+from response_cache import ResponseCache, accepts_gzip
+import metrics
+from ci_logging import get_logger
+import config
+
+log = get_logger('CIServer')
+# One record per request answered, instead of BaseHTTPRequestHandler's lines on stderr
+access_log = get_logger('http')
 
 create_database()
-# Load environment variables from .env file
-load_dotenv()
+
+response_cache = ResponseCache(config.RESPONSE_CACHE_ENTRIES, config.LOG_COMPRESSION_LEVEL)
 
 
 class SimpleHandler(BaseHTTPRequestHandler):
+    # Reading a request gives up after this many seconds, and idle keep-alive
+    # connections are closed after it, see PooledHTTPServer
+    timeout = config.KEEPALIVE_TIMEOUT
+    # Following a log holds the serving thread until the build is done, which
+    # would stop a server serving one request at a time, see KeepAliveHandler
+    follow_logs = False
+
     def do_GET(self):
         # Parse the requested path
-        path = self.path
-        field_names = ["id", "commit_id", "build_date", "build_logs", "github_commit_url"]
+        url = urlsplit(self.path)
+        path = url.path
+        field_names = BUILD_FIELDS
 
         
         if path == "/":
-            # Handle the root path
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-
-            self.end_headers()
-            message = get_logs()
-            data = [dict(zip(field_names, item)) for item in message]
-            self.wfile.write(json.dumps(data).encode())
+            # Handle the root path: a page of builds, see parse_history_query
+            def build_list():
+                query = parse_history_query(parse_qs(url.query))
+                message = get_logs(**query)
+                data = [dict(zip(query['fields'], item)) for item in message]
+                headers = {}
+                if len(data) == query['limit'] and 'id' in query['fields']:
+                    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    params['after_id'] = data[-1]['id']
+                    headers['Link'] = f'</?{urlencode(params)}>; rel="next"'
+                return 200, data, headers
+            self.send_cached_json(build_list)
         
         elif re.match(r"^/\d+$", path):  # Check if the path matches "/{id}" where id is a number
             # Extract the ID from the path
             id_value = path[1:]  # Remove the leading '/'
+            def build_detail():
+                fields = parse_fields(parse_qs(url.query), field_names)
+                message = get_log(id_value, fields)
+                if message is None:
+                    return 404, {'status': 'error', 'message': f"Build {id_value} not found"}, {}
+                return 200, dict(zip(fields, message)), {}
+            self.send_cached_json(build_detail)
+
+        elif path == "/metrics":
+            body = metrics.registry.render().encode()
             self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            message = get_log(id_value)
-            data = dict(zip(field_names, message))
-            self.wfile.write(json.dumps(data).encode())
+            self.wfile.write(body)
+
+        elif re.match(r"^/\d+/log$", path):  # "/{id}/log", optionally ?follow=1
+            build_id = int(path.split('/')[1])
+            follow = parse_qs(url.query).get('follow', ['0'])[0] == '1'
+            if follow and not self.follow_logs:
+                self.send_json(400, {'status': 'error', 'message': "Following a log needs the server in threaded mode"})
+                return
+            if get_log(build_id) is None or (not follow and not log_exists(config.BUILD_LOG_PATH, build_id)):
+                self.send_json(404, {'status': 'error', 'message': f"No log for build {build_id}"})
+                return
+            self.send_build_log(build_id, follow)
         
         else:
             # Handle unknown paths
+            message = "404 Not Found".encode()
             self.send_response(404)
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(message)))
             self.end_headers()
-            message = "404 Not Found"
-            self.wfile.write(message.encode())
+            self.wfile.write(message)
 
     def do_POST(self):
         """
         Handles POST requests from GitHub webhooks.
 
-        Extracts repository and branch details from the payload, Clones the repository.
-        Runs a syntax check using Pylint, Executes tests.
-        Updates the commit status on GitHub and sends a JSON response with the results.
+        Validates the payload and queues a build for it, so the webhook is answered
+        right away. The build itself is run in the background by process_build.
+        Replies 202 with the id of the queued build, 400 if the payload is not
+        a usable push event, or 503 while the server shuts down.
+
+        Requests to /runners/ come from remote runners, see handle_runner.
+        """
+        if urlsplit(self.path).path.startswith('/runners/'):
+            self.handle_runner(urlsplit(self.path).path)
+            return
+
+        with metrics.webhook_seconds.time():
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
 
-        Raises:
-            Exception: If syntax check or tests fail, GitHub commit status is updated accordingly.
+            try:
+                payload = json.loads(post_data.decode('utf-8'))
+                validate_payload(payload)
+            except (ValueError, KeyError, TypeError) as e:
+                log.warning("Invalid webhook payload", error=str(e))
+                self.send_json(400, {'status': 'error', 'message': f"Invalid webhook payload: {str(e)}"})
+                return
+
+            try:
+                build_id = build_queue.enqueue(
+                    payload, repo_url=payload['repository']['clone_url'], branch=get_branch(payload['ref'])
+                )
+            except QueueStopped:
+                self.send_json(503, {'status': 'error', 'message': "Server is shutting down"}, {'Retry-After': '30'})
+                return
+            log.info("Queued build", build_id=build_id, commit_id=payload['after'], branch=get_branch(payload['ref']))
+            self.send_json(202, {'status': 'queued', 'build_id': build_id}, {'Location': f"/{build_id}"})
+
+    def handle_runner(self, path):
         """
-        content_length = int(self.headers['Content-Length'])
+        Handles the requests of remote runners, JSON objects carrying the id of the
+        runner as 'runner'.
+
+        POST /runners/claim answers 200 with a build to run, or 204 if none is
+        waiting. For the build it claimed, the runner then sends:
+            POST /runners/<id>/heartbeat, answered with {"cancel": bool}
+            POST /runners/<id>/log with the output as 'text'
+            POST /runners/<id>/record with a result as 'kind' and 'data'
+            POST /runners/<id>/complete with 'status' and 'message'
+        A build that is not leased to the runner anymore is answered with 409, the
+        runner should stop working on it.
+
+        The endpoints hand out builds and write the build history, so they only
+        exist when config.RUNNER_TOKEN is set: otherwise every request is answered
+        with 404, and requests without the token with 401.
+
+        Args:
+            path (str): Path of the request.
+        """
+        content_length = int(self.headers['Content-Length'] or 0)
         post_data = self.rfile.read(content_length)
-        
+        if not config.RUNNER_TOKEN:
+            self.send_json(404, {'status': 'error', 'message': "Remote runners are disabled, set CI_RUNNER_TOKEN"})
+            return
+        authorization = self.headers.get('Authorization') or ''
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {config.RUNNER_TOKEN}".encode()):
+            self.send_json(401, {'status': 'error', 'message': "Invalid runner token"})
+            return
+        match = re.match(r"^/runners/(?:claim|(\d+)/(heartbeat|log|record|complete))$", path)
+        if match is None:
+            self.send_json(404, {'status': 'error', 'message': f"Unknown runner endpoint {path}"})
+            return
+        build_id, action = int(match.group(1) or 0), match.group(2)
         try:
-            payload = json.loads(post_data.decode('utf-8'))
-            token = os.getenv('GITHUB_TOKEN')
-            repo_url = payload['repository']['clone_url']
-            ghSyntax = GithubNotification(payload['organization']['login'], payload['repository']['name'], token, "http://localhost:8008", "ci/syntaxcheck")
-            ghTest = GithubNotification(payload['organization']['login'], payload['repository']['name'], token, "http://localhost:8008", "ci/tests")
-            
-            
-            if payload['ref'].split('/')[-2].lower() == 'issue':
-                branch = payload['ref'].split('/')[-2] + '/' + payload['ref'].split('/')[-1]
+            body = json.loads(post_data.decode('utf-8') or '{}')
+            runner = body['runner']
+            if not runner:
+                raise ValueError("runner is empty")
+            if action is None:
+                job = coordinator.claim(runner)
+                if job is None:
+                    self.send_response(204)
+                    self.end_headers()
+                    return
+                self.send_json(200, job)
+            elif action == 'heartbeat':
+                self.send_json(200, coordinator.heartbeat(build_id, runner))
+            elif action == 'log':
+                coordinator.append_log(build_id, runner, body['text'])
+                self.send_json(200, {'status': 'ok'})
+            elif action == 'record':
+                coordinator.record(build_id, runner, body['kind'], body['data'])
+                self.send_json(200, {'status': 'ok'})
             else:
-                branch = payload['ref'].split('/')[-1]  # refs/heads/branch-name -> branch-name
-            
-            
-            try:
-                commit_id, result = clone_check(repo_url, branch)
-            except Exception as clone_error:
-                print(f"Error: {str(clone_error)}")
-                try:
-                    ghTest.send_commit_status("failure", "Tests failed", payload['after'], "1")
-                except Exception as notify_error:
-                    if "Network error" in str(notify_error):
-                        print(f"Warning: Failed to send notification: {str(notify_error)}")
-                raise clone_error
-
-            syntaxcheck = syntax_check(result)
-            
-            try:
-                if syntaxcheck['status'] == "success":
-                    print("Syntax Check Passed")
-                    ghSyntax.send_commit_status("success", "Syntax check passed", payload['after'], "1") 
-                else:
-                    print("Syntax Check Failed")
-                    ghSyntax.send_commit_status("failure", "Syntax check failed", payload['after'], "1")
-            except Exception as notify_error:
-                if "Network error" in str(notify_error):
-                    print(f"Warning: Failed to send notification: {str(notify_error)}")
-                else:
-                    raise notify_error
-
-            if syntaxcheck['status'] == "error":
-                raise Exception("Syntax check failed")
-
-            test_results, test_logs = run_tests(result)
+                coordinator.complete(build_id, runner, body['status'], body.get('message'))
+                self.send_json(200, {'status': 'ok'})
+        except LeaseLost as e:
+            self.send_json(409, {'status': 'error', 'message': str(e)})
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'status': 'error', 'message': f"Invalid runner request: {str(e)}"})
+
+    def send_build_log(self, build_id, follow):
+        """
+        Sends the log of a build as plain text, read from disk piece by piece.
+
+        Without follow, the log as written so far is sent. With follow, the
+        response stays open and new output is sent as it is written, until the log
+        is closed or the build finished without one. HTTP/1.1 clients get the log
+        in chunked transfer encoding, HTTP/1.0 clients until the connection closes.
+        Following a log holds a request thread for as long as the build runs, so
+        only handlers with follow_logs, i.e. in threaded mode, do it.
+
+        Args:
+            build_id (int): Id of the build.
+            follow (bool): Whether to keep sending output until the build is done.
+        """
+        read_size = 64 * 1024
+        chunked = follow and self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        elif follow:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            size = log_size(config.BUILD_LOG_PATH, build_id)
+            self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+        offset = 0
+        try:
+            while True:
+                complete = is_complete(config.BUILD_LOG_PATH, build_id)
+                data = read_log(config.BUILD_LOG_PATH, build_id, offset, read_size)
+                if not follow:
+                    data = data[:size - offset]
+                if data:
+                    offset += len(data)
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                    continue
+                if not follow or complete:
+                    break
+                status = (get_log(build_id) or [None] * 6)[5]
+                if status in FINISHED_STATES and not log_exists(config.BUILD_LOG_PATH, build_id):
+                    break
+                time.sleep(config.LOG_FOLLOW_POLL_SECONDS)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_cached_json(self, produce):
+        """
+        Sends a JSON response of the build history from the response cache.
+
+        The response is produced again only if a build was written since it was
+        cached. Clients revalidating with If-None-Match or If-Modified-Since get a
+        304 Not Modified while it is unchanged, and large bodies are sent with
+        gzip when the client accepts it.
+
+        Args:
+            produce: Callable returning (status code, JSON-serializable data, extra
+                headers). It raises ValueError for an invalid query, answered with
+                400. Only 200 responses are cached.
+        """
+        version, modified = history_version.current()
+        entry = response_cache.get(self.path, version)
+        if entry is None:
             try:
-                if test_results:
-                    print("Test Passed")
-                    ghTest.send_commit_status("success", "Tests passed", payload['after'], "1") 
-                else:
-                    print("Test Failed")
-                    ghTest.send_commit_status("failure", "Tests failed", payload['after'], "1")
-            except Exception as notify_error:
-                if "Network error" in str(notify_error):
-                    print(f"Warning: Failed to send notification: {str(notify_error)}")
-                else:
-                    raise notify_error
-
-            if not test_results:
-                raise Exception("Tests failed")
-
-
-            if not commit_id:   
-                raise Exception("Error cloning repository.")
-            
-            # if test_logs != "Test logs here": 
-            #     logs = f"Syntax Check Logs: {syntaxcheck['details']} \nTest Logs: {test_logs}"
-            #     log_build(commit_id, logs)                       
-            #     github_commit_url = get_github_commit_url(commit_id)
-
-            print(f"Test Logs: {test_logs}")
-            if test_logs != "Test logs here" and test_logs != "logs":
-                logs = f"Syntax Check Logs: {syntaxcheck['details']} \nTest Logs: {test_logs}"
-                log_build(commit_id, logs)
-                github_commit_url = get_github_commit_url(commit_id)
-
-
-                
-            remove_temp_folder(result)
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
+                code, data, headers = produce()
+            except ValueError as e:
+                self.send_json(400, {'status': 'error', 'message': str(e)})
+                return
+            if code != 200:
+                self.send_json(code, data, headers)
+                return
+            entry = response_cache.put(self.path, version, modified, json.dumps(data).encode(), headers)
+
+        headers = {
+            'ETag': entry.etag,
+            'Last-Modified': entry.last_modified,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+            **entry.headers
+        }
+        if entry.not_modified(self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
             self.end_headers()
-            response = {'status': 'success', 'message': result, "test_results": test_results }
-            
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            try:
-                if "Syntax check failed" in str(e):
-                    self.send_response(500)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    error_response = {'status': 'error', 'message': str(e)}
-                elif "Tests failed" in str(e):
-                    self.send_response(500)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    error_response = {'status': 'error', 'message': str(e)}
-                else:
-                    self.send_response(500)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    error_response = {'status': 'error', 'message': str(e)}
-            except Exception as send_error:
-                print(f"Error sending response: {str(send_error)}")
+            return
+        body = entry.body
+        if len(body) >= config.GZIP_MIN_BYTES and accepts_gzip(self.headers.get('Accept-Encoding')):
+            body = entry.gzipped()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
 
-def remove_temp_folder(folder):
+    def send_json(self, code, data, headers=None):
+        """
+        Sends a JSON response.
+
+        Args:
+            code (int): HTTP status code.
+            data: JSON-serializable response body.
+            headers (dict): Extra response headers.
+        """
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        code = getattr(code, 'value', code)
+        level = access_log.warning if isinstance(code, int) and code >= 500 else access_log.info
+        level("Request", method=self.command, path=self.path, status=code, client=self.client_address[0])
+
+    def log_error(self, format, *args):
+        # E.g. a malformed request line or a client timing out, which may come
+        # before the method and path were read
+        access_log.warning("Request error", method=getattr(self, 'command', None),
+                           path=getattr(self, 'path', None), error=format % args, client=self.client_address[0])
+
+    def log_message(self, format, *args):
+        access_log.info(format % args, client=self.client_address[0])
+
+
+def validate_payload(payload):
     """
-    Removes a temporary folder.
+    Checks that a webhook payload carries everything a build needs.
 
     Args:
-        folder (str): Path of the directory to be removed.
+        payload (dict): Parsed GitHub push payload.
+
+    Raises:
+        KeyError: If a required field is missing.
+        ValueError: If the ref is not a branch.
     """
-    shutil.rmtree(folder, onerror=handle_remove_readonly)
+    if not isinstance(payload, dict):
+        raise ValueError("payload must be a JSON object")
+    for field in ('clone_url', 'name'):
+        if not payload['repository'][field]:
+            raise ValueError(f"repository.{field} is empty")
+    if not payload['organization']['login']:
+        raise ValueError("organization.login is empty")
+    if not payload['after']:
+        raise ValueError("after is empty")
+    if not payload['ref'].startswith('refs/heads/'):
+        raise ValueError(f"{payload['ref']} is not a branch")
 
-def handle_remove_readonly(func, path, exc):
+
+def parse_history_query(params):
     """
-    Handles removal of read-only files by modifying permissions.
+    Reads the query parameters of the build list.
+
+    Supported parameters: limit (page size), after_id (id of the last build of the
+    previous page), order ('asc' or 'desc' by id), commit (SHA or SHA prefix),
+    status (comma-separated statuses), repo (clone URL), branch, since and until
+    (dates as 'YYYY-MM-DD[ HH:MM:SS]') and fields (comma-separated fields to return; all but
+    build_logs by default).
 
     Args:
-        func: Function that triggered the error
-        path: File path causing the issue
-        exc: Exception details
-    """
-    # Change permissions to writeable if needed
-    excvalue = exc[1]
-    if func in (os.rmdir, os.remove, os.unlink) and excvalue.errno == errno.EACCES:
-        # Ensure the item is writeable
-        os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
-        func(path)  # Retry the removal
-    else:
-        raise excvalue
+        params (dict): Parsed query string, as returned by urllib.parse.parse_qs.
+
+    Returns:
+        dict: Keyword arguments of build_history.get_logs.
 
-def run_server(port):
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    def last(name):
+        return params[name][-1] if name in params else None
+
+    query = {'limit': config.HISTORY_PAGE_SIZE}
+    if last('limit') is not None:
+        if not last('limit').isdigit() or not 1 <= int(last('limit')) <= config.HISTORY_MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {config.HISTORY_MAX_PAGE_SIZE}")
+        query['limit'] = int(last('limit'))
+    if last('after_id') is not None:
+        if not last('after_id').isdigit():
+            raise ValueError("after_id must be a build id")
+        query['after_id'] = int(last('after_id'))
+    if last('order') not in (None, 'asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    query['descending'] = last('order') == 'desc'
+    if last('commit') is not None:
+        if not re.fullmatch(r"[0-9a-fA-F]{1,40}", last('commit')):
+            raise ValueError("commit must be a hex SHA or SHA prefix")
+        query['commit_id'] = last('commit').lower()
+    if last('status') is not None:
+        query['statuses'] = last('status').split(',')
+    if last('repo'):
+        query['repo_url'] = last('repo')
+    if last('branch'):
+        query['branch'] = last('branch')
+    for name in ('since', 'until'):
+        if last(name) is not None:
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?", last(name)):
+                raise ValueError(f"{name} must be a date as YYYY-MM-DD[ HH:MM:SS]")
+            query[name] = last(name)
+    query['fields'] = parse_fields(params, SUMMARY_FIELDS)
+    return query
+
+
+def parse_fields(params, default):
+    """
+    Reads the 'fields' query parameter, a comma-separated list of build fields.
+
+    Args:
+        params (dict): Parsed query string, as returned by urllib.parse.parse_qs.
+        default (list): Fields returned when the parameter is missing.
+
+    Returns:
+        list: The requested fields.
+
+    Raises:
+        ValueError: If a field is unknown.
+    """
+    if 'fields' not in params:
+        return default
+    fields = params['fields'][-1].split(',')
+    unknown = [field for field in fields if field not in BUILD_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, expected some of {BUILD_FIELDS}")
+    return fields
+
+
+def get_branch(ref):
+    """
+    Returns the branch name of a pushed ref.
+
+    Args:
+        ref (str): Full ref, e.g. refs/heads/main or refs/heads/issue/12.
+
+    Returns:
+        str: The branch name, keeping the 'issue/' prefix of issue branches.
+    """
+    if ref.split('/')[-2].lower() == 'issue':
+        return ref.split('/')[-2] + '/' + ref.split('/')[-1]
+    return ref.split('/')[-1]  # refs/heads/branch-name -> branch-name
+
+
+class LocalRecorder:
+    """Records the results of a build in the build history of this process."""
+
+    def __init__(self, build_id):
+        self.build_id = build_id
+
+    def stage(self, stage, seconds):
+        record_stage(self.build_id, stage, seconds)
+
+    def lint_messages(self, messages):
+        log_lint_messages(self.build_id, messages)
+
+    def test_outcomes(self, outcomes):
+        log_test_outcomes(self.build_id, outcomes)
+
+    def finish(self, commit_id, logs, status):
+        log_build(commit_id, logs, build_id=self.build_id, status=status)
+
+
+def process_build(build_id, payload, build_log=None, cancel=None, recorder=None):
+    """
+    Runs a queued build.
+
+    Clones the repository, runs a syntax check using Pylint and executes tests.
+    Updates the commit status on GitHub after each stage and records the outcome
+    in the build history. The output of every stage is streamed to the build's log
+    on disk, served by GET /<id>/log.
+
+    Args:
+        build_id (int): Id of the build reserved when the webhook was queued.
+        payload (dict): Parsed GitHub push payload.
+        build_log: Log the output is written to, defaults to the BuildLog of the build.
+        cancel (threading.Event): Set to stop the build, defaults to the cancel
+            event of the build queue.
+        recorder: Where the results go, defaults to a LocalRecorder. Remote runners
+            pass one sending them to the coordinator, see runner.RemoteRecorder.
+
+    Raises:
+        BuildCancelled: If a newer build of the branch superseded this one.
+        Exception: If cloning, the syntax check or the tests fail.
+    """
+    if build_log is None:
+        build_log = BuildLog(config.BUILD_LOG_PATH, build_id, config.BUILD_LOG_MAX_BYTES, config.BUILD_LOG_CHUNK_BYTES)
+    if cancel is None:
+        cancel = build_queue.cancel_event(build_id)
+    recorder = recorder or LocalRecorder(build_id)
+    try:
+        run_pipeline(build_id, payload, build_log, cancel, recorder)
+    except BuildCancelled as e:
+        build_log.write(f"Build cancelled: {str(e)}\n")
+        recorder.finish(payload['after'], f"Build cancelled: {str(e)}", 'cancelled')
+        raise
+    except Exception as e:
+        build_log.write(f"Build failed: {str(e)}\n")
+        recorder.finish(payload['after'], f"Build failed: {str(e)}", 'failure')
+        raise
+    finally:
+        build_log.close()
+
+
+def run_pipeline(build_id, payload, build_log=None, cancel=None, recorder=None):
+    """
+    Runs the clone, syntax check, test and notification stages of a build.
+
+    The duration of each stage is recorded with the build, the time spent sending
+    commit statuses adding up to the notify stage, as are the lint messages and
+    the outcome of each test.
+
+    Once cancel is set, the build stops after the current stage, killing the test
+    processes if the tests are running, and raises BuildCancelled. The checkout is
+    removed either way.
+    """
+    build_log = build_log or BuildLog(config.BUILD_LOG_PATH, build_id, config.BUILD_LOG_MAX_BYTES, config.BUILD_LOG_CHUNK_BYTES)
+    recorder = recorder or LocalRecorder(build_id)
+    token = os.getenv('GITHUB_TOKEN')
+    repo_url = payload['repository']['clone_url']
+    ghSyntax = GithubNotification(payload['organization']['login'], payload['repository']['name'], token, config.SERVER_URL, "ci/syntaxcheck")
+    ghTest = GithubNotification(payload['organization']['login'], payload['repository']['name'], token, config.SERVER_URL, "ci/tests")
+    run_id = str(build_id)
+    branch = get_branch(payload['ref'])
+
+    notify_seconds = 0.0
+
+    def check_cancelled():
+        if cancel is not None and cancel.is_set():
+            raise BuildCancelled(f"Superseded by a newer build of {branch}")
+
+    def send_status(notification, state, description):
+        nonlocal notify_seconds
+        started = time.perf_counter()
+        try:
+            notification.send_commit_status(state, description, payload['after'], run_id)
+        finally:
+            seconds = time.perf_counter() - started
+            notify_seconds += seconds
+            recorder.stage('notify', notify_seconds)
+            metrics.stage_seconds.observe(seconds, stage='notify')
+
+    build_log.write(f"===== Build {build_id}: {repo_url} {branch} {payload['after']} =====\n")
+    started = time.perf_counter()
+    try:
+        cloned = clone_check(repo_url, branch, payload['after'])
+        if isinstance(cloned, dict):
+            raise Exception(cloned['message'])
+        commit_id, result = cloned
+    except Exception as clone_error:
+        log.error("Clone failed", error=str(clone_error))
+        finish_stage(recorder, 'clone', time.perf_counter() - started)
+        send_status(ghTest, "failure", "Tests failed")
+        raise clone_error
+    finish_stage(recorder, 'clone', time.perf_counter() - started)
+
+    try:
+        check_cancelled()
+        changed_files = None
+        if config.SYNTAX_CHECK_INCREMENTAL or config.TEST_IMPACT_ANALYSIS:
+            changed_files = get_changed_files(result, payload.get('before'), payload['after'], payload.get('commits'))
+        started = time.perf_counter()
+        syntaxcheck = syntax_check(result, changed_files if config.SYNTAX_CHECK_INCREMENTAL else None)
+        finish_stage(recorder, 'lint', time.perf_counter() - started)
+        log.info("Syntax check done", status=syntaxcheck['status'], errors=syntaxcheck.get('error_count'))
+        if syntaxcheck['details']:
+            recorder.lint_messages(flatten_details(syntaxcheck['details'], result))
+        build_log.write(f"===== Syntax check: {syntaxcheck['status']} =====\n{json.dumps(syntaxcheck['details'], indent=2)}\n")
+        check_cancelled()
+
+        if syntaxcheck['status'] == "success":
+            send_status(ghSyntax, "success", "Syntax check passed")
+        else:
+            send_status(ghSyntax, "failure", "Syntax check failed")
+
+        if syntaxcheck['status'] == "error":
+            raise Exception("Syntax check failed")
+
+        build_log.write("===== Tests =====\n")
+        started = time.perf_counter()
+        test_results, test_logs = run_tests(
+            result, repo=repo_url,
+            changed_files=changed_files if config.TEST_IMPACT_ANALYSIS else None,
+            commit_id=payload['after'], log=build_log, cancel=cancel, record_outcomes=recorder.test_outcomes
+        )
+        finish_stage(recorder, 'test', time.perf_counter() - started)
+        log.info("Tests done", passed=test_results)
+        check_cancelled()
+        if test_results:
+            send_status(ghTest, "success", "Tests passed")
+        else:
+            send_status(ghTest, "failure", "Tests failed")
+
+        if not test_results:
+            raise Exception("Tests failed")
+
+        if not commit_id:
+            raise Exception("Error cloning repository.")
+
+        log.info("Build passed", log_path=build_log.path)
+        # Only the tail of the test output is kept in the history, the full log stays on disk
+        logs = f"Syntax Check Logs: {syntaxcheck['details']} \nTest Logs: {test_logs}"
+        recorder.finish(commit_id, logs, 'success')
+    finally:
+        # The checkout is not needed by this build anymore, whether it passed or not
+        remove_temp_folder(result)
+
+
+def finish_stage(recorder, stage, seconds):
+    """Records the duration of a build stage with the build and in the ci_stage_seconds histogram."""
+    recorder.stage(stage, seconds)
+    metrics.stage_seconds.observe(seconds, stage=stage)
+
+
+def remove_temp_folder(folder):
+    """
+    Hands the checkout of a build back to the workspace pool.
+
+    It is kept for the next build of the repository, or deleted in the background
+    if the pool is full, see workspace_pool.WorkspacePool.
+
+    Args:
+        folder (str): Path of the checkout returned by clone_check.
+    """
+    workspace_pool.release(folder)
+
+class KeepAliveHandler(SimpleHandler):
+    """
+    SimpleHandler speaking HTTP/1.1, so clients can reuse their connection.
+
+    It answers the requests a client has sent and returns without waiting for
+    the next one: PooledHTTPServer watches the idle connection and calls
+    handle_next once it becomes readable.
+    """
+    protocol_version = 'HTTP/1.1'
+    follow_logs = True
+
+    def handle(self):
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            # Requests already read into the buffer would not wake the selector up
+            while not self.close_connection and self._input_buffered():
+                self.handle_one_request()
+        except BaseException:
+            self.close_connection = True
+            raise
+
+    def handle_next(self):
+        """Answers the requests that arrived on the connection since the last ones."""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        # The files of a connection kept alive are used again by handle_next
+        if self.close_connection:
+            super().finish()
+
+    def _input_buffered(self):
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer that answers requests on a bounded pool of threads.
+
+    A connection only holds a thread while one of its requests is read and
+    answered. New connections, and keep-alive connections between requests,
+    are watched by a selector thread and handed to the pool once the client
+    sends something. Connections idle for longer than the timeout of the handler
+    are closed.
+
+    At most max_in_flight requests are accepted at once, counting both the ones
+    being served and the ones waiting for a free thread. Requests beyond that
+    are answered with 503 straight away instead of piling up.
+    """
+
+    def __init__(self, server_address, handler_class, max_workers=16, max_in_flight=64):
+        super().__init__(server_address, handler_class)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http')
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._selector = selectors.DefaultSelector()
+        # Written to when a connection is parked or the server closes, to wake the selector up
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._parking = []
+        self._closing = False
+        self._parking_lock = threading.Lock()
+        self._watcher = threading.Thread(target=self._watch_idle, name='http-idle', daemon=True)
+        self._watcher.start()
+
+    def process_request(self, request, client_address):
+        self._park(request, client_address, None)
+
+    def process_request_thread(self, request, client_address, handler=None):
+        keep_alive = False
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            else:
+                handler.handle_next()
+            keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._slots.release()
+        if keep_alive:
+            self._park(request, client_address, handler)
+        else:
+            self._close(request, handler)
+
+    def reject_request(self, request, handler=None):
+        try:
+            request.sendall(
+                b"HTTP/1.1 503 Service Unavailable\r\n"
+                b"Content-Type: text/html\r\n"
+                b"Content-Length: 23\r\n"
+                b"Retry-After: 1\r\n"
+                b"Connection: close\r\n\r\n"
+                b"503 Service Unavailable"
+            )
+        except OSError:
+            pass
+        self._close(request, handler)
+
+    def server_close(self):
+        """Stops accepting connections, closes the idle ones and waits for the requests in flight."""
+        super().server_close()
+        with self._parking_lock:
+            self._closing = True
+        self._waker.send(b'\0')
+        self._watcher.join()
+        self._executor.shutdown(wait=True)
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+    def _park(self, request, client_address, handler):
+        with self._parking_lock:
+            closing = self._closing
+            if not closing:
+                self._parking.append((request, client_address, handler))
+        if closing:
+            self._close(request, handler)
+        else:
+            self._waker.send(b'\0')
+
+    def _dispatch(self, request, client_address, handler):
+        if not self._slots.acquire(blocking=False):
+            self.reject_request(request, handler)
+            return
+        try:
+            self._executor.submit(self.process_request_thread, request, client_address, handler)
+        except RuntimeError:
+            # The pool is shutting down
+            self._slots.release()
+            self._close(request, handler)
+
+    def _close(self, request, handler):
+        if handler is not None and not handler.close_connection:
+            handler.close_connection = True
+            handler.finish()
+        self.shutdown_request(request)
+
+    def _watch_idle(self):
+        idle_timeout = self.RequestHandlerClass.timeout
+        # All connections wait for the same time, so the oldest one expires first
+        deadlines = OrderedDict()
+        while True:
+            wait = None
+            if deadlines and idle_timeout is not None:
+                wait = max(0.0, next(iter(deadlines.values())) - time.monotonic())
+            for key, _ in self._selector.select(wait):
+                if key.fileobj is self._wakeup:
+                    try:
+                        self._wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self._dispatch(key.fileobj, *key.data)
+            with self._parking_lock:
+                parking, self._parking = self._parking, []
+                closing = self._closing
+            now = time.monotonic()
+            for request, client_address, handler in parking:
+                self._selector.register(request, selectors.EVENT_READ, (client_address, handler))
+                deadlines[request] = now + (idle_timeout or 0)
+            while deadlines and (closing or idle_timeout is not None and next(iter(deadlines.values())) <= now):
+                request, _ = deadlines.popitem(last=False)
+                _, handler = self._selector.get_key(request).data
+                self._selector.unregister(request)
+                self._close(request, handler)
+            if closing:
+                return
+
+
+SERVER_MODES = ('single', 'threaded')
+
+
+def run_server(port, mode='single', max_workers=None, max_in_flight=None):
     """
     Starts an HTTP server on the specified port.
 
     Args:
         port: Port number for the server
+        mode (str): 'single' serves one request at a time, 'threaded' serves
+            keep-alive connections concurrently on a bounded thread pool.
+        max_workers (int): Size of the thread pool in threaded mode.
+        max_in_flight (int): Maximum number of requests accepted at once in threaded mode.
 
     Returns:
         HTTPServer: The running server instance.
     """
-    server = HTTPServer(('', port), SimpleHandler)
-    print(f'Server running on port {port}...')
+    if mode == 'threaded':
+        server = PooledHTTPServer(
+            ('', port), KeepAliveHandler,
+            max_workers=max_workers or config.HTTP_WORKERS,
+            max_in_flight=max_in_flight or config.HTTP_MAX_IN_FLIGHT
+        )
+    elif mode == 'single':
+        server = HTTPServer(('', port), SimpleHandler)
+    else:
+        raise ValueError(f"Unknown server mode '{mode}', expected one of {SERVER_MODES}")
+    workspace_pool.reap_leaked(startup=True)
+    if config.LINT_SERVICE_ENABLED:
+        lint_service.start()
+    build_queue.start()
+    github_client.start()
+    log.info("Server running", port=port, mode=mode)
     return server
+
+
+def stop_server(server):
+    """
+    Shuts a server down gracefully.
+
+    Stops accepting requests, lets the in-flight ones finish and waits for the
+    builds being run to complete. Queued builds and commit statuses not sent yet
+    stay in their tables for the next start.
+
+    Args:
+        server: Server returned by run_server, whose serve_forever loop runs in another thread.
+    """
+    log.info("Shutting down server")
+    server.shutdown()
+    server.server_close()
+    build_queue.stop()
+    lint_service.stop()
+    workspace_pool.drain(timeout=30)
+    github_client.flush(timeout=5)
+    github_client.stop(timeout=5)
+    log.info("Server stopped")
+
+
+build_queue = BuildQueue(process_build, workers=config.BUILD_WORKERS, db_path=config.DB_PATH,
+                         supersede=config.BUILD_SUPERSEDE)
+coordinator = Coordinator(build_queue, config.BUILD_LOG_PATH, config.RUNNER_LEASE_SECONDS,
+                          config.RUNNER_HEARTBEAT_SECONDS)
+
+
+def cache_requests():
+    """Hits and misses of the caches, for GET /metrics."""
+    counts = {}
+    for name, cache in (('lint', lint_cache), ('response', response_cache), ('venv', venv_cache)):
+        if cache is not None:
+            counts[(('cache', name), ('result', 'hit'))] = cache.hits
+            counts[(('cache', name), ('result', 'miss'))] = cache.misses
+    return counts
+
+
+metrics.registry.register('ci_build_queue_depth', 'Builds waiting for a worker.', 'gauge', build_queue.depth)
+metrics.registry.register('ci_builds_in_flight', 'Builds being run.', 'gauge', build_queue.running)
+metrics.registry.register('ci_runners_active', 'Remote runners heard from within the lease time.', 'gauge',
+                          lambda: coordinator.active_runners())
+# Walking the directories takes a while when they are large, so their sizes are sampled in the background
+metrics.registry.register('ci_tmp_dir_bytes', 'Disk used by the build workspaces, idle and retired ones included.',
+                          'gauge', metrics.Sampled(lambda: metrics.dir_size(TMP_PATH), config.METRICS_DISK_SAMPLE_SECONDS))
+metrics.registry.register('ci_workspaces', 'Build workspaces by state.', 'gauge',
+                          lambda: {(('state', state),): count for state, count in workspace_pool.counts().items()})
+metrics.registry.register('ci_workspace_checkouts_total', 'Checkouts by whether a workspace was reset or cloned.',
+                          'counter', lambda: {(('result', 'reset'),): workspace_pool.reused,
+                                              (('result', 'cloned'),): workspace_pool.created})
+metrics.registry.register('ci_mirror_cache_bytes', 'Disk used by the mirror cache.', 'gauge',
+                          metrics.Sampled(mirror_cache.size, config.METRICS_DISK_SAMPLE_SECONDS))
+metrics.registry.register('ci_venv_cache_bytes', 'Disk used by the cached test environments.', 'gauge',
+                          metrics.Sampled(lambda: venv_cache.size() if venv_cache is not None else 0,
+                                          config.METRICS_DISK_SAMPLE_SECONDS))
+metrics.registry.register('ci_cache_requests_total', 'Lookups of the lint, response and test environment caches.', 'counter',
+                          cache_requests)
+metrics.registry.register('ci_github_statuses_total', 'Commit statuses by what happened to them.', 'counter',
+                          lambda: {(('result', result),): count for result, count in github_client.stats.items()})
+metrics.registry.register('ci_github_outbox_depth', 'Commit statuses waiting to be sent.', 'gauge',
+                          lambda: github_client.outbox.count())
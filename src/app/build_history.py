@@ -1,93 +1,790 @@
+import hashlib
+import os
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
+import config
+from metrics import db_query_seconds
+from ci_logging import get_logger
+
+try:
+    import zstandard
+except ImportError:  # zlib is used instead
+    zstandard = None
+
+log = get_logger('build_history')
+
+# Rows of old inline logs compressed per transaction by the migration in create_database
+MIGRATION_BATCH = 500
+
+# Columns added to builds after its first version, with their types
+BUILD_COLUMNS = {
+    'build_logs': 'TEXT',
+    'status': 'TEXT',
+    'logs_ref': 'TEXT',
+    'repo_url': 'TEXT',
+    'branch': 'TEXT',
+    'started_at': 'TEXT',
+    'finished_at': 'TEXT',
+    'clone_seconds': 'REAL',
+    'lint_seconds': 'REAL',
+    'test_seconds': 'REAL',
+    'notify_seconds': 'REAL',
+}
+# Stages of a build timed in the <stage>_seconds columns of builds
+STAGES = ('clone', 'lint', 'test', 'notify')
+# Longest failure or lint message stored per test or lint finding
+MAX_MESSAGE_CHARS = 2000
+
+
+class BuildHistoryStore:
+    """
+    Thread-safe pool of connections to the build history database.
+
+    Connections are opened lazily, up to pool_size, and handed to one thread at a
+    time. The database runs in WAL mode, so readers never block the writer and the
+    writer never blocks readers; concurrent writers wait for each other for up to
+    busy_timeout instead of failing with 'database is locked'. Each connection
+    keeps its compiled statements cached, so reusing it skips parsing the SQL again.
+    """
+
+    def __init__(self, db_path, pool_size=8, busy_timeout=5000, synchronous='NORMAL', cached_statements=256):
+        """
+        Args:
+            db_path (str): Path of the SQLite database.
+            pool_size (int): Maximum number of open connections.
+            busy_timeout (int): Milliseconds a write waits for another one to finish.
+            synchronous (str): SQLite 'synchronous' setting, NORMAL is safe with WAL.
+            cached_statements (int): Compiled statements cached per connection.
+        """
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.busy_timeout / 1000,
+            check_same_thread=False, cached_statements=self.cached_statements
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends a connection of the pool, waiting for one if all of them are in use.
+
+        The transaction is committed when the block exits normally and rolled back
+        when it raises. The time from asking for the connection to handing it back
+        is recorded in the ci_db_query_seconds histogram.
+        """
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+            db_query_seconds.observe(time.perf_counter() - started)
+
+    def close(self):
+        """Closes the idle connections of the pool."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+class HistoryVersion:
+    """
+    Counter of the writes to the builds table made by this process.
+
+    Readers caching what they read from the builds table (see response_cache) compare
+    the version they read at with the current one to tell whether it is still fresh.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.modified = time.time()
+        self._lock = threading.Lock()
+
+    def bump(self):
+        """Marks the builds table as changed."""
+        with self._lock:
+            self.version += 1
+            self.modified = time.time()
+
+    def current(self):
+        """Returns the version and the time of the last change, as a Unix timestamp."""
+        with self._lock:
+            return self.version, self.modified
+
+
+history_version = HistoryVersion()
+
+store = BuildHistoryStore(
+    config.DB_PATH,
+    pool_size=config.DB_POOL_SIZE,
+    busy_timeout=config.DB_BUSY_TIMEOUT_MS,
+    synchronous=config.DB_SYNCHRONOUS
+)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(db_path):
+    """
+    Returns the connection pool of a database.
+
+    The build history database gets the shared store, so the queue, the caches and
+    the GitHub outbox living in it share its connections and settings. Other paths,
+    e.g. in tests, get a pool of their own with the same settings, one per path.
+
+    Args:
+        db_path (str): Path of the SQLite database.
+
+    Returns:
+        BuildHistoryStore: The pool.
+    """
+    db_path = os.path.abspath(db_path)
+    if db_path == os.path.abspath(store.db_path):
+        return store
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = BuildHistoryStore(
+                db_path, pool_size=config.DB_POOL_SIZE, busy_timeout=config.DB_BUSY_TIMEOUT_MS,
+                synchronous=config.DB_SYNCHRONOUS
+            )
+        return _stores[db_path]
 
 def create_database(table_name='builds'):
     """Create the database and the specified table if it doesn't exist, and add missing columns."""
-    print(f"Creating database and table '{table_name}' if not exists.")  
+    log.debug("Creating database", table=table_name)
     try:
-        print("Connecting to the database...")
-        conn = sqlite3.connect('build_history.db')  
-        cursor = conn.cursor()
-        
-        # Create the table if it doesn't exist
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id INTEGER PRIMARY KEY,
-                commit_id TEXT,
-                build_date TEXT,
-                build_logs TEXT,
-                github_commit_url TEXT  
-            )
-        ''')
+        with store.connection() as conn:
+            cursor = conn.cursor()
         
-        # Check if the 'build_logs' column exists, and add it if not
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        column_names = [column[1] for column in columns]
-
-        if 'build_logs' not in column_names:
-            print(f"Adding 'build_logs' column to table '{table_name}'.")
-            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN build_logs TEXT;")
+            # Create the table if it doesn't exist
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id INTEGER PRIMARY KEY,
+                    commit_id TEXT,
+                    build_date TEXT,
+                    build_logs TEXT,
+                    github_commit_url TEXT,
+                    status TEXT
+                )
+            ''')
         
-        conn.commit()
+            # Add the columns missing from tables created by earlier versions
+            cursor.execute(f"PRAGMA table_info({table_name});")
+            columns = cursor.fetchall()
+            column_names = [column[1] for column in columns]
+            for column, column_type in BUILD_COLUMNS.items():
+                if column not in column_names:
+                    log.info("Adding column", table=table_name, column=column)
+                    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type};")
+
+            # Logs are stored compressed in log_blobs, builds only keep a reference
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS log_blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    codec TEXT,
+                    size INTEGER,
+                    data BLOB
+                )
+            ''')
         
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        print(f"Tables after creation: {tables}")  
+            # Filters of the paginated build list, see get_logs
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_commit ON {table_name} (commit_id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_status ON {table_name} (status, id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_date ON {table_name} (build_date, id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_branch ON {table_name} (repo_url, branch, id)")
+
+            # Outcome of every test and every lint message of a build
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS test_outcomes (
+                    build_id INTEGER,
+                    test_file TEXT,
+                    name TEXT,
+                    outcome TEXT,
+                    seconds REAL,
+                    message TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_outcomes_build ON test_outcomes (build_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_outcomes_name ON test_outcomes (name, outcome)")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lint_messages (
+                    build_id INTEGER,
+                    path TEXT,
+                    line INTEGER,
+                    column INTEGER,
+                    symbol TEXT,
+                    message_id TEXT,
+                    type TEXT,
+                    message TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_lint_messages_build ON lint_messages (build_id)")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS clone_timings (
+                    id INTEGER PRIMARY KEY,
+                    repo_url TEXT,
+                    strategy TEXT,
+                    seconds REAL,
+                    recorded_at TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_clone_timings_repo ON clone_timings (repo_url, strategy)")
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS test_durations (
+                    repo_url TEXT,
+                    test_file TEXT,
+                    seconds REAL,
+                    updated_at TEXT,
+                    PRIMARY KEY (repo_url, test_file)
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS test_coverage (
+                    repo_url TEXT,
+                    test_file TEXT,
+                    source_file TEXT
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_coverage_repo ON test_coverage (repo_url)")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS coverage_runs (
+                    repo_url TEXT PRIMARY KEY,
+                    commit_id TEXT,
+                    recorded_at TEXT,
+                    builds_since INTEGER
+                )
+            ''')
+
         
-        conn.close()
-        print(f"Database created and table '{table_name}' initialized successfully.")
+        migrate_inline_logs(table_name)
+        log.info("Database initialized", table=table_name, db_path=store.db_path)
     except Exception as e:
-        print(f"Error during database creation: {e}")
+        log.error("Error during database creation", error=str(e))
 
 def get_github_commit_url(commit_id):
     """Generate a unique URL for a specific build."""
     return f"https://github.com/DD2480Group8/DD2480-CI/commit/{commit_id}"
 
-def log_build(commit_id, build_logs=None, table_name='builds'):
-    """Log the build details to the specified table in the database."""
-    try:
-        print(f"Logging build for commit: {commit_id} in table '{table_name}'")
-        conn = sqlite3.connect('build_history.db')
-        cursor = conn.cursor()
-        build_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S') 
-        github_commit_url = get_github_commit_url(commit_id)  
-        cursor.execute(f'''
-            INSERT INTO {table_name} (commit_id, build_date, build_logs, github_commit_url)
-            VALUES (?, ?, ?, ?)
-        ''', (commit_id, build_date, build_logs if build_logs else 'No logs available', github_commit_url))
-        conn.commit()
-        conn.close()
-        print(f"Build logged: {commit_id} on {build_date}, \nLogs: {build_logs} \nURL: {github_commit_url}")
-    except Exception as e:
-        print(f"Error logging build: {e}")
-
-def get_logs():
-    """Retrieve all build logs from the database."""
-    try:
-        print("Retrieving build logs from database.")
-        conn = sqlite3.connect('build_history.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM builds")
-        logs = cursor.fetchall()
-        conn.close()
-        print(f"Logs retrieved: {logs}")
+def compress_logs(text):
+    """
+    Compress build logs with zstd when the zstandard package is installed and
+    config.LOG_CODEC allows it, with zlib otherwise.
+
+    Returns:
+        tuple: (codec name, compressed bytes).
+    """
+    data = text.encode('utf-8', errors='replace')
+    if zstandard is not None and config.LOG_CODEC in ('auto', 'zstd'):
+        return 'zstd', zstandard.ZstdCompressor(level=config.LOG_COMPRESSION_LEVEL).compress(data)
+    return 'zlib', zlib.compress(data, min(config.LOG_COMPRESSION_LEVEL, 9))
+
+def decompress_logs(codec, data):
+    """Decompress build logs stored by store_logs."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Logs are compressed with zstd, install the zstandard package to read them")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+def store_logs(conn, text):
+    """
+    Store build logs compressed in log_blobs, keyed by the SHA-256 of their text,
+    so identical logs are stored once.
+
+    Returns:
+        str: The reference to keep in the logs_ref column of builds.
+    """
+    raw = text.encode('utf-8', errors='replace')
+    ref = hashlib.sha256(raw).hexdigest()
+    if conn.execute("SELECT 1 FROM log_blobs WHERE sha256 = ?", (ref,)).fetchone() is None:
+        codec, data = compress_logs(text)
+        conn.execute(
+            "INSERT OR IGNORE INTO log_blobs (sha256, codec, size, data) VALUES (?, ?, ?, ?)",
+            (ref, codec, len(raw), data)
+        )
+    return ref
+
+def load_logs(conn, refs):
+    """Load and decompress the logs behind several references, as a dict."""
+    refs = list(set(ref for ref in refs if ref))
+    logs = {}
+    for i in range(0, len(refs), MIGRATION_BATCH):
+        batch = refs[i:i + MIGRATION_BATCH]
+        rows = conn.execute(
+            f"SELECT sha256, codec, data FROM log_blobs WHERE sha256 IN ({','.join('?' * len(batch))})", batch
+        ).fetchall()
+        logs.update((ref, decompress_logs(codec, data)) for ref, codec, data in rows)
+    return logs
+
+def migrate_inline_logs(table_name='builds'):
+    """Move logs stored inline in builds by earlier versions into log_blobs."""
+    try:
+        migrated = 0
+        while True:
+            with store.connection() as conn:
+                rows = conn.execute(
+                    f"SELECT id, build_logs FROM {table_name} WHERE logs_ref IS NULL AND build_logs IS NOT NULL LIMIT ?",
+                    (MIGRATION_BATCH,)
+                ).fetchall()
+                for build_id, text in rows:
+                    conn.execute(
+                        f"UPDATE {table_name} SET logs_ref = ?, build_logs = NULL WHERE id = ?",
+                        (store_logs(conn, text), build_id)
+                    )
+            migrated += len(rows)
+            if len(rows) < MIGRATION_BATCH:
+                break
+        if migrated:
+            log.info("Compressed inline build logs", table=table_name, builds=migrated)
+    except Exception as e:
+        log.error("Error migrating build logs", error=str(e))
+
+def create_build(commit_id, table_name='builds', repo_url=None, branch=None):
+    """Reserve a row for a build that has been queued but not started yet, and return its id."""
+    with store.connection() as conn:
+        build_id = insert_build(conn, commit_id, table_name, repo_url, branch)
+    history_version.bump()
+    return build_id
+
+def insert_build(conn, commit_id, table_name='builds', repo_url=None, branch=None):
+    """
+    Reserve a row for a queued build in the transaction of conn, see create_build.
+
+    The caller bumps history_version once the transaction is committed.
+    """
+    build_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor = conn.execute(f'''
+        INSERT INTO {table_name} (commit_id, build_date, logs_ref, github_commit_url, status, repo_url, branch)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (commit_id, build_date, store_logs(conn, 'Build queued'), get_github_commit_url(commit_id), 'queued',
+          repo_url, branch))
+    return cursor.lastrowid
+
+def set_build_status(build_id, status, table_name='builds'):
+    """Update the status of a previously reserved build, noting when it started running."""
+    try:
+        with store.connection() as conn:
+            if status == 'running':
+                conn.execute(
+                    f"UPDATE {table_name} SET status = ?, started_at = ? WHERE id = ?",
+                    (status, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), build_id)
+                )
+            else:
+                conn.execute(f"UPDATE {table_name} SET status = ? WHERE id = ?", (status, build_id))
+        history_version.bump()
+    except Exception as e:
+        log.error("Error updating build status", error=str(e))
+
+def record_stage(build_id, stage, seconds, table_name='builds'):
+    """Record how long a stage of a build took, one of STAGES."""
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage '{stage}', expected one of {STAGES}")
+    try:
+        with store.connection() as conn:
+            conn.execute(f"UPDATE {table_name} SET {stage}_seconds = ? WHERE id = ?", (seconds, build_id))
+        history_version.bump()
+    except Exception as e:
+        log.error("Error recording stage duration", stage=stage, error=str(e))
+
+def log_test_outcomes(build_id, outcomes, replace=False):
+    """
+    Record the outcome of each test of a build.
+
+    Args:
+        build_id (int): Id of the build.
+        outcomes (list): Dicts with 'test_file', 'name', 'outcome' (passed, failed,
+            error or skipped), 'seconds' and 'message'.
+        replace (bool): Drop the outcomes recorded for the build before, e.g. by
+            an earlier attempt or a request sent again.
+    """
+    try:
+        with store.connection() as conn:
+            if replace:
+                conn.execute("DELETE FROM test_outcomes WHERE build_id = ?", (build_id,))
+            conn.executemany(
+                "INSERT INTO test_outcomes (build_id, test_file, name, outcome, seconds, message) VALUES (?, ?, ?, ?, ?, ?)",
+                [(build_id, o['test_file'], o['name'], o['outcome'], o['seconds'], (o.get('message') or '')[:MAX_MESSAGE_CHARS] or None)
+                 for o in outcomes]
+            )
+    except Exception as e:
+        log.error("Error logging test outcomes", error=str(e))
+
+def log_lint_messages(build_id, messages, replace=False):
+    """
+    Record the pylint messages of a build.
+
+    Args:
+        build_id (int): Id of the build.
+        messages (list): Pylint JSON messages, with 'path' relative to the checkout.
+        replace (bool): Drop the messages recorded for the build before.
+    """
+    try:
+        with store.connection() as conn:
+            if replace:
+                conn.execute("DELETE FROM lint_messages WHERE build_id = ?", (build_id,))
+            conn.executemany(
+                "INSERT INTO lint_messages (build_id, path, line, column, symbol, message_id, type, message) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(build_id, m.get('path'), m.get('line'), m.get('column'), m.get('symbol'), m.get('message-id'),
+                  m.get('type'), (m.get('message') or '')[:MAX_MESSAGE_CHARS]) for m in messages]
+            )
+    except Exception as e:
+        log.error("Error logging lint messages", error=str(e))
+
+def log_build(commit_id, build_logs=None, table_name='builds', build_id=None, status='success'):
+    """
+    Log the build details to the specified table in the database.
+
+    When build_id is given, the row reserved by create_build is completed in place,
+    otherwise a new row is inserted.
+    """
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            build_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S') 
+            github_commit_url = get_github_commit_url(commit_id)  
+            logs_ref = store_logs(conn, build_logs if build_logs else 'No logs available')
+            values = (commit_id, build_date, logs_ref, github_commit_url, status)
+            if build_id is None:
+                cursor.execute(f'''
+                    INSERT INTO {table_name} (commit_id, build_date, logs_ref, github_commit_url, status)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', values)
+            else:
+                cursor.execute(f'''
+                    UPDATE {table_name}
+                    SET commit_id = ?, build_date = ?, build_logs = NULL, logs_ref = ?, github_commit_url = ?, status = ?,
+                        finished_at = ?
+                    WHERE id = ?
+                ''', (*values, build_date, build_id))
+        history_version.bump()
+        log.info("Build logged", build_id=build_id, commit_id=commit_id, status=status,
+                 logs_bytes=len(build_logs or ''))
+    except Exception as e:
+        log.error("Error logging build", error=str(e))
+
+BUILD_FIELDS = [
+    "id", "commit_id", "build_date", "build_logs", "github_commit_url", "status",
+    "repo_url", "branch", "started_at", "finished_at",
+    "clone_seconds", "lint_seconds", "test_seconds", "notify_seconds"
+]
+# Fields listed by default, the logs can be large
+SUMMARY_FIELDS = [field for field in BUILD_FIELDS if field != "build_logs"]
+
+def get_logs(limit=100, after_id=None, commit_id=None, statuses=None, since=None, until=None,
+             fields=SUMMARY_FIELDS, descending=False, repo_url=None, branch=None):
+    """
+    Retrieve a page of builds from the database.
+
+    Pages are read by keyset: the next page starts after the id of the last build
+    of the previous one, so reading deep pages costs no more than the first one.
+
+    Args:
+        limit (int): Maximum number of builds.
+        after_id (int): Only builds after this id, in the listing order.
+        commit_id (str): Only builds of commits starting with this hex SHA prefix.
+        statuses (list): Only builds with one of these statuses.
+        since (str): Only builds from this date on, as 'YYYY-MM-DD[ HH:MM:SS]'.
+        until (str): Only builds before this date, as 'YYYY-MM-DD[ HH:MM:SS]'.
+        fields (list): Columns to return, out of BUILD_FIELDS.
+        descending (bool): List the newest builds first.
+        repo_url (str): Only builds of this repository.
+        branch (str): Only builds of this branch.
+
+    Returns:
+        list: Tuples with the requested fields, ordered by id.
+    """
+    fields = [field for field in fields if field in BUILD_FIELDS]
+    conditions, params = [], []
+    if after_id is not None:
+        conditions.append("id < ?" if descending else "id > ?")
+        params.append(after_id)
+    if commit_id:
+        # GLOB on a prefix can use the index, commit ids are checked to be hex
+        conditions.append("commit_id GLOB ?")
+        params.append(commit_id + '*')
+    if statuses:
+        conditions.append(f"status IN ({','.join('?' * len(statuses))})")
+        params.extend(statuses)
+    if repo_url:
+        conditions.append("repo_url = ?")
+        params.append(repo_url)
+    if branch:
+        conditions.append("branch = ?")
+        params.append(branch)
+    if since:
+        conditions.append("build_date >= ?")
+        params.append(since)
+    if until:
+        conditions.append("build_date < ?")
+        params.append(until)
+    # Logs are read from log_blobs, and only when they are asked for
+    columns = ["COALESCE(logs_ref, build_logs)" if field == "build_logs" else field for field in fields]
+    query = f"SELECT {', '.join(columns)} FROM builds"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY id {'DESC' if descending else 'ASC'} LIMIT ?"
+    params.append(limit)
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            logs = cursor.fetchall()
+            if "build_logs" in fields:
+                logs = _resolve_logs(conn, logs, fields.index("build_logs"))
+        log.debug("Builds retrieved", count=len(logs))
         return logs
     except Exception as e:
-        print(f"Error retrieving logs: {e}")
+        log.error("Error retrieving logs", error=str(e))
+        return []
+
+def get_log(id, fields=BUILD_FIELDS):
+    """
+    Retrieve a specific build from the database.
+
+    Args:
+        id (int): Id of the build.
+        fields (list): Columns to return, out of BUILD_FIELDS. The logs are only
+            decompressed when 'build_logs' is one of them.
+
+    Returns:
+        tuple: The requested fields, or None if there is no such build.
+    """
+    fields = [field for field in fields if field in BUILD_FIELDS]
+    columns = ["COALESCE(logs_ref, build_logs)" if field == "build_logs" else field for field in fields]
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(columns)} FROM builds WHERE id=?", (id,))
+            row = cursor.fetchone()
+            if row is not None and "build_logs" in fields:
+                row = _resolve_logs(conn, [row], fields.index("build_logs"))[0]
+        return row
+    except Exception as e:
+        log.error("Error retrieving log", error=str(e))
+        return None
+
+def _resolve_logs(conn, rows, index):
+    """Replace the log references at position index of rows with the logs they point to."""
+    logs = load_logs(conn, [row[index] for row in rows])
+    return [row[:index] + (logs.get(row[index], row[index]),) + row[index + 1:] for row in rows]
+
+def get_test_outcomes(build_id, outcomes=None):
+    """
+    Retrieve the test outcomes of a build.
+
+    Args:
+        build_id (int): Id of the build.
+        outcomes (list): Only tests with one of these outcomes, e.g. ['failed', 'error'].
+
+    Returns:
+        list: Tuples of (test_file, name, outcome, seconds, message).
+    """
+    query = "SELECT test_file, name, outcome, seconds, message FROM test_outcomes WHERE build_id = ?"
+    params = [build_id]
+    if outcomes:
+        query += f" AND outcome IN ({', '.join('?' * len(outcomes))})"
+        params.extend(outcomes)
+    try:
+        with store.connection() as conn:
+            return conn.execute(query + " ORDER BY rowid", params).fetchall()
+    except Exception as e:
+        log.error("Error retrieving test outcomes", error=str(e))
+        return []
+
+def get_lint_messages(build_id):
+    """Retrieve the lint messages of a build as tuples of (path, line, column, symbol, message_id, type, message)."""
+    try:
+        with store.connection() as conn:
+            return conn.execute(
+                "SELECT path, line, column, symbol, message_id, type, message FROM lint_messages "
+                "WHERE build_id = ? ORDER BY rowid", (build_id,)
+            ).fetchall()
+    except Exception as e:
+        log.error("Error retrieving lint messages", error=str(e))
+        return []
+
+def get_failure_rates(since=None, table_name='builds'):
+    """
+    Retrieve the share of failed builds and the average stage durations per repository and branch.
+
+    Args:
+        since (str): Only builds from this date on, 'YYYY-MM-DD[ HH:MM:SS]'.
+
+    Returns:
+        list: Tuples of (repo_url, branch, builds, failure rate, average clone, lint,
+            test and notify seconds), most failing first.
+    """
+    params = []
+    condition = "status IN ('success', 'failure')"
+    if since:
+        condition += " AND build_date >= ?"
+        params.append(since)
+    try:
+        with store.connection() as conn:
+            return conn.execute(f'''
+                SELECT repo_url, branch, COUNT(*), AVG(status = 'failure'),
+                       AVG(clone_seconds), AVG(lint_seconds), AVG(test_seconds), AVG(notify_seconds)
+                FROM {table_name} WHERE {condition}
+                GROUP BY repo_url, branch ORDER BY 4 DESC, 3 DESC
+            ''', params).fetchall()
+    except Exception as e:
+        log.error("Error retrieving failure rates", error=str(e))
         return []
 
-def get_log(id):
-    """Retrieve a specific build log from the database."""
+def log_clone_timing(repo_url, strategy, seconds):
+    """Record how long cloning a repository took with a given strategy."""
+    try:
+        with store.connection() as conn:
+            conn.execute(
+                "INSERT INTO clone_timings (repo_url, strategy, seconds, recorded_at) VALUES (?, ?, ?, ?)",
+                (repo_url, strategy, seconds, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+    except Exception as e:
+        log.error("Error logging clone timing", error=str(e))
+
+def get_clone_timings(repo_url, recent=10):
+    """
+    Retrieve the clone timings of a repository per strategy.
+
+    Returns a dict mapping each strategy to (sample count, average seconds) over its
+    most recent samples.
+    """
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT strategy, COUNT(*), AVG(seconds) FROM (
+                    SELECT strategy, seconds, ROW_NUMBER() OVER (PARTITION BY strategy ORDER BY id DESC) AS age
+                    FROM clone_timings WHERE repo_url = ?
+                ) WHERE age <= ? GROUP BY strategy
+            ''', (repo_url, recent))
+            timings = {strategy: (count, average) for strategy, count, average in cursor.fetchall()}
+        return timings
+    except Exception as e:
+        log.error("Error retrieving clone timings", error=str(e))
+        return {}
+
+def log_test_durations(repo_url, durations):
+    """Record the latest duration in seconds of each test file of a repository."""
+    try:
+        with store.connection() as conn:
+            updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            conn.executemany(
+                "INSERT OR REPLACE INTO test_durations (repo_url, test_file, seconds, updated_at) VALUES (?, ?, ?, ?)",
+                [(repo_url, test_file, seconds, updated_at) for test_file, seconds in durations.items()]
+            )
+    except Exception as e:
+        log.error("Error logging test durations", error=str(e))
+
+def get_test_durations(repo_url):
+    """Retrieve the recorded duration in seconds of each test file of a repository."""
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT test_file, seconds FROM test_durations WHERE repo_url = ?", (repo_url,))
+            durations = dict(cursor.fetchall())
+        return durations
+    except Exception as e:
+        log.error("Error retrieving test durations", error=str(e))
+        return {}
+
+def save_coverage_map(repo_url, commit_id, coverage):
+    """
+    Replace the coverage map of a repository with the one recorded by a full test run.
+
+    Args:
+        repo_url (str): URL of the repository.
+        commit_id (str): Commit the tests ran on.
+        coverage (dict): Maps each test file to the source files it runs.
+    """
+    try:
+        with store.connection() as conn:
+            conn.execute("DELETE FROM test_coverage WHERE repo_url = ?", (repo_url,))
+            conn.executemany(
+                "INSERT INTO test_coverage (repo_url, test_file, source_file) VALUES (?, ?, ?)",
+                [(repo_url, test_file, source) for test_file, sources in coverage.items() for source in sources]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO coverage_runs (repo_url, commit_id, recorded_at, builds_since) VALUES (?, ?, ?, 0)",
+                (repo_url, commit_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+    except Exception as e:
+        log.error("Error saving coverage map", error=str(e))
+
+def get_coverage_map(repo_url):
+    """
+    Retrieve the coverage map of a repository.
+
+    Returns:
+        tuple: (dict mapping test files to sets of source files, date it was recorded,
+               number of builds run with it since), or None if there is no map.
+    """
+    try:
+        with store.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT recorded_at, builds_since FROM coverage_runs WHERE repo_url = ?", (repo_url,))
+            run = cursor.fetchone()
+            if run is None:
+                return None
+            coverage = {}
+            cursor.execute("SELECT test_file, source_file FROM test_coverage WHERE repo_url = ?", (repo_url,))
+            for test_file, source in cursor.fetchall():
+                coverage.setdefault(test_file, set()).add(source)
+        return coverage, run[0], run[1]
+    except Exception as e:
+        log.error("Error retrieving coverage map", error=str(e))
+        return None
+
+def count_selective_build(repo_url):
+    """Count a build that only ran the tests picked from the coverage map."""
     try:
-        print(f"Retrieving build log with id: {id}")
-        conn = sqlite3.connect('build_history.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM builds WHERE id=?", (id,))
-        log = cursor.fetchone()
-        conn.close()
-        print(f"Log retrieved: {log}")
-        return log
+        with store.connection() as conn:
+            conn.execute("UPDATE coverage_runs SET builds_since = builds_since + 1 WHERE repo_url = ?", (repo_url,))
     except Exception as e:
-        print(f"Error retrieving log: {e}")
-        return None
\ No newline at end of file
+        log.error("Error counting selective build", error=str(e))
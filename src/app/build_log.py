@@ -0,0 +1,153 @@
+import os
+import threading
+
+COMPLETE_FILE = 'complete'
+# Room kept below the size cap for the truncation markers
+MARKER_RESERVE = 256
+
+
+class BuildLog:
+    """
+    Append-only log of a build, written to disk as it is produced.
+
+    The log of build <id> lives in <root>/<id>/ as numbered chunk files of
+    chunk_bytes each, so it never has to be held in memory and readers can seek to
+    any offset. Output beyond max_bytes is dropped; a marker in the log says where
+    and, once the log is closed, how much was left out.
+
+    A build id can run again, e.g. when its build is queued again after a restart,
+    so opening a log starts it over unless resume is set.
+    """
+
+    def __init__(self, root, build_id, max_bytes, chunk_bytes, resume=False):
+        """
+        Args:
+            root (str): Directory holding the logs of all builds.
+            build_id (int): Id of the build.
+            max_bytes (int): Maximum size of the log on disk.
+            chunk_bytes (int): Size of each chunk file.
+            resume (bool): Append to the output already on disk instead of
+                removing it, for a build still running.
+        """
+        self.path = log_dir(root, build_id)
+        self.max_bytes = max(max_bytes, MARKER_RESERVE * 2)
+        self.chunk_bytes = chunk_bytes
+        self.size = 0
+        self.omitted = 0
+        self._file = None
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name == COMPLETE_FILE or (name.endswith('.log') and not resume):
+                os.remove(os.path.join(self.path, name))
+        if resume:
+            self.size = log_size(root, build_id)
+
+    def write(self, text):
+        """
+        Appends text to the log, truncating it once the size cap is reached.
+
+        Args:
+            text (str): Output to append.
+        """
+        data = text.encode('utf-8', errors='replace')
+        with self._lock:
+            if self.omitted:
+                self.omitted += len(data)
+                return
+            room = self.max_bytes - MARKER_RESERVE - self.size
+            if len(data) > room:
+                kept = data[:room]
+                # Cut at a line end when there is one, so no character is split
+                if b'\n' in kept:
+                    kept = kept[:kept.rindex(b'\n') + 1]
+                self._append(kept)
+                self.omitted = len(data) - len(kept)
+                self._append(f"\n[... log truncated at {self.size} bytes ...]\n".encode())
+                return
+            self._append(data)
+
+    def close(self):
+        """Finishes the log, so readers following it know no more output comes."""
+        with self._lock:
+            if self.omitted:
+                self._append(f"[... {self.omitted} bytes omitted ...]\n".encode())
+            if self._file:
+                self._file.close()
+                self._file = None
+            open(os.path.join(self.path, COMPLETE_FILE), 'w').close()
+
+    def _append(self, data):
+        while data:
+            index, position = divmod(self.size, self.chunk_bytes)
+            if position == 0 and self._file:
+                self._file.close()
+                self._file = None
+            if self._file is None:
+                self._file = open(chunk_path(self.path, index), 'ab')
+            part = data[:self.chunk_bytes - position]
+            self._file.write(part)
+            self._file.flush()
+            self.size += len(part)
+            data = data[len(part):]
+
+
+def log_dir(root, build_id):
+    """Returns the directory holding the log of a build."""
+    return os.path.join(root, str(int(build_id)))
+
+
+def chunk_path(path, index):
+    return os.path.join(path, f"{index:06d}.log")
+
+
+def log_exists(root, build_id):
+    """Returns whether a build has started writing its log."""
+    return os.path.isdir(log_dir(root, build_id))
+
+
+def is_complete(root, build_id):
+    """Returns whether the log of a build was closed."""
+    return os.path.exists(os.path.join(log_dir(root, build_id), COMPLETE_FILE))
+
+
+def log_size(root, build_id):
+    """Returns the number of bytes written to the log of a build so far."""
+    path = log_dir(root, build_id)
+    if not os.path.isdir(path):
+        return 0
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith('.log'))
+
+
+def read_log(root, build_id, offset, limit):
+    """
+    Reads part of a build log from disk.
+
+    Args:
+        root (str): Directory holding the logs of all builds.
+        build_id (int): Id of the build.
+        offset (int): Position in the log to read from.
+        limit (int): Maximum number of bytes to read.
+
+    Returns:
+        bytes: The data read, empty at the current end of the log.
+    """
+    path = log_dir(root, build_id)
+    data = b''
+    index = 0
+    while len(data) < limit:
+        try:
+            with open(chunk_path(path, index), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if offset >= size:
+                    offset -= size
+                    index += 1
+                    continue
+                f.seek(offset)
+                part = f.read(limit - len(data))
+        except FileNotFoundError:
+            break
+        data += part
+        offset = 0
+        index += 1
+    return data
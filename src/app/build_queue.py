@@ -0,0 +1,418 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from build_history import (create_build, insert_build, set_build_status, log_build, history_version, store_for,
+                           store as history_store)
+from ci_logging import get_logger, build_context
+
+log = get_logger('build_queue')
+
+FINISHED_STATES = ('success', 'failure', 'cancelled')
+
+
+class BuildCancelled(Exception):
+    """Raised by a build handler that stopped because a newer build superseded it."""
+
+
+class QueueStopped(Exception):
+    """Raised by BuildQueue.enqueue once the queue was stopped, e.g. while the server shuts down."""
+
+
+class BuildQueue:
+    """
+    Durable FIFO of webhook payloads drained by a pool of worker threads.
+
+    Jobs are stored in the 'build_queue' table of the build history database, so
+    builds that were queued or running when the server stopped are picked up again
+    on the next start. Every job shares its id with the row reserved in 'builds'.
+
+    With supersede, only the newest build of a repository branch matters: queuing
+    one cancels the builds of the same branch still waiting in the queue, and asks
+    the one running to stop through its cancel_event. Both end up 'cancelled'.
+
+    Remote runners take builds from the same queue through claim, see
+    coordinator.Coordinator. A build they claim is leased to them: the runner
+    renews the lease with heartbeat while it works, and a build whose lease
+    expires, because its runner died or lost the network, is queued again.
+    """
+
+    def __init__(self, handler, workers=2, db_path='build_history.db', supersede=False):
+        """
+        Args:
+            handler: Callable taking (build_id, payload) that runs one build. It
+                should raise if the build fails, and raise BuildCancelled if it
+                stopped because its cancel_event was set.
+            workers (int): Number of worker threads.
+            db_path (str): Path of the SQLite database holding the queue, see build_history.store_for.
+            supersede (bool): Cancel the older builds of a branch when a new one is queued.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.db_path = os.path.abspath(db_path)
+        self.store = store_for(db_path)
+        self.supersede = supersede
+        self._cancel_events = {}
+        self._threads = []
+        self._claim_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stopping = threading.Event()
+        self._ensure_table()
+
+    def _connect(self):
+        return self.store.connection()
+
+    def _ensure_table(self):
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS build_queue (
+                    build_id INTEGER PRIMARY KEY,
+                    payload TEXT,
+                    status TEXT,
+                    enqueued_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    message TEXT
+                )
+            ''')
+            # Repository and branch of the build, the builds superseding each other share it
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(build_queue)")]
+            if 'build_key' not in columns:
+                conn.execute("ALTER TABLE build_queue ADD COLUMN build_key TEXT")
+            # Remote runner a running build is leased to, and when the lease runs out as a Unix timestamp
+            if 'runner' not in columns:
+                conn.execute("ALTER TABLE build_queue ADD COLUMN runner TEXT")
+            if 'lease_expires' not in columns:
+                conn.execute("ALTER TABLE build_queue ADD COLUMN lease_expires REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_build_queue_key ON build_queue (build_key, status)")
+
+    def start(self):
+        """
+        Starts the worker threads if they are not running yet.
+
+        Jobs left in the 'running' state by the workers of a previous process are
+        queued again, and so are their builds, in the same transaction when the
+        queue shares the build history database. The ones leased to remote runners
+        keep running until their lease expires.
+        """
+        with self._cond:
+            self._stopping.clear()
+            self._start_workers()
+
+    def _start_workers(self):
+        # Called with self._cond held, so stop sees the threads started
+        if self._threads:
+            return
+        with self._connect() as conn:
+            interrupted = [(row[0],) for row in conn.execute(
+                "SELECT build_id FROM build_queue WHERE status = 'running' AND runner IS NULL"
+            )]
+            shared = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'builds'").fetchone()
+            if interrupted:
+                conn.executemany("UPDATE build_queue SET status = 'queued', started_at = NULL WHERE build_id = ?", interrupted)
+                if shared:
+                    conn.executemany("UPDATE builds SET status = 'queued', started_at = NULL WHERE id = ?", interrupted)
+                log.info("Re-queued interrupted builds", count=len(interrupted))
+        if interrupted:
+            if shared:
+                history_version.bump()
+            else:
+                for (build_id,) in interrupted:
+                    set_build_status(build_id, 'queued')
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"build-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker threads once they finish their current build.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait for each worker.
+        """
+        self._stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def enqueue(self, payload, repo_url=None, branch=None):
+        """
+        Reserves a build for the webhook payload and queues it for the workers.
+
+        Args:
+            payload (dict): Parsed GitHub push payload.
+            repo_url (str): Repository the build is recorded under.
+            branch (str): Branch the build is recorded under.
+
+        Returns:
+            int: The id of the queued build.
+
+        Raises:
+            QueueStopped: If stop was called, the build is not queued.
+        """
+        with self._cond:
+            if self._stopping.is_set():
+                raise QueueStopped("The build queue is stopped")
+            self._start_workers()
+        # The build and its job are written in one transaction when the queue shares
+        # the build history database, so a build is never left queued without a job
+        shared = self.store is history_store
+        build_id = None if shared else create_build(payload['after'], repo_url=repo_url, branch=branch)
+        build_key = f"{repo_url}#{branch}" if repo_url and branch else None
+        superseded = []
+        with self._claim_lock:
+            with self._connect() as conn:
+                if shared:
+                    build_id = insert_build(conn, payload['after'], repo_url=repo_url, branch=branch)
+                conn.execute(
+                    "INSERT INTO build_queue (build_id, payload, status, enqueued_at, build_key) VALUES (?, ?, 'queued', ?, ?)",
+                    (build_id, json.dumps(payload), _now(), build_key)
+                )
+                if self.supersede and build_key:
+                    superseded = conn.execute(
+                        "SELECT build_id, payload, status FROM build_queue "
+                        "WHERE build_key = ? AND status IN ('queued', 'running') AND build_id < ?",
+                        (build_key, build_id)
+                    ).fetchall()
+                    message = f"Superseded by build {build_id}"
+                    conn.execute(
+                        "UPDATE build_queue SET status = 'cancelled', finished_at = ?, message = ? "
+                        "WHERE build_key = ? AND status = 'queued' AND build_id < ?",
+                        (_now(), message, build_key, build_id)
+                    )
+                    for old_id, _, status in superseded:
+                        if status == 'running' and old_id in self._cancel_events:
+                            self._cancel_events[old_id].set()
+        if shared:
+            history_version.bump()
+        for old_id, old_payload, status in superseded:
+            log.info("Build superseded", build_id=old_id, superseded_by=build_id)
+            if status == 'queued':
+                log_build(json.loads(old_payload)['after'], f"Superseded by build {build_id}",
+                          build_id=old_id, status='cancelled')
+        with self._cond:
+            self._cond.notify_all()
+        return build_id
+
+    def cancel_event(self, build_id):
+        """
+        Returns the event set when a running build is superseded by a newer one.
+
+        Handlers check it between stages and stop, raising BuildCancelled, once it
+        is set. Builds that are not running get an event that is never set.
+        """
+        with self._claim_lock:
+            return self._cancel_events.get(build_id) or threading.Event()
+
+    def get(self, build_id):
+        """
+        Returns the queue entry of a build as a dict, or None if it is unknown.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT build_id, status, enqueued_at, started_at, finished_at, message FROM build_queue WHERE build_id = ?",
+                (build_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["build_id", "status", "enqueued_at", "started_at", "finished_at", "message"], row))
+
+    def wait(self, build_id, timeout=None):
+        """
+        Blocks until a build has finished.
+
+        Args:
+            build_id (int): Id returned by enqueue.
+            timeout (float): Maximum number of seconds to wait, or None to wait forever.
+
+        Returns:
+            dict: The queue entry of the build, which may still be unfinished on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self.get(build_id)
+                if job is None or job['status'] in FINISHED_STATES:
+                    return job
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return job
+                self._cond.wait(0.5 if remaining is None else min(remaining, 0.5))
+
+    def depth(self):
+        """Returns the number of builds waiting for a worker."""
+        with self._connect() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM build_queue WHERE status = 'queued'").fetchone()
+        return count
+
+    def running(self):
+        """Returns the number of builds being run, by the workers of this process or by remote runners."""
+        with self._claim_lock:
+            return len(self._cancel_events)
+
+    def claim(self, runner, lease_seconds):
+        """
+        Hands the oldest queued build to a remote runner.
+
+        Builds whose lease expired are queued again first, so a runner asking for
+        work can pick up the build of a runner that died.
+
+        Args:
+            runner (str): Id of the runner.
+            lease_seconds (float): Time the runner has to send its first heartbeat.
+
+        Returns:
+            tuple: (build_id, payload), or None if no build is waiting.
+        """
+        self.requeue_expired()
+        job = self._claim(runner, time.time() + lease_seconds)
+        if job is not None:
+            set_build_status(job[0], 'running')
+            log.info("Build leased", build_id=job[0], runner=runner)
+        return job
+
+    def heartbeat(self, build_id, runner, lease_seconds):
+        """
+        Extends the lease of a build a remote runner is running.
+
+        Args:
+            build_id (int): Id of the build.
+            runner (str): Id of the runner.
+            lease_seconds (float): Time until the next heartbeat is due.
+
+        Returns:
+            bool: False if the build is not leased to the runner anymore, it should
+                then stop working on it.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE build_queue SET lease_expires = ? WHERE build_id = ? AND runner = ? AND status = 'running'",
+                (time.time() + lease_seconds, build_id, runner)
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, build_id, runner, status, message=None):
+        """
+        Marks a build leased to a remote runner as finished.
+
+        Args:
+            build_id (int): Id of the build.
+            runner (str): Id of the runner.
+            status (str): One of FINISHED_STATES.
+            message (str): Why the build failed or was cancelled.
+
+        Returns:
+            bool: False if the build is not leased to the runner anymore, nothing
+                is changed then.
+        """
+        if status not in FINISHED_STATES:
+            raise ValueError(f"Unknown status '{status}', expected one of {FINISHED_STATES}")
+        with self._claim_lock:
+            with self._connect() as conn:
+                cursor = conn.execute(
+                    "UPDATE build_queue SET status = ?, finished_at = ?, message = ?, lease_expires = NULL "
+                    "WHERE build_id = ? AND runner = ? AND status = 'running'",
+                    (status, _now(), message, build_id, runner)
+                )
+            if cursor.rowcount:
+                self._cancel_events.pop(build_id, None)
+        if cursor.rowcount:
+            with self._cond:
+                self._cond.notify_all()
+        return cursor.rowcount > 0
+
+    def requeue_expired(self):
+        """
+        Queues the builds whose remote runner stopped sending heartbeats again.
+
+        Returns:
+            list: Ids of the builds queued again.
+        """
+        with self._claim_lock:
+            with self._connect() as conn:
+                expired = [row[0] for row in conn.execute(
+                    "SELECT build_id FROM build_queue WHERE status = 'running' AND runner IS NOT NULL AND lease_expires < ?",
+                    (time.time(),)
+                )]
+                if expired:
+                    conn.executemany(
+                        "UPDATE build_queue SET status = 'queued', started_at = NULL, runner = NULL, lease_expires = NULL "
+                        "WHERE build_id = ?",
+                        [(build_id,) for build_id in expired]
+                    )
+            for build_id in expired:
+                self._cancel_events.pop(build_id, None)
+                # Under the lock, so a runner claiming the build right away marks it running after this
+                set_build_status(build_id, 'queued')
+        for build_id in expired:
+            log.warning("Build lease expired, re-queued", build_id=build_id)
+        if expired:
+            with self._cond:
+                self._cond.notify_all()
+        return expired
+
+    def _claim(self, runner=None, lease_expires=None):
+        with self._claim_lock:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT build_id, payload FROM build_queue WHERE status = 'queued' ORDER BY build_id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE build_queue SET status = 'running', started_at = ?, runner = ?, lease_expires = ? "
+                        "WHERE build_id = ?",
+                        (_now(), runner, lease_expires, row[0])
+                    )
+                    self._cancel_events[row[0]] = threading.Event()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _finish(self, build_id, status, message=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE build_queue SET status = ?, finished_at = ?, message = ? WHERE build_id = ?",
+                (status, _now(), message, build_id)
+            )
+        with self._cond:
+            self._cond.notify_all()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+                if job is None:
+                    with self._cond:
+                        self._cond.wait(1.0)
+                    continue
+                self._run(*job)
+            except Exception as e:
+                # E.g. 'database is locked' past the busy timeout: the worker keeps going, and
+                # a job it could not finish is queued again when the queue is next started
+                log.error("Build worker error", error=str(e), exc_info=True)
+                self._stopping.wait(1.0)
+
+    def _run(self, build_id, payload):
+        set_build_status(build_id, 'running')
+        try:
+            with build_context(build_id):
+                self.handler(build_id, payload)
+        except BuildCancelled as e:
+            log.info("Build cancelled", build_id=build_id, reason=str(e))
+            self._finish(build_id, 'cancelled', str(e))
+        except Exception as e:
+            log.warning("Build failed", build_id=build_id, error=str(e))
+            self._finish(build_id, 'failure', str(e))
+        else:
+            self._finish(build_id, 'success')
+        finally:
+            with self._claim_lock:
+                self._cancel_events.pop(build_id, None)
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
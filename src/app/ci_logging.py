@@ -0,0 +1,209 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import config
+
+# Id of the build the current thread works on, added to every record it logs
+current_build = contextvars.ContextVar('build_id', default=None)
+
+# Attributes every LogRecord has, the others were passed as fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    Logger taking the fields of a record as keyword arguments.
+
+        log.info("Build logged", commit_id=commit_id, status=status)
+
+    Nothing is done, not even building the record, when the level is disabled.
+    """
+
+    def process(self, msg, kwargs):
+        extra = dict(kwargs.pop('extra', None) or {})
+        for name in list(kwargs):
+            if name not in ('exc_info', 'stack_info', 'stacklevel'):
+                extra[name] = kwargs.pop(name)
+        kwargs['extra'] = extra
+        return msg, kwargs
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON with its time, level, logger, message, build id and fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'build_id', None) is not None:
+            entry['build_id'] = record.build_id
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and name != 'build_id':
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats a record as readable text, the fields as name=value pairs after the message."""
+
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}"
+        if getattr(record, 'build_id', None) is not None:
+            line += f" [build {record.build_id}]"
+        line += f" {record.getMessage()}"
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and name != 'build_id':
+                line += f" {name}={value!r}"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class BuildIdFilter(logging.Filter):
+    """Adds the id of the current build to records that do not set one."""
+
+    def filter(self, record):
+        if getattr(record, 'build_id', None) is None:
+            record.build_id = current_build.get()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a bounded queue drained by a QueueListener thread.
+
+    Logging never waits for the output: when the queue is full the record is
+    dropped and counted. Fields are truncated before they are queued, so a record
+    holding a whole build log or result set stays small.
+    """
+
+    def __init__(self, log_queue, max_chars=2000, max_items=20):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.max_items = max_items
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        for name, value in list(vars(record).items()):
+            if name not in _RECORD_ATTRIBUTES:
+                setattr(record, name, truncate(value, self.max_chars, self.max_items))
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+def truncate(value, max_chars, max_items):
+    """
+    Shortens a field value for logging.
+
+    Args:
+        value: The value.
+        max_chars (int): Longest string kept, longer ones are cut with a note of
+            how much was left out.
+        max_items (int): Most items of a list, tuple, set or dict kept.
+
+    Returns:
+        The value, or a shortened copy of it.
+    """
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return f"{value[:max_chars]}...[{len(value) - max_chars} chars truncated]"
+        return value
+    if isinstance(value, dict):
+        items = list(value.items())
+        shortened = {str(k): truncate(v, max_chars, max_items) for k, v in items[:max_items]}
+        if len(items) > max_items:
+            shortened['...'] = f"{len(items) - max_items} more items"
+        return shortened
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = list(value)
+        shortened = [truncate(v, max_chars, max_items) for v in items[:max_items]]
+        if len(items) > max_items:
+            shortened.append(f"... {len(items) - max_items} more items")
+        return shortened
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return truncate(str(value), max_chars, max_items)
+
+
+def get_logger(name):
+    """Returns the StructuredLogger of a module, e.g. get_logger('build_history')."""
+    return StructuredLogger(logging.getLogger(f"ci.{name}"), {})
+
+
+@contextmanager
+def build_context(build_id):
+    """Tags the records logged in the block by this thread with a build id."""
+    token = current_build.set(build_id)
+    try:
+        yield
+    finally:
+        current_build.reset(token)
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(level=None, fmt=None, stream=None):
+    """
+    Sends the records of the 'ci' loggers through a queue to a background thread
+    writing them to stream.
+
+    Calling it again replaces the previous setup.
+
+    Args:
+        level (str): Lowest level logged, defaults to config.LOG_LEVEL.
+        fmt (str): 'json' or 'text', defaults to config.LOG_FORMAT.
+        stream: File the records are written to, defaults to stdout.
+
+    Returns:
+        DroppingQueueHandler: The handler, whose 'dropped' counts the records lost
+            to a full queue.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(TextFormatter() if (fmt or config.LOG_FORMAT) == 'text' else JsonFormatter())
+        handler = DroppingQueueHandler(
+            queue.Queue(config.LOG_QUEUE_SIZE), config.LOG_FIELD_MAX_CHARS, config.LOG_FIELD_MAX_ITEMS
+        )
+        handler.addFilter(BuildIdFilter())
+        logger = logging.getLogger('ci')
+        logger.handlers = [handler]
+        logger.setLevel((level or config.LOG_LEVEL).upper())
+        logger.propagate = False
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+        return handler
+
+
+@atexit.register
+def flush_logging():
+    """Writes out the queued records and stops the background thread."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
@@ -1,12 +1,23 @@
 import tempfile
-import shutil
 from git import Repo
 import os
 from syntax_check import syntax_check
-import uuid
+import time
+import config
+from mirror_cache import MirrorCache
+from workspace_pool import WorkspacePool
+from build_history import log_clone_timing, get_clone_timings
+from ci_logging import get_logger
 
-PROJ_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-TMP_PATH = os.path.abspath(os.path.join(PROJ_ROOT, "tmp/"))
+TMP_PATH = os.path.abspath(config.TMP_PATH)
+
+log = get_logger('clone')
+
+mirror_cache = MirrorCache(config.MIRROR_CACHE_PATH, config.MIRROR_CACHE_MAX_BYTES)
+# Checkouts of finished builds, reset for the next build of the same repository.
+# Idle workspaces keep borrowing objects from their mirror until they are retired.
+workspace_pool = WorkspacePool(TMP_PATH, config.WORKSPACE_POOL_SIZE, config.WORKSPACE_POOL_MAX_BYTES,
+                               config.WORKSPACE_LEAK_SECONDS, on_retire=mirror_cache.release)
 
 def ensure_tmp_directory():
     """
@@ -21,20 +32,142 @@ def ensure_tmp_directory():
     try:
         if not os.path.exists(TMP_PATH):
             os.makedirs(TMP_PATH, mode=0o755)
-            print(f"Created tmp directory at {TMP_PATH}")
+            log.info("Created tmp directory", path=TMP_PATH)
     except Exception as e:
-        print(f"Error creating tmp directory: {str(e)}")
+        log.error("Error creating tmp directory", path=TMP_PATH, error=str(e))
         raise
 
 
 
-def clone_check(repo_url, branch):
+# Paths syntax_check and run_tests read, used by the 'sparse' strategy
+SPARSE_PATTERNS = [
+    '*.py',
+    '/src/test/',
+    '/conftest.py',
+    '/pytest.ini',
+    '/pyproject.toml',
+    '/setup.cfg',
+    '/tox.ini',
+    '/requirements*.txt',
+]
+
+CLONE_STRATEGIES = ('mirror', 'full', 'shallow', 'blobless', 'sparse')
+
+
+def choose_strategy(repo_url):
+    """
+    Picks the clone strategy for a repository when CLONE_STRATEGY is 'auto'.
+
+    Strategies that have been timed fewer than CLONE_TIMING_SAMPLES times for the
+    repository are tried first; after that the one with the lowest recent average wins.
+
+    Args:
+        repo_url (str): URL of the Git repository.
+
+    Returns:
+        str: One of CLONE_STRATEGIES.
+    """
+    timings = get_clone_timings(repo_url)
+    for strategy in CLONE_STRATEGIES:
+        count, _ = timings.get(strategy, (0, None))
+        if count < config.CLONE_TIMING_SAMPLES:
+            return strategy
+    return min(CLONE_STRATEGIES, key=lambda strategy: timings[strategy][1])
+
+
+def clone_repo(repo_url, branch, dest, sha=None, strategy='full'):
+    """
+    Clones a Git repository into dest using the given strategy.
+
+    Args:
+        repo_url (str): URL of the Git repository to clone.
+        branch (str): The branch to clone.
+        dest (str): Empty directory to clone into.
+        sha (str): Commit to check out, defaults to the tip of the branch.
+        strategy (str): 'mirror' checks out from the mirror cache, 'full' clones the
+            whole branch history, 'shallow' only the tip commit, 'blobless' the
+            history without file contents, and 'sparse' only the tip commit's
+            files matched by SPARSE_PATTERNS.
+
+    Returns:
+        Repo: The cloned repository.
+
+    Raises:
+        ValueError: If the strategy is unknown.
+    """
+    if strategy == 'mirror':
+        return mirror_cache.checkout(repo_url, branch, dest, sha)
+    if strategy == 'full':
+        repo = Repo.clone_from(repo_url, dest, branch=branch)
+    elif strategy == 'shallow':
+        repo = Repo.clone_from(repo_url, dest, branch=branch, depth=1, single_branch=True)
+    elif strategy == 'blobless':
+        repo = Repo.clone_from(repo_url, dest, branch=branch, filter='blob:none', single_branch=True)
+    elif strategy == 'sparse':
+        repo = Repo.clone_from(repo_url, dest, branch=branch, filter='blob:none', depth=1,
+                               single_branch=True, no_checkout=True)
+        repo.git.sparse_checkout('set', '--no-cone', *SPARSE_PATTERNS)
+        repo.git.checkout(branch)
+    else:
+        raise ValueError(f"Unknown clone strategy '{strategy}', expected one of {CLONE_STRATEGIES}")
+
+    if sha and repo.head.commit.hexsha != sha:
+        if strategy in ('shallow', 'sparse'):
+            # The branch moved on since the push, fetch the pushed commit on its own
+            repo.git.fetch('origin', sha, depth=1)
+        repo.git.checkout(sha)
+    return repo
+
+
+def reset_workspace(path, repo_url, branch, sha=None):
+    """
+    Brings the checkout of an earlier build up to date with a pushed commit.
+
+    Fetches the branch, or for shallow checkouts only the commit, from the remote
+    the checkout was cloned from, refreshing the mirror first if that is its
+    origin. Then checks the commit out over any local changes and removes every
+    untracked and ignored file, leaving the tree as a fresh clone would.
+
+    Args:
+        path (str): Directory of the checkout.
+        repo_url (str): URL of the Git repository.
+        branch (str): The branch that was pushed.
+        sha (str): Commit to check out, defaults to the tip of the branch.
+
+    Returns:
+        Repo: The checked out repository.
+    """
+    repo = Repo(path)
+    if os.path.abspath(repo.remotes.origin.url) == mirror_cache.mirror_path(repo_url):
+        mirror_cache.refresh(repo_url, branch, sha)
+    depth = {'depth': 1} if os.path.exists(os.path.join(repo.git_dir, 'shallow')) else {}
+    repo.git.fetch('origin', f"+refs/heads/{branch}:refs/remotes/origin/{branch}", '--no-tags', **depth)
+    if sha:
+        try:
+            repo.git.cat_file('-e', f"{sha}^{{commit}}")
+        except Exception:
+            # The branch moved on or was force-pushed since the webhook was sent
+            repo.git.fetch('origin', sha, **depth)
+    repo.git.checkout('--force', '--detach', sha or f"origin/{branch}")
+    repo.git.clean('-ffdx')
+    return repo
+
+
+def clone_check(repo_url, branch, sha=None, strategy=None):
     """
-    Clones a Git repository to a temporary directory and returns the directory path.
+    Checks a Git repository out into a workspace and returns the directory path.
+
+    An idle workspace of the repository is reset with reset_workspace when the
+    pool has one, otherwise the repository is cloned into a new workspace. The
+    time taken is recorded per strategy, resets as 'reset', so 'auto' can pick
+    the fastest one for the repository. Hand the workspace back with
+    workspace_pool.release.
 
     Args:
         repo_url (str): URL of the Git repository to clone.
         branch (str): The branch to clone.
+        sha (str): Commit to check out, defaults to the tip of the branch.
+        strategy (str): One of CLONE_STRATEGIES or 'auto', defaults to config.CLONE_STRATEGY.
 
     Returns:
         str: Path to the cloned repository if successful.
@@ -45,18 +178,34 @@ def clone_check(repo_url, branch):
     """
     try:
         ensure_tmp_directory()
-        temp_dir = os.path.join(TMP_PATH, str(uuid.uuid4()))
-        os.makedirs(temp_dir, mode=0o755)
-        
-        print(f"Cloning {repo_url} branch {branch} to {temp_dir}")
-        repo = Repo.clone_from(repo_url, temp_dir, branch=branch)
+        temp_dir = workspace_pool.acquire(repo_url)
+        if temp_dir is not None:
+            try:
+                log.info("Resetting workspace", repo_url=repo_url, branch=branch, dest=temp_dir)
+                started = time.monotonic()
+                repo = reset_workspace(temp_dir, repo_url, branch, sha)
+                log_clone_timing(repo_url, 'reset', time.monotonic() - started)
+                return repo.head.commit.hexsha, temp_dir
+            except Exception as e:
+                log.warning("Could not reset workspace, cloning instead", path=temp_dir, error=str(e))
+                workspace_pool.release(temp_dir, reusable=False)
+        temp_dir = workspace_pool.create(repo_url)
+
+        strategy = strategy or config.CLONE_STRATEGY
+        if strategy == 'auto':
+            strategy = choose_strategy(repo_url)
+
+        log.info("Cloning", repo_url=repo_url, branch=branch, dest=temp_dir, strategy=strategy)
+        started = time.monotonic()
+        repo = clone_repo(repo_url, branch, temp_dir, sha, strategy)
+        log_clone_timing(repo_url, strategy, time.monotonic() - started)
         commit_id = repo.head.commit.hexsha      
         return commit_id, temp_dir
         
     except Exception as e:
-        if 'temp_dir' in locals() and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            
+        if 'temp_dir' in locals() and temp_dir is not None:
+            workspace_pool.release(temp_dir, reusable=False)
+
         return {
             "status": "error",
             "message": f"Error during cloning: {str(e)}",
@@ -66,4 +215,49 @@ def clone_check(repo_url, branch):
             },
             "error_count": -1,
             "details": {"error": str(e)}
-        }
\ No newline at end of file
+        }
+
+
+NULL_SHA = '0' * 40
+
+# GitHub lists at most this many commits in a push payload
+MAX_PAYLOAD_COMMITS = 20
+
+
+def get_changed_files(repo_dir, before, after, commits=None):
+    """
+    Lists the files changed by a push.
+
+    Diffs the 'before' and 'after' commits in the checkout, fetching 'before' on
+    its own if the clone does not have it. Falls back to the file lists of the
+    webhook's commits when that fails.
+
+    Args:
+        repo_dir (str): Path to the cloned repository.
+        before (str): Commit the branch pointed to before the push.
+        after (str): Commit the branch points to after the push.
+        commits (list): The 'commits' of the push payload.
+
+    Returns:
+        list: Paths relative to the repository root that were added, modified or
+            removed, or None if they cannot be determined (e.g. a new branch).
+    """
+    if not before or before == NULL_SHA:
+        return None
+    try:
+        repo = Repo(repo_dir)
+        try:
+            repo.git.cat_file('-e', f"{before}^{{commit}}")
+        except Exception:
+            repo.git.fetch('origin', before, depth=1)
+        return repo.git.diff('--name-only', '--no-renames', before, after).splitlines()
+    except Exception as e:
+        log.warning("Could not diff", before=before, after=after, error=str(e))
+
+    if commits and len(commits) < MAX_PAYLOAD_COMMITS:
+        files = set()
+        for commit in commits:
+            for key in ('added', 'removed', 'modified'):
+                files.update(commit.get(key, []))
+        return sorted(files)
+    return None
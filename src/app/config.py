@@ -0,0 +1,144 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file before any setting is read
+load_dotenv()
+
+# Public URL of this server, used as the target of GitHub commit statuses
+SERVER_URL = os.getenv('CI_SERVER_URL', 'http://localhost:8008')
+
+# SQLite database of the build history, queue and caches, see build_history.BuildHistoryStore.
+# Resolved once, since GitPython changes the working directory while it runs
+DB_PATH = os.path.abspath(os.getenv('CI_DB_PATH', 'build_history.db'))
+DB_POOL_SIZE = int(os.getenv('CI_DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('CI_DB_BUSY_TIMEOUT_MS', '5000'))
+DB_SYNCHRONOUS = os.getenv('CI_DB_SYNCHRONOUS', 'NORMAL')
+
+# Number of worker threads draining the build queue
+BUILD_WORKERS = int(os.getenv('CI_BUILD_WORKERS', '2'))
+# A new push to a branch cancels the builds of that branch queued or running before it
+BUILD_SUPERSEDE = os.getenv('CI_BUILD_SUPERSEDE', '1') == '1'
+
+# HTTP front end: 'single' or 'threaded', see CIServer.run_server
+SERVER_MODE = os.getenv('CI_SERVER_MODE', 'threaded')
+HTTP_WORKERS = int(os.getenv('CI_HTTP_WORKERS', '32'))
+HTTP_MAX_IN_FLIGHT = int(os.getenv('CI_HTTP_MAX_IN_FLIGHT', '256'))
+KEEPALIVE_TIMEOUT = float(os.getenv('CI_KEEPALIVE_TIMEOUT', '5'))
+
+# How clone_check gets the code: 'mirror', 'full', 'shallow', 'blobless', 'sparse'
+# or 'auto' to use the fastest one measured for the repository
+CLONE_STRATEGY = os.getenv('CI_CLONE_STRATEGY', 'mirror')
+# Clones timed per strategy before 'auto' starts picking the fastest one
+CLONE_TIMING_SAMPLES = int(os.getenv('CI_CLONE_TIMING_SAMPLES', '3'))
+
+# Checkouts of the builds, see workspace_pool.WorkspacePool
+TMP_PATH = os.getenv('CI_TMP_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tmp'))
+
+# Bare mirrors reused across builds, see mirror_cache.MirrorCache
+MIRROR_CACHE_PATH = os.getenv('CI_MIRROR_CACHE_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'mirrors'))
+MIRROR_CACHE_MAX_BYTES = int(os.getenv('CI_MIRROR_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))
+
+# Only lint the files changed by a push and the files importing them
+SYNTAX_CHECK_INCREMENTAL = os.getenv('CI_SYNTAX_CHECK_INCREMENTAL', '1') == '1'
+# Maximum number of pylint processes, 0 uses one per CPU
+SYNTAX_CHECK_JOBS = int(os.getenv('CI_SYNTAX_CHECK_JOBS', '0'))
+
+# Pylint messages cached per file content, see lint_cache.LintCache
+LINT_CACHE_ENABLED = os.getenv('CI_LINT_CACHE', '1') == '1'
+LINT_CACHE_MAX_ENTRIES = int(os.getenv('CI_LINT_CACHE_MAX_ENTRIES', '200000'))
+
+# Long-lived pylint workers kept warm across builds, see lint_worker.LintService. Each one
+# keeps pylint and the parsed modules in memory, so there are a few of them whatever the
+# number of CPUs, and each worker is replaced after that many batches
+LINT_SERVICE_ENABLED = os.getenv('CI_LINT_SERVICE', '1') == '1'
+LINT_SERVICE_WORKERS = int(os.getenv('CI_LINT_SERVICE_WORKERS', '2'))
+LINT_WORKER_MAX_BATCHES = int(os.getenv('CI_LINT_WORKER_MAX_BATCHES', '200'))
+
+# Number of pytest processes a build's test files are spread over
+TEST_SHARDS = int(os.getenv('CI_TEST_SHARDS', '1'))
+
+# Test impact analysis: only run the tests covering the changed files, with a
+# full run recording a new coverage map every N builds or when it gets too old
+TEST_IMPACT_ANALYSIS = os.getenv('CI_TEST_IMPACT_ANALYSIS', '1') == '1'
+TEST_FULL_RUN_EVERY = int(os.getenv('CI_TEST_FULL_RUN_EVERY', '20'))
+TEST_MAP_MAX_AGE_HOURS = float(os.getenv('CI_TEST_MAP_MAX_AGE_HOURS', '24'))
+
+# Build logs streamed to disk, see build_log.BuildLog
+BUILD_LOG_PATH = os.getenv('CI_BUILD_LOG_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs'))
+BUILD_LOG_MAX_BYTES = int(os.getenv('CI_BUILD_LOG_MAX_BYTES', str(50 * 1024 ** 2)))
+BUILD_LOG_CHUNK_BYTES = int(os.getenv('CI_BUILD_LOG_CHUNK_BYTES', str(1024 ** 2)))
+# Last lines of the test output kept in the build history, the full log stays on disk
+TEST_LOG_TAIL_LINES = int(os.getenv('CI_TEST_LOG_TAIL_LINES', '200'))
+# How often GET /<id>/log?follow=1 checks for new output, in seconds
+LOG_FOLLOW_POLL_SECONDS = float(os.getenv('CI_LOG_FOLLOW_POLL_SECONDS', '0.5'))
+
+# GitHub commit status API, see notify.GithubClient
+GITHUB_API_URL = os.getenv('CI_GITHUB_API_URL', 'https://api.github.com')
+GITHUB_POOL_SIZE = int(os.getenv('CI_GITHUB_POOL_SIZE', '10'))
+GITHUB_MAX_RETRIES = int(os.getenv('CI_GITHUB_MAX_RETRIES', '5'))
+GITHUB_BACKOFF_BASE = float(os.getenv('CI_GITHUB_BACKOFF_BASE', '0.5'))
+GITHUB_BACKOFF_MAX = float(os.getenv('CI_GITHUB_BACKOFF_MAX', '30'))
+GITHUB_TIMEOUT = float(os.getenv('CI_GITHUB_TIMEOUT', '10'))
+# Deliveries of a commit status tried before it is dropped from the outbox
+GITHUB_OUTBOX_MAX_ATTEMPTS = int(os.getenv('CI_GITHUB_OUTBOX_MAX_ATTEMPTS', '50'))
+
+# Builds per page of GET /, and the largest page a client may ask for
+HISTORY_PAGE_SIZE = int(os.getenv('CI_HISTORY_PAGE_SIZE', '100'))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('CI_HISTORY_MAX_PAGE_SIZE', '1000'))
+
+# Build logs are stored compressed in the build history: 'auto' uses zstd when the
+# optional zstandard package is installed and zlib otherwise, 'zlib' always uses zlib
+LOG_CODEC = os.getenv('CI_LOG_CODEC', 'auto')
+LOG_COMPRESSION_LEVEL = int(os.getenv('CI_LOG_COMPRESSION_LEVEL', '6'))
+
+# JSON responses of GET / and GET /<id> cached until the next build is written,
+# see response_cache.ResponseCache, and gzip-compressed from this size on
+RESPONSE_CACHE_ENTRIES = int(os.getenv('CI_RESPONSE_CACHE_ENTRIES', '256'))
+GZIP_MIN_BYTES = int(os.getenv('CI_GZIP_MIN_BYTES', '1024'))
+
+# Disk usage gauges of GET /metrics are measured in the background at most this often,
+# see metrics.Sampled
+METRICS_DISK_SAMPLE_SECONDS = float(os.getenv('CI_METRICS_DISK_SAMPLE_SECONDS', '60'))
+
+# Logging, see ci_logging.setup_logging: records are written as JSON lines ('json')
+# or readable text ('text') by a background thread fed through a bounded queue
+LOG_LEVEL = os.getenv('CI_LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('CI_LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('CI_LOG_QUEUE_SIZE', '10000'))
+# Longest string and most items of a list or dict kept in a logged field
+LOG_FIELD_MAX_CHARS = int(os.getenv('CI_LOG_FIELD_MAX_CHARS', '2000'))
+LOG_FIELD_MAX_ITEMS = int(os.getenv('CI_LOG_FIELD_MAX_ITEMS', '20'))
+
+# Remote runners, see coordinator.Coordinator and runner.Runner. With CI_BUILD_WORKERS=0
+# the server only coordinates and every build runs on a runner. The /runners/ endpoints
+# only exist while a token is set, and runners must send it as 'Authorization: Bearer <token>'
+RUNNER_TOKEN = os.getenv('CI_RUNNER_TOKEN', '')
+# A build is queued again when its runner sent no heartbeat for this many seconds
+RUNNER_LEASE_SECONDS = float(os.getenv('CI_RUNNER_LEASE_SECONDS', '60'))
+RUNNER_HEARTBEAT_SECONDS = float(os.getenv('CI_RUNNER_HEARTBEAT_SECONDS', '10'))
+# How long an idle runner waits before asking for work again
+RUNNER_POLL_SECONDS = float(os.getenv('CI_RUNNER_POLL_SECONDS', '2'))
+COORDINATOR_URL = os.getenv('CI_COORDINATOR_URL', 'http://localhost:8008')
+# Retries of a runner's request the coordinator did not answer, or answered with a
+# server error, see runner.CoordinatorClient. Test durations, coverage maps and the lint
+# cache of the builds a runner ran stay in the database of the runner, see runner.Runner
+RUNNER_MAX_RETRIES = int(os.getenv('CI_RUNNER_MAX_RETRIES', '5'))
+RUNNER_BACKOFF_BASE = float(os.getenv('CI_RUNNER_BACKOFF_BASE', '0.5'))
+RUNNER_BACKOFF_MAX = float(os.getenv('CI_RUNNER_BACKOFF_MAX', '30'))
+
+# Checkouts kept between builds and reset with git for the next build of the same
+# repository, see workspace_pool.WorkspacePool; 0 deletes every checkout after its build
+WORKSPACE_POOL_SIZE = int(os.getenv('CI_WORKSPACE_POOL_SIZE', '4'))
+WORKSPACE_POOL_MAX_BYTES = int(os.getenv('CI_WORKSPACE_POOL_MAX_BYTES', str(5 * 1024 ** 3)))
+# Checkouts of crashed processes are looked for this often, and ones without an owner
+# file are deleted once they are this old
+WORKSPACE_LEAK_SECONDS = float(os.getenv('CI_WORKSPACE_LEAK_SECONDS', '3600'))
+
+# Checkouts with requirements*.txt or pyproject.toml run their tests in a virtualenv of
+# their own, built once per hash of those files and copied as hard links, see
+# venv_cache.EnvCache; without them, or with CI_VENV_CACHE=0, tests run in the server's environment
+VENV_CACHE_ENABLED = os.getenv('CI_VENV_CACHE', '1') == '1'
+VENV_CACHE_PATH = os.getenv('CI_VENV_CACHE_PATH', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'envs'))
+VENV_CACHE_MAX_BYTES = int(os.getenv('CI_VENV_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+# Comma-separated packages installed in every environment besides the checkout's dependencies
+VENV_EXTRA_PACKAGES = tuple(filter(None, os.getenv('CI_VENV_EXTRA_PACKAGES', 'pytest').split(',')))
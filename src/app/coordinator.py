@@ -0,0 +1,181 @@
+import threading
+import time
+from build_history import record_stage, log_lint_messages, log_test_outcomes, log_build
+from build_log import BuildLog
+from build_queue import FINISHED_STATES
+from ci_logging import get_logger
+import config
+
+log = get_logger('coordinator')
+
+# Results a runner may send with POST /runners/<id>/record, see runner.RemoteRecorder
+RECORD_KINDS = ('stage', 'lint_messages', 'test_outcomes', 'finish')
+
+
+class LeaseLost(Exception):
+    """Raised when a runner reports on a build that is not leased to it anymore."""
+
+
+class Coordinator:
+    """
+    Hands the builds of a BuildQueue to remote runner processes and stores what
+    they send back, behind the /runners/ endpoints of the server.
+
+    A runner claims a build, sends a heartbeat every few seconds while it runs it,
+    streams its log and records its results, and completes it. The build history
+    and the logs stay with the coordinator, runners only need the payload. A build
+    whose runner stops sending heartbeats is queued again once its lease expires,
+    and whatever that runner sends afterwards is refused with LeaseLost.
+    """
+
+    def __init__(self, queue, log_root, lease_seconds=60, heartbeat_seconds=10):
+        """
+        Args:
+            queue (BuildQueue): Queue the builds are taken from.
+            log_root (str): Directory the build logs are written to.
+            lease_seconds (float): Time a runner has between heartbeats before its
+                build is queued again.
+            heartbeat_seconds (float): Interval between heartbeats told to runners.
+        """
+        self.queue = queue
+        self.log_root = log_root
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self._leases = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def claim(self, runner):
+        """
+        Leases the oldest queued build to a runner.
+
+        Args:
+            runner (str): Id of the runner.
+
+        Returns:
+            dict: The build_id and payload of the build, and the heartbeat interval
+                the runner should keep, or None if no build is waiting.
+        """
+        self._saw(runner)
+        self._release(self.queue.requeue_expired())
+        job = self.queue.claim(runner, self.lease_seconds)
+        if job is None:
+            return None
+        build_id, payload = job
+        with self._lock:
+            # Starts over the output of an earlier attempt whose runner went away
+            self._leases[build_id] = (runner, self._open_log(build_id))
+        return {'build_id': build_id, 'payload': payload, 'heartbeat_seconds': self.heartbeat_seconds}
+
+    def heartbeat(self, build_id, runner):
+        """
+        Extends the lease of a build.
+
+        Args:
+            build_id (int): Id of the build.
+            runner (str): Id of the runner.
+
+        Returns:
+            dict: 'cancel' is True once a newer build of the branch superseded it.
+
+        Raises:
+            LeaseLost: If the build is not leased to the runner anymore.
+        """
+        self._saw(runner)
+        self._release(self.queue.requeue_expired())
+        if not self.queue.heartbeat(build_id, runner, self.lease_seconds):
+            self._release([build_id], runner)
+            raise LeaseLost(f"Build {build_id} is not leased to {runner}")
+        return {'cancel': self.queue.cancel_event(build_id).is_set()}
+
+    def append_log(self, build_id, runner, text):
+        """Appends output streamed by a runner to the log of its build."""
+        self._lease(build_id, runner).write(text)
+
+    def record(self, build_id, runner, kind, data):
+        """
+        Records a result a runner sent in the build history.
+
+        Recording the same result again replaces it, so a runner may send it again
+        when it did not get the answer, or when the build is run a second time.
+
+        Args:
+            build_id (int): Id of the build.
+            runner (str): Id of the runner.
+            kind (str): One of RECORD_KINDS, named after the LocalRecorder method
+                the runner would have called.
+            data (dict): Arguments of that method.
+
+        Raises:
+            LeaseLost: If the build is not leased to the runner anymore.
+            ValueError: If the kind, or the status of a finished build, is unknown.
+        """
+        if kind not in RECORD_KINDS:
+            raise ValueError(f"Unknown record '{kind}', expected one of {RECORD_KINDS}")
+        if kind == 'finish' and data['status'] not in FINISHED_STATES:
+            raise ValueError(f"Unknown status '{data['status']}', expected one of {FINISHED_STATES}")
+        self._lease(build_id, runner)
+        if kind == 'stage':
+            record_stage(build_id, data['stage'], float(data['seconds']))
+        elif kind == 'lint_messages':
+            log_lint_messages(build_id, data['messages'], replace=True)
+        elif kind == 'test_outcomes':
+            log_test_outcomes(build_id, data['outcomes'], replace=True)
+        else:
+            log_build(data['commit_id'], data['logs'], build_id=build_id, status=data['status'])
+
+    def complete(self, build_id, runner, status, message=None):
+        """
+        Marks a build as finished and closes its log.
+
+        Args:
+            build_id (int): Id of the build.
+            runner (str): Id of the runner.
+            status (str): 'success', 'failure' or 'cancelled'.
+            message (str): Why the build failed or was cancelled.
+
+        Raises:
+            LeaseLost: If the build is not leased to the runner anymore.
+        """
+        self._saw(runner)
+        if not self.queue.complete(build_id, runner, status, message):
+            self._release([build_id], runner)
+            raise LeaseLost(f"Build {build_id} is not leased to {runner}")
+        self._release([build_id], runner)
+        log.info("Remote build finished", build_id=build_id, runner=runner, status=status)
+
+    def active_runners(self):
+        """Returns the number of runners heard from within the lease time."""
+        horizon = time.monotonic() - self.lease_seconds
+        with self._lock:
+            self._seen = {runner: seen for runner, seen in self._seen.items() if seen >= horizon}
+            return len(self._seen)
+
+    def _lease(self, build_id, runner):
+        with self._lock:
+            lease = self._leases.get(build_id)
+        if lease is not None and lease[0] == runner:
+            return lease[1]
+        # Leases taken before the coordinator restarted are still valid in the queue
+        if lease is None and self.queue.heartbeat(build_id, runner, self.lease_seconds):
+            with self._lock:
+                lease = self._leases.setdefault(build_id, (runner, self._open_log(build_id, resume=True)))
+            return lease[1]
+        raise LeaseLost(f"Build {build_id} is not leased to {runner}")
+
+    def _open_log(self, build_id, resume=False):
+        return BuildLog(self.log_root, build_id, config.BUILD_LOG_MAX_BYTES, config.BUILD_LOG_CHUNK_BYTES,
+                        resume=resume)
+
+    def _release(self, build_ids, runner=None):
+        for build_id in build_ids:
+            with self._lock:
+                lease = self._leases.get(build_id)
+                if lease is None or (runner is not None and lease[0] != runner):
+                    continue
+                del self._leases[build_id]
+            lease[1].close()
+
+    def _saw(self, runner):
+        with self._lock:
+            self._seen[runner] = time.monotonic()
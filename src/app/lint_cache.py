@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from build_history import store_for
+
+# SQLite limits the number of bound parameters per statement
+BATCH_SIZE = 500
+
+
+def blob_sha(data):
+    """
+    Computes the Git blob SHA of file contents, the same id 'git hash-object' gives it.
+
+    Args:
+        data (bytes): Contents of the file.
+
+    Returns:
+        str: The hex SHA-1.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class LintCache:
+    """
+    Persistent cache of pylint messages per file content.
+
+    Entries are keyed by (blob SHA, pylint version, enabled checks), so a file that
+    did not change between builds is never linted twice. The cache lives in the
+    'lint_cache' table of the build history database and keeps at most max_entries
+    rows, dropping the least recently used ones first.
+    """
+
+    def __init__(self, db_path='build_history.db', max_entries=200000):
+        """
+        Args:
+            db_path (str): Path of the SQLite database holding the cache, see build_history.store_for.
+            max_entries (int): Maximum number of cached files.
+        """
+        self.db_path = os.path.abspath(db_path)
+        self.store = store_for(db_path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        self._table_ready = False
+
+    @contextmanager
+    def _connect(self):
+        with self.store.connection() as conn:
+            if not self._table_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS lint_cache (
+                        blob_sha TEXT,
+                        pylint_version TEXT,
+                        checks TEXT,
+                        messages TEXT,
+                        last_used REAL,
+                        PRIMARY KEY (blob_sha, pylint_version, checks)
+                    )
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_lint_cache_last_used ON lint_cache (last_used)")
+                self._table_ready = True
+            yield conn
+
+    def get_many(self, shas, pylint_version, checks):
+        """
+        Looks up the cached messages of several files.
+
+        Args:
+            shas (list): Blob SHAs of the files.
+            pylint_version (str): Version of pylint the messages must come from.
+            checks (str): Enabled checks the messages must come from.
+
+        Returns:
+            dict: Maps each cached blob SHA to its list of messages, without 'path'.
+        """
+        shas = list(set(shas))
+        found = {}
+        with self._connect() as conn:
+            for i in range(0, len(shas), BATCH_SIZE):
+                batch = shas[i:i + BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = conn.execute(
+                    f"SELECT blob_sha, messages FROM lint_cache "
+                    f"WHERE pylint_version = ? AND checks = ? AND blob_sha IN ({placeholders})",
+                    (pylint_version, checks, *batch)
+                ).fetchall()
+                found.update((sha, json.loads(messages)) for sha, messages in rows)
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE lint_cache SET last_used = ? WHERE blob_sha = ? AND pylint_version = ? AND checks = ?",
+                    [(now, sha, pylint_version, checks) for sha in found]
+                )
+        with self._counter_lock:
+            self.hits += len(found)
+            self.misses += len(shas) - len(found)
+        return found
+
+    def put_many(self, entries, pylint_version, checks):
+        """
+        Stores the messages of freshly linted files and evicts old entries.
+
+        Args:
+            entries (dict): Maps blob SHAs to their list of messages, without 'path'.
+            pylint_version (str): Version of pylint that produced the messages.
+            checks (str): Checks that were enabled.
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO lint_cache (blob_sha, pylint_version, checks, messages, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(sha, pylint_version, checks, json.dumps(messages), now) for sha, messages in entries.items()]
+            )
+            (count,) = conn.execute("SELECT COUNT(*) FROM lint_cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM lint_cache WHERE rowid IN (SELECT rowid FROM lint_cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def stats(self):
+        """Returns the hit and miss counters and the number of cached files."""
+        with self._connect() as conn:
+            (entries,) = conn.execute("SELECT COUNT(*) FROM lint_cache").fetchone()
+        with self._counter_lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
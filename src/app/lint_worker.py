@@ -0,0 +1,250 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import sysconfig
+import tempfile
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+import pylint.lint
+from pylint.reporters import JSONReporter
+from ci_logging import get_logger
+
+log = get_logger('lint_worker')
+
+# Where the modules astroid may keep between builds come from
+LIBRARY_PATHS = tuple(sorted({
+    os.path.realpath(sysconfig.get_paths()[name]) + os.sep for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+}))
+
+# astroid caches keyed by paths or by nodes of dropped modules, see astroid.manager.AstroidManager.clear_cache
+_PATH_CACHES = (
+    ('astroid.modutils', '_cache_normalize_path_'),
+    ('astroid.modutils', '_has_init'),
+    ('astroid.modutils', 'cached_os_path_isfile'),
+    ('astroid.interpreter._import.spec', '_find_spec'),
+    ('astroid.interpreter._import.spec', '_is_setuptools_namespace'),
+    ('astroid.interpreter._import.util', 'is_namespace'),
+    ('astroid.nodes._base_nodes', 'LookupMixIn.lookup'),
+    ('astroid.interpreter.objectmodel', 'ObjectModel.attributes'),
+    ('astroid.nodes.scoped_nodes', 'ClassDef._metaclass_lookup_attribute'),
+)
+
+
+def is_library(path):
+    """Returns whether a module file belongs to the Python installation, builtins included."""
+    return path is None or os.path.realpath(path).startswith(LIBRARY_PATHS)
+
+
+def invalidate_project_modules():
+    """
+    Drops the modules of checkouts from astroid's caches, keeping the standard
+    library and installed packages.
+
+    astroid reuses a cached module when one of the same name was read from the same
+    path, so without this a workspace reset for a new build would be linted as it
+    was in the previous one. The caches of module lookups and inference results,
+    which may point into the dropped modules, are cleared too. Falls back to
+    clearing everything if astroid's internals are not as expected.
+    """
+    from astroid import MANAGER
+    try:
+        from importlib import import_module
+        from astroid.context import _invalidate_cache
+        from astroid.inference_tip import clear_inference_tip_cache
+        from astroid.interpreter._import import spec
+
+        for name, module in list(MANAGER.astroid_cache.items()):
+            if not is_library(getattr(module, 'file', None)):
+                del MANAGER.astroid_cache[name]
+        MANAGER._mod_file_cache.clear()
+        clear_inference_tip_cache()
+        _invalidate_cache()
+        for module_name, attribute in _PATH_CACHES:
+            target = import_module(module_name)
+            for part in attribute.split('.'):
+                target = getattr(target, part, None)
+            if target is not None:
+                target.cache_clear()
+        for finder in spec._SPEC_FINDERS:
+            finder.find_module.cache_clear()
+    except Exception as e:
+        log.warning("Clearing all of astroid's caches", error=str(e))
+        MANAGER.clear_cache()
+
+
+class ResidentLinter:
+    """
+    A pylint linter kept across batches of files.
+
+    The first batch pays for building the linter, loading its plugins and parsing
+    the standard library modules the files import; later batches reuse all of it
+    and only parse the files themselves. The modules of checkouts are invalidated
+    before every batch, see invalidate_project_modules.
+    """
+
+    def __init__(self, checks):
+        """
+        Args:
+            checks (str): Comma separated pylint checks to enable, all others are disabled.
+        """
+        self.checks = checks
+        self.batches = 0
+        self._linter = None
+
+    def lint(self, python_files):
+        """
+        Lints a batch of files.
+
+        Args:
+            python_files (list): Paths of the files.
+
+        Returns:
+            list: Pylint JSON messages.
+        """
+        invalidate_project_modules()
+        output = StringIO()
+        if self._linter is None:
+            run = pylint.lint.Run(['--disable=all', f'--enable={self.checks}', *python_files],
+                                  reporter=JSONReporter(output), exit=False)
+            self._linter = run.linter
+        else:
+            self._linter.set_reporter(JSONReporter(output))
+            self._linter.check(python_files)
+            self._linter.generate_reports()
+        self.batches += 1
+        return json.loads(output.getvalue())
+
+
+# Linters of this worker process, by enabled checks
+_linters = {}
+
+
+def lint_batch(python_files, checks):
+    """Lints files with the resident linter of this process for the checks."""
+    linter = _linters.get(checks)
+    if linter is None:
+        linter = _linters[checks] = ResidentLinter(checks)
+    return linter.lint(python_files)
+
+
+def warm_up(checks):
+    """Builds the linter of a new worker process on a small file, so its first batch is warm."""
+    directory = tempfile.mkdtemp(prefix='ci-lint-warm-')
+    try:
+        path = os.path.join(directory, 'warm_up.py')
+        with open(path, 'w') as f:
+            f.write("import os\nimport sys\nimport json\n\n\ndef main():\n    return os.path.join(sys.prefix, json.__name__)\n")
+        lint_batch([path], checks)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _ready():
+    return os.getpid()
+
+
+class LintServiceStopped(Exception):
+    """Raised by LintService.lint when the service is not started or was stopped."""
+
+
+class LintService:
+    """
+    Pool of long-lived pylint worker processes kept warm by the server.
+
+    Each worker holds a ResidentLinter, so a build's files are linted without
+    starting processes, importing pylint or parsing the standard library again.
+    Workers are replaced after max_batches batches to bound the memory astroid
+    holds, and the pool is started again if a worker dies. Once stopped, no
+    worker is started again until start is called: lint raises
+    LintServiceStopped, and its callers lint without the service.
+    """
+
+    def __init__(self, workers, checks, max_batches=200):
+        """
+        Args:
+            workers (int): Number of worker processes.
+            checks (str): Checks the workers warm their linter up with.
+            max_batches (int): Batches a worker lints before it is replaced.
+        """
+        self.workers = workers
+        self.checks = checks
+        self.max_batches = max_batches
+        self._executor = None
+        self._stopped = True
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return not self._stopped
+
+    def start(self):
+        """Starts the worker processes if they are not running, warming them up in the background."""
+        with self._lock:
+            self._stopped = False
+            if self._executor is None:
+                self._executor = self._make_executor()
+                # One task per worker, so every process is spawned and warmed up now
+                for _ in range(self.workers):
+                    self._executor.submit(_ready)
+                log.info("Lint workers started", workers=self.workers)
+
+    def stop(self):
+        """Stops the worker processes, the batches waiting for a worker are cancelled."""
+        with self._lock:
+            self._stopped = True
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def lint(self, shards, checks):
+        """
+        Lints batches of files, one per worker at a time.
+
+        Args:
+            shards (list): Lists of paths, see syntax_check.make_shards.
+            checks (str): Comma separated pylint checks to enable.
+
+        Returns:
+            list: Pylint JSON messages of all batches.
+
+        Raises:
+            LintServiceStopped: If the service is not started, or is stopped
+                before all batches are linted.
+        """
+        for attempt in range(2):
+            with self._lock:
+                if self._stopped:
+                    raise LintServiceStopped("The lint workers are stopped")
+                if self._executor is None:
+                    self._executor = self._make_executor()
+                executor = self._executor
+            try:
+                results = executor.map(lint_batch, shards, [checks] * len(shards))
+                return [message for result in results for message in result]
+            except (RuntimeError, CancelledError) as e:
+                # stop() shut the executor down under this call: its batches were cancelled,
+                # or it refused them with 'cannot schedule new futures after shutdown'
+                if self._stopped:
+                    raise LintServiceStopped("The lint workers were stopped") from e
+                if not isinstance(e, BrokenProcessPool):
+                    raise
+                log.warning("Lint worker died, restarting the workers", attempt=attempt + 1)
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+                if attempt:
+                    raise
+
+    def _make_executor(self):
+        # Replacing workers after some batches needs Python 3.11
+        recycle = {'max_tasks_per_child': self.max_batches} if sys.version_info >= (3, 11) else {}
+        # Forking a threaded server is unsafe, start the workers from scratch instead
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=warm_up, initargs=(self.checks,), **recycle
+        )
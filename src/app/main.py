@@ -1,9 +1,36 @@
-from CIServer import SimpleHandler
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from CIServer import run_server
+import argparse
+import signal
+import threading
+import config
+from ci_logging import setup_logging
+from CIServer import run_server, stop_server, SERVER_MODES
 
 
-server = run_server(8008)
-server.serve_forever()
+def main():
+    parser = argparse.ArgumentParser(description="Run the CI server.")
+    parser.add_argument('--port', type=int, default=8008, help="port to listen on")
+    parser.add_argument('--mode', choices=SERVER_MODES, default=config.SERVER_MODE,
+                        help="'single' serves one request at a time, 'threaded' serves them concurrently")
+    parser.add_argument('--max-workers', type=int, default=config.HTTP_WORKERS,
+                        help="size of the request thread pool in threaded mode")
+    parser.add_argument('--max-in-flight', type=int, default=config.HTTP_MAX_IN_FLIGHT,
+                        help="requests accepted at once in threaded mode before answering 503")
+    parser.add_argument('--log-level', default=config.LOG_LEVEL, help="lowest level logged, e.g. DEBUG or WARNING")
+    parser.add_argument('--log-format', choices=('json', 'text'), default=config.LOG_FORMAT)
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_format)
 
+    server = run_server(args.port, mode=args.mode, max_workers=args.max_workers, max_in_flight=args.max_in_flight)
 
+    def handle_signal(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it cannot run on the serving thread
+        threading.Thread(target=stop_server, args=(server,)).start()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    server.serve_forever()
+
+
+# Worker processes started with 'spawn' import this module again, they must not start a server
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from ci_logging import get_logger
+
+log = get_logger('metrics')
+
+# Upper bounds in seconds of the latency histogram buckets, from SQLite queries to
+# whole test suites
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Histogram:
+    """
+    Latency histogram in the Prometheus text format, optionally split by labels.
+
+    Observing a value is a bisect and three additions under a lock, cheap enough to
+    time every query and request.
+    """
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name (str): Metric name.
+            help_text (str): Description shown in the HELP line.
+            labelnames (tuple): Names of the labels observations are split by.
+            buckets (tuple): Sorted upper bounds of the buckets, +Inf is added.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Records one value, with a value for each of the label names."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time spent in the block, whether it raises or not."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        """Returns the number of values observed with the given labels."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics of the server, rendered by GET /metrics.
+
+    Histograms are updated as things happen. Gauges and counters kept elsewhere
+    (queue depth, cache statistics, ...) are read from callbacks at scrape time,
+    so keeping them costs nothing between scrapes.
+    """
+
+    def __init__(self):
+        self._histograms = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Creates and registers a Histogram."""
+        histogram = Histogram(name, help_text, labelnames, buckets)
+        with self._lock:
+            self._histograms.append(histogram)
+        return histogram
+
+    def register(self, name, help_text, kind, callback):
+        """
+        Registers a metric read at scrape time.
+
+        Args:
+            name (str): Metric name.
+            help_text (str): Description shown in the HELP line.
+            kind (str): 'gauge' or 'counter'.
+            callback: Callable returning a number, or a dict mapping label sets,
+                tuples of (label name, value) pairs, to numbers. None leaves the
+                metric out, see Sampled.
+        """
+        with self._lock:
+            self._callbacks = [entry for entry in self._callbacks if entry[0] != name]
+            self._callbacks.append((name, help_text, kind, callback))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = list(self._histograms)
+            callbacks = list(self._callbacks)
+        lines = []
+        for name, help_text, kind, callback in callbacks:
+            try:
+                value = callback()
+            except Exception as e:
+                log.error("Error reading metric", metric=name, error=str(e))
+                continue
+            if value is None:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if isinstance(value, dict):
+                for labels, sample in sorted(value.items()):
+                    lines.append(f"{name}{_labels(list(labels))} {sample}")
+            else:
+                lines.append(f"{name} {value}")
+        for histogram in histograms:
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+
+class Sampled:
+    """
+    A metric too costly to read at every scrape, e.g. the size of a directory tree.
+
+    Reading it returns the last sample at once. When that is older than max_age
+    seconds, a new one is taken by a background thread, so a scrape never waits
+    on the callback; the first scrape gets None and the metric is left out.
+    """
+
+    def __init__(self, callback, max_age):
+        """
+        Args:
+            callback: Callable returning the value, as for Registry.register.
+            max_age (float): Seconds a sample is served before it is taken again.
+        """
+        self.callback = callback
+        self.max_age = max_age
+        self._value = None
+        self._sampled_at = None
+        self._sampling = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            stale = self._sampled_at is None or time.monotonic() - self._sampled_at >= self.max_age
+            if stale and not self._sampling:
+                self._sampling = True
+                threading.Thread(target=self._sample, name='metrics-sampler', daemon=True).start()
+            return self._value
+
+    def _sample(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            log.error("Error sampling metric", error=str(e))
+            value = self._value
+        with self._lock:
+            self._value = value
+            self._sampled_at = time.monotonic()
+            self._sampling = False
+
+
+def dir_size(path):
+    """Returns the bytes used by the files under a directory, 0 if it does not exist."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    return total
+
+
+def _labels(labels):
+    """Formats (name, value) pairs as a Prometheus label set."""
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}' if labels else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+webhook_seconds = registry.histogram('ci_webhook_seconds', 'Time to validate and queue a webhook.')
+stage_seconds = registry.histogram(
+    'ci_stage_seconds', 'Time spent in each stage of a build.', ('stage',)
+)
+github_request_seconds = registry.histogram(
+    'ci_github_request_seconds', 'Time of each request to the GitHub commit status API.', ('outcome',)
+)
+db_query_seconds = registry.histogram(
+    'ci_db_query_seconds', 'Time a build history connection is held, waiting for the pool included.'
+)
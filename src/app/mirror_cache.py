@@ -0,0 +1,209 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from git import Repo
+from ci_logging import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+log = get_logger('mirror_cache')
+
+LAST_USED_FILE = 'ci-last-used'
+
+
+class MirrorCache:
+    """
+    Bare mirrors of remote repositories, reused across builds.
+
+    Each build fetches only the pushed branch into the mirror of its repository and
+    then makes a shared checkout from it, which borrows the mirror's objects instead
+    of copying them. Mirrors are locked while they are updated, and the least
+    recently used ones are evicted once the cache grows beyond its disk budget.
+    Mirrors that still back a checkout are never evicted.
+    """
+
+    def __init__(self, root, max_bytes):
+        """
+        Args:
+            root (str): Directory holding the mirrors.
+            max_bytes (int): Disk budget of the cache in bytes.
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._leases = {}
+        self._leases_guard = threading.Lock()
+
+    def mirror_path(self, repo_url):
+        """Returns the directory of the mirror of a repository."""
+        name = hashlib.sha1(repo_url.encode()).hexdigest()[:16]
+        return os.path.join(self.root, f"{name}.git")
+
+    def lock(self, repo_url):
+        """
+        Holds the lock of a repository's mirror, across threads and processes.
+        """
+        return self._lock_path(self.mirror_path(repo_url))
+
+    @contextmanager
+    def _lock_path(self, path):
+        with self._locks_guard:
+            thread_lock = self._locks.setdefault(path, threading.Lock())
+        with thread_lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path + '.lock', 'w') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update(self, repo_url, branch):
+        """
+        Creates the mirror of a repository if needed and fetches a branch into it.
+
+        Args:
+            repo_url (str): URL of the Git repository.
+            branch (str): The branch to fetch.
+
+        Returns:
+            Repo: The bare mirror repository.
+        """
+        path = self.mirror_path(repo_url)
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            mirror = Repo(path)
+        else:
+            log.info("Creating mirror", repo_url=repo_url, path=path)
+            mirror = Repo.init(path, bare=True)
+            mirror.create_remote('origin', repo_url)
+            # Objects borrowed by shared checkouts must not be pruned behind their back
+            mirror.git.config('gc.auto', '0')
+        log.info("Fetching into mirror", repo_url=repo_url, branch=branch)
+        mirror.git.fetch('origin', f"+refs/heads/{branch}:refs/heads/{branch}", '--prune', '--no-tags')
+        self._touch(path)
+        return mirror
+
+    def checkout(self, repo_url, branch, dest, sha=None):
+        """
+        Checks out a commit of a repository into dest, sharing objects with its mirror.
+
+        Args:
+            repo_url (str): URL of the Git repository.
+            branch (str): The branch that was pushed.
+            dest (str): Empty directory to check out into.
+            sha (str): Commit to check out, defaults to the tip of the branch.
+
+        Returns:
+            Repo: The checked out repository.
+        """
+        with self.lock(repo_url):
+            mirror = self._refresh(repo_url, branch, sha)
+            repo = Repo.clone_from(mirror.git_dir, dest, shared=True, no_checkout=True, branch=branch)
+            repo.git.checkout(sha or branch)
+            with self._leases_guard:
+                self._leases[os.path.abspath(dest)] = self.mirror_path(repo_url)
+        self.evict()
+        return repo
+
+    def refresh(self, repo_url, branch, sha=None):
+        """
+        Fetches a branch, and the commit if the branch moved on since, into the
+        mirror of a repository, for a checkout made earlier to fetch from.
+
+        Args:
+            repo_url (str): URL of the Git repository.
+            branch (str): The branch that was pushed.
+            sha (str): Commit that will be checked out.
+
+        Returns:
+            Repo: The bare mirror repository.
+        """
+        with self.lock(repo_url):
+            return self._refresh(repo_url, branch, sha)
+
+    def _refresh(self, repo_url, branch, sha):
+        mirror = self.update(repo_url, branch)
+        if sha and not _has_commit(mirror, sha):
+            # The branch moved on or was force-pushed since the webhook was sent
+            mirror.git.fetch('origin', sha)
+        return mirror
+
+    def release(self, dest):
+        """
+        Marks a checkout as removed, so its mirror may be evicted again.
+
+        Args:
+            dest (str): Directory previously passed to checkout.
+        """
+        with self._leases_guard:
+            self._leases.pop(os.path.abspath(dest), None)
+
+    def size(self):
+        """Returns the disk usage of all mirrors in bytes."""
+        return sum(_dir_size(path) for path in self._mirrors())
+
+    def evict(self):
+        """
+        Removes the least recently used mirrors until the cache fits its disk budget.
+        """
+        mirrors = sorted(self._mirrors(), key=_last_used)
+        sizes = {path: _dir_size(path) for path in mirrors}
+        total = sum(sizes.values())
+        for path in mirrors:
+            if total <= self.max_bytes:
+                break
+            with self._lock_path(path):
+                with self._leases_guard:
+                    if path in self._leases.values():
+                        continue
+                log.info("Evicting mirror", path=path)
+                shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+
+    def _mirrors(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if name.endswith('.git') and os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def _touch(self, path):
+        with open(os.path.join(path, LAST_USED_FILE), 'w') as f:
+            f.write(str(time.time()))
+
+
+def _has_commit(repo, sha):
+    try:
+        repo.git.cat_file('-e', f"{sha}^{{commit}}")
+        return True
+    except Exception:
+        return False
+
+
+def _last_used(path):
+    try:
+        return os.path.getmtime(os.path.join(path, LAST_USED_FILE))
+    except OSError:
+        return 0
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
@@ -1,45 +1,428 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import requests
-import subprocess
+from requests.adapters import HTTPAdapter
+import config
+from build_history import store_for
+from metrics import github_request_seconds
+from ci_logging import get_logger
+
+log = get_logger('notify')
+
+# Responses worth sending the same request again for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses remembered per commit and context to skip sending them twice
+MAX_SENT_STATUSES = 10000
+# Statuses read from the outbox at a time
+DISPATCH_BATCH = 50
+
+
+class StatusOutbox:
+    """
+    Commit statuses waiting to be sent, kept in the 'status_outbox' table of the
+    build history database so they survive a restart of the server.
+
+    There is at most one row per commit and context: queuing a status replaces
+    the one waiting for the same commit and context. Tokens are not written to disk.
+    """
+
+    def __init__(self, db_path='build_history.db'):
+        """
+        Args:
+            db_path (str): Path of the SQLite database holding the outbox, see build_history.store_for.
+        """
+        self.db_path = os.path.abspath(db_path)
+        self.store = store_for(db_path)
+        self._table_ready = False
+
+    @contextmanager
+    def _connect(self):
+        with self.store.connection() as conn:
+            if not self._table_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS status_outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        owner TEXT,
+                        repo TEXT,
+                        sha TEXT,
+                        context TEXT,
+                        data TEXT,
+                        attempts INTEGER DEFAULT 0,
+                        next_attempt_at REAL,
+                        created_at REAL,
+                        UNIQUE (owner, repo, sha, context)
+                    )
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_status_outbox_next_attempt ON status_outbox (next_attempt_at)")
+                self._table_ready = True
+            yield conn
+
+    def put(self, owner, repo, sha, data):
+        """
+        Queues a status, replacing the one waiting for the same commit and context.
+
+        Returns:
+            bool: True if a waiting status was replaced.
+        """
+        replaced = self.waiting(owner, repo, sha, data['context'])
+        now = time.time()
+        with self._connect() as conn:
+            # REPLACE gives the row a new id, so a delivery of the old status in progress
+            # does not remove the new one when it finishes
+            conn.execute(
+                "INSERT OR REPLACE INTO status_outbox (owner, repo, sha, context, data, attempts, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                (owner, repo, sha, data['context'], json.dumps(data), now, now)
+            )
+        return replaced
+
+    def waiting(self, owner, repo, sha, context):
+        """Returns whether a status for a commit and context is waiting to be sent."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM status_outbox WHERE owner = ? AND repo = ? AND sha = ? AND context = ?",
+                (owner, repo, sha, context)
+            ).fetchone()
+        return row is not None
+
+    def due(self, now, limit):
+        """
+        Returns the statuses ready to be sent, oldest first.
+
+        Returns:
+            list: Tuples of (id, owner, repo, sha, data, attempts).
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, owner, repo, sha, data, attempts FROM status_outbox "
+                "WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?",
+                (now, limit)
+            ).fetchall()
+        return [(id, owner, repo, sha, json.loads(data), attempts) for id, owner, repo, sha, data, attempts in rows]
+
+    def next_attempt(self):
+        """Returns when the next status is due, or None if the outbox is empty."""
+        with self._connect() as conn:
+            (next_at,) = conn.execute("SELECT MIN(next_attempt_at) FROM status_outbox").fetchone()
+        return next_at
+
+    def done(self, id):
+        """Removes a status that was sent or given up on."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM status_outbox WHERE id = ?", (id,))
+
+    def retry(self, id, attempts, next_attempt_at):
+        """Schedules another attempt at sending a status."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE status_outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts, next_attempt_at, id)
+            )
+
+    def count(self):
+        """Returns the number of statuses waiting to be sent."""
+        with self._connect() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM status_outbox").fetchone()
+        return count
+
+
+class GithubClient:
+    """
+    Client for the GitHub commit status API shared by all builds.
+
+    Requests go through one requests.Session, so connections are pooled and kept
+    alive between statuses. Failed requests are retried with exponential backoff
+    and jitter, and the rate-limit headers of GitHub are honored.
+
+    Statuses are written to a StatusOutbox and delivered by a background
+    dispatcher thread, so builds never wait on GitHub. A newer status for the same
+    commit and context replaces a queued one, and a status identical to the last
+    one sent is dropped. Delivery is at least once: a status stays in the outbox
+    until GitHub accepted it, is retried with backoff while it keeps failing, and
+    is picked up again after a restart.
+    """
+
+    def __init__(self, api_url='https://api.github.com', pool_size=10, max_retries=5,
+                 backoff_base=0.5, backoff_max=30.0, max_wait=300.0, timeout=10.0,
+                 db_path='build_history.db', max_attempts=50, token=None):
+        """
+        Args:
+            api_url (str): Base URL of the GitHub API.
+            pool_size (int): Connections kept open to the API.
+            max_retries (int): Retries of a failed request before giving up.
+            backoff_base (float): Delay before the first retry in seconds, doubled on each retry.
+            backoff_max (float): Longest backoff delay in seconds.
+            max_wait (float): Longest wait for a rate limit to reset in seconds.
+            timeout (float): Timeout of a request in seconds.
+            db_path (str): Path of the SQLite database holding the outbox.
+            max_attempts (int): Deliveries of a status tried before it is dropped.
+            token (str): Token for statuses queued before a restart, defaults to $GITHUB_TOKEN.
+        """
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.token = token or os.getenv('GITHUB_TOKEN')
+        self.outbox = StatusOutbox(db_path)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        self.stats = {'sent': 0, 'failed': 0, 'retries': 0, 'coalesced': 0, 'skipped': 0}
+        self._tokens = {}
+        self._sent = OrderedDict()
+        self._rate_limited_until = 0.0
+        self._cond = threading.Condition()
+        self._wakeup = False
+        self._stopping = False
+        self._dispatcher = None
+
+    def post_status(self, owner, repo, sha, token, data):
+        """
+        Queues a commit status in the outbox, to be sent in the background.
+
+        Args:
+            owner (str): Owner of the repository.
+            repo (str): Name of the repository.
+            sha (str): SHA of the commit.
+            token (str): GitHub token authorized to set statuses.
+            data (dict): Status with 'state', 'target_url', 'description' and 'context'.
+        """
+        key = (owner, repo, sha, data['context'])
+        with self._cond:
+            if token:
+                self._tokens[(owner, repo)] = token
+            already_sent = self._sent.get(key) == data
+        if already_sent and not self.outbox.waiting(*key):
+            with self._cond:
+                self.stats['skipped'] += 1
+            return
+        replaced = self.outbox.put(owner, repo, sha, data)
+        with self._cond:
+            if replaced:
+                self.stats['coalesced'] += 1
+        self.start()
+        self._wake()
+
+    def start(self):
+        """Starts the dispatcher thread, which also sends statuses left from before a restart."""
+        with self._cond:
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._stopping = False
+                self._dispatcher = threading.Thread(target=self._run, name='github-status', daemon=True)
+                self._dispatcher.start()
+
+    def stop(self, timeout=None):
+        """Stops the dispatcher thread, statuses not sent yet stay in the outbox."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            dispatcher = self._dispatcher
+        if dispatcher:
+            dispatcher.join(timeout)
+
+    def flush(self, timeout=None):
+        """
+        Waits for the queued statuses to be sent.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds, None waits forever.
+
+        Returns:
+            bool: True if nothing is left to send.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.outbox.count() == 0, timeout)
+
+    def send(self, owner, repo, sha, token, data):
+        """
+        Sends a commit status right away, retrying failed requests.
+
+        Connection errors, timeouts, server errors and rate-limited responses are
+        retried. Waits for Retry-After or X-RateLimit-Reset when GitHub sends them,
+        and for an exponential backoff with full jitter otherwise.
+
+        Args:
+            owner (str): Owner of the repository.
+            repo (str): Name of the repository.
+            sha (str): SHA of the commit.
+            token (str): GitHub token authorized to set statuses.
+            data (dict): Status with 'state', 'target_url', 'description' and 'context'.
+
+        Returns:
+            requests.Response: The successful response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request still fails after all retries.
+        """
+        url = f"{self.api_url}/repos/{owner}/{repo}/statuses/{sha}"
+        headers = {"Authorization": f"token {token}"}
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, headers=headers, json=data, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                github_request_seconds.observe(time.perf_counter() - started, outcome='error')
+                error, delay = e, self._backoff(attempt)
+            else:
+                github_request_seconds.observe(time.perf_counter() - started, outcome=f"{response.status_code // 100}xx")
+                self._note_rate_limit(response)
+                if response.ok:
+                    return response
+                if not _is_retryable(response):
+                    response.raise_for_status()
+                error = requests.exceptions.HTTPError(
+                    f"{response.status_code} Error: {response.reason} for url: {url}", response=response
+                )
+                delay = self._retry_delay(response, attempt)
+            if attempt == self.max_retries:
+                raise error
+            with self._cond:
+                self.stats['retries'] += 1
+            time.sleep(delay)
+
+    def _wake(self):
+        with self._cond:
+            self._wakeup = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+            due = self.outbox.due(time.time(), DISPATCH_BATCH)
+            if not due:
+                next_at = self.outbox.next_attempt()
+                with self._cond:
+                    if not self._wakeup and not self._stopping:
+                        self._cond.wait(None if next_at is None else max(0.0, next_at - time.time()))
+                    self._wakeup = False
+                continue
+            for id, owner, repo, sha, data, attempts in due:
+                if self._stopping:
+                    return
+                self._deliver(id, owner, repo, sha, data, attempts)
+
+    def _deliver(self, id, owner, repo, sha, data, attempts):
+        with self._cond:
+            token = self._tokens.get((owner, repo), self.token)
+        key = (owner, repo, sha, data['context'])
+        try:
+            self.send(owner, repo, sha, token, data)
+            log.info("Commit status set", context=data['context'], state=data['state'], sha=sha)
+            self.outbox.done(id)
+            with self._cond:
+                self.stats['sent'] += 1
+                self._sent[key] = data
+                self._sent.move_to_end(key)
+                while len(self._sent) > MAX_SENT_STATUSES:
+                    self._sent.popitem(last=False)
+                self._cond.notify_all()
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, 'response', None)
+            permanent = response is not None and not _is_retryable(response)
+            if permanent or attempts + 1 >= self.max_attempts:
+                log.error("Failed to update commit status, giving up", sha=sha, context=data['context'], error=str(e))
+                self.outbox.done(id)
+            else:
+                log.warning("Failed to update commit status, retrying later", sha=sha, context=data['context'],
+                            attempts=attempts + 1, error=str(e))
+                self.outbox.retry(id, attempts + 1, time.time() + self._backoff(attempts + 1))
+            with self._cond:
+                self.stats['failed'] += 1
+                self._cond.notify_all()
+
+    def _backoff(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_wait)
+            except ValueError:
+                pass
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return min(max(0.0, self._rate_limited_until - time.time()), self.max_wait)
+        return self._backoff(attempt)
+
+    def _note_rate_limit(self, response):
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            try:
+                self._rate_limited_until = float(response.headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError):
+                pass
+
+    def _wait_for_rate_limit(self):
+        delay = min(self._rate_limited_until - time.time(), self.max_wait)
+        if delay > 0:
+            log.warning("GitHub rate limit reached", wait_seconds=round(delay))
+            time.sleep(delay)
+
+
+def backoff_delay(attempt, base, maximum):
+    """Exponential backoff with full jitter: a random delay up to base * 2 ** attempt, at most maximum seconds."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def _is_retryable(response):
+    if response.status_code in RETRY_STATUSES:
+        return True
+    # Secondary rate limits answer 403 with one of these headers
+    return response.status_code == 403 and (
+        'Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0'
+    )
+
+
+github_client = GithubClient(
+    config.GITHUB_API_URL,
+    pool_size=config.GITHUB_POOL_SIZE,
+    max_retries=config.GITHUB_MAX_RETRIES,
+    backoff_base=config.GITHUB_BACKOFF_BASE,
+    backoff_max=config.GITHUB_BACKOFF_MAX,
+    timeout=config.GITHUB_TIMEOUT,
+    max_attempts=config.GITHUB_OUTBOX_MAX_ATTEMPTS,
+    db_path=config.DB_PATH
+)
 
 
 class GithubNotification:
-    def __init__(self, owner, repo, token, target_url, context):
+    def __init__(self, owner, repo, token, target_url, context, client=None):
         self.owner = owner
         self.repo = repo
         self.token = token
         self.target_url = target_url
         self.context = context
-        
+        self.client = client or github_client
+
     def send_commit_status(self, state, description, sha, run_id):
         """
         Sends a commit status update to GitHub.
 
+        The status is written to the outbox of the shared GithubClient, which sends
+        it in the background, so a slow or failing GitHub API does not hold up the build.
+
         Args:
             state (str): Commit state
             description (str): Short description of the status.
             sha (str): SHA hash of the commit to update.
             run_id (str): Unique identifier for the related CI/CD run.
-
-        Raises:
-            requests.exceptions.RequestException: If the request fails
         """
-        url = f"https://api.github.com/repos/{self.owner}/{self.repo}/statuses/{sha}"
-        headers = {
-            "Authorization": f"token {self.token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        
         data = {
             "state": state,
             "target_url": f"{self.target_url}/{run_id}",
             "description": description,
             "context": self.context
         }
-        
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            print("Commit status updated successfully!")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to update commit status: {e}")
-            print(response.text)
\ No newline at end of file
+        self.client.post_status(self.owner, self.repo, sha, self.token, data)
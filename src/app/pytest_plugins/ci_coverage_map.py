@@ -0,0 +1,179 @@
+"""
+Pytest plugin recording which source files each test file runs.
+
+Loaded by run_tests with '-p ci_coverage_map' on full test runs. Only function
+calls are traced, not lines, which keeps the overhead low. Code run while a test
+module is imported is attributed to that module.
+
+Code that runs once for several test files is attributed to each of them: a
+source module's import-time code to every test module importing it, directly or
+through other source files, since only the first import runs it, and a fixture's
+setup to every test using the fixture, since module and session scoped ones are
+set up once.
+
+The map is written as JSON to the path in the CI_COVERAGE_MAP environment
+variable, as {test file: [source files]} with paths relative to CI_COVERAGE_ROOT.
+"""
+import ast
+import importlib.util
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.realpath(os.environ.get('CI_COVERAGE_ROOT', os.getcwd())) + os.sep
+OUTPUT = os.environ.get('CI_COVERAGE_MAP')
+
+coverage = {}
+# Source files run by the setup of each fixture definition, by id
+fixture_coverage = {}
+# Test modules by test file, their imports are resolved at the end of the session
+test_modules = {}
+# Set the files being traced are added to, and the code objects already seen for it
+current = None
+seen_code = set()
+
+
+def _trace(frame, event, arg):
+    # Called for 'call' events only, since it never returns a local trace function
+    code = frame.f_code
+    if current is not None and code not in seen_code:
+        seen_code.add(code)
+        filename = _relative(code.co_filename)
+        if filename is not None:
+            current.add(filename)
+    return None
+
+
+def _relative(filename):
+    # sys.path entries like 'src/test/../app' leave '..' in the file names
+    filename = os.path.realpath(filename)
+    return filename[len(ROOT):] if filename.startswith(ROOT) else None
+
+
+def _test_file(path):
+    return os.path.relpath(os.path.realpath(str(path)), ROOT)
+
+
+def _record(path):
+    global current, seen_code
+    seen_code = set()
+    current = coverage.setdefault(_test_file(path), set())
+    sys.settrace(_trace)
+    threading.settrace(_trace)
+
+
+def _stop():
+    global current
+    sys.settrace(None)
+    threading.settrace(None)
+    current = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_make_collect_report(collector):
+    if not OUTPUT or not isinstance(collector, pytest.Module):
+        yield
+        return
+    _record(collector.path)
+    try:
+        outcome = yield
+    finally:
+        _stop()
+    if outcome.get_result().passed:
+        test_modules[_test_file(collector.path)] = collector.obj
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    if not OUTPUT:
+        yield
+        return
+    _record(item.path)
+    try:
+        yield
+    finally:
+        # Items other than test functions, e.g. doctests, have no fixture info
+        fixtureinfo = getattr(item, '_fixtureinfo', None)
+        if fixtureinfo is not None:
+            for fixturedefs in fixtureinfo.name2fixturedefs.values():
+                for fixturedef in fixturedefs:
+                    current.update(fixture_coverage.get(id(fixturedef), ()))
+        _stop()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    global current, seen_code
+    if not OUTPUT or current is None:
+        yield
+        return
+    # Traced on its own, so the tests set up after it get what it ran as well
+    outer = current, seen_code
+    current = fixture_coverage.setdefault(id(fixturedef), set())
+    seen_code = set()
+    try:
+        yield
+    finally:
+        current, seen_code = outer
+
+
+def imported_files(module):
+    """
+    Lists the source files a module imports, directly or through other source
+    files, itself included.
+
+    The import statements are read from the source and resolved to the modules
+    already loaded, along with their parent packages. Modules outside
+    CI_COVERAGE_ROOT are not followed.
+
+    Args:
+        module: A test module.
+
+    Returns:
+        set: Paths relative to CI_COVERAGE_ROOT.
+    """
+    files = set()
+    stack = [module]
+    while stack:
+        module = stack.pop()
+        path = getattr(module, '__file__', None) or ''
+        filename = _relative(path)
+        if filename is None or not filename.endswith('.py') or filename in files:
+            continue
+        files.add(filename)
+        try:
+            with open(path, 'rb') as f:
+                tree = ast.parse(f.read(), filename=path)
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                try:
+                    base = importlib.util.resolve_name('.' * node.level + (node.module or ''), module.__package__)
+                except (ImportError, ValueError):
+                    continue
+                # 'from package import module' imports a submodule
+                names = [base] + [f"{base}.{alias.name}" for alias in node.names]
+            else:
+                continue
+            for name in names:
+                parts = name.split('.')
+                stack.extend(
+                    sys.modules['.'.join(parts[:i])] for i in range(1, len(parts) + 1)
+                    if '.'.join(parts[:i]) in sys.modules
+                )
+    return files
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not OUTPUT:
+        return
+    for test_file, module in test_modules.items():
+        coverage.setdefault(test_file, set()).update(imported_files(module))
+    with open(OUTPUT, 'w') as f:
+        json.dump({test_file: sorted(sources) for test_file, sources in coverage.items()}, f)
@@ -0,0 +1,143 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+
+class CachedResponse:
+    """A JSON response body with its validators, and its gzip encoding once asked for."""
+
+    def __init__(self, version, modified, body, headers, compress_level):
+        self.version = version
+        self.modified = modified
+        self.body = body
+        self.headers = headers
+        self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        self.last_modified = formatdate(modified, usegmt=True)
+        self.compress_level = compress_level
+        self._gzipped = None
+
+    def gzipped(self):
+        """Returns the body compressed with gzip, compressing it the first time only."""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, self.compress_level, mtime=0)
+        return self._gzipped
+
+    def not_modified(self, if_none_match, if_modified_since):
+        """
+        Tells whether the client's copy is still current.
+
+        Args:
+            if_none_match (str): If-None-Match request header, or None.
+            if_modified_since (str): If-Modified-Since request header, or None. It is
+                ignored when If-None-Match is given.
+
+        Returns:
+            bool: True if a 304 Not Modified answers the request.
+        """
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # A weak comparison: the gzip encoding of the body has the same tag
+            return '*' in tags or any(tag.removeprefix('W/') == self.etag for tag in tags)
+        if if_modified_since is not None:
+            try:
+                return int(self.modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of the JSON responses of the build history endpoints.
+
+    Every entry remembers the build_history.history_version it was read at and is
+    only served while no build was written since, so a poll that finds nothing new
+    costs a dictionary lookup instead of a query and a serialization. The ETag of an
+    entry is a hash of its body: a client revalidating after an unrelated write still
+    gets a 304 when its page did not change.
+    """
+
+    def __init__(self, max_entries=256, compress_level=6):
+        """
+        Args:
+            max_entries (int): Responses kept, the least recently used are dropped.
+            compress_level (int): gzip compression level of large responses.
+        """
+        self.max_entries = max_entries
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """
+        Returns the cached response for a key if it was read at the given version.
+
+        Args:
+            key (str): Request path and query string.
+            version (int): Current version of the build history.
+
+        Returns:
+            CachedResponse: The response, or None if it is missing or stale.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, modified, body, headers=None):
+        """
+        Caches a response body.
+
+        Args:
+            key (str): Request path and query string.
+            version (int): Version of the build history the body was read at.
+            modified (float): Time of that version, as a Unix timestamp.
+            body (bytes): The JSON response body.
+            headers (dict): Extra response headers sent with it.
+
+        Returns:
+            CachedResponse: The new entry.
+        """
+        entry = CachedResponse(version, modified, body, headers or {}, self.compress_level)
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """Drops every cached response."""
+        with self._lock:
+            self._entries.clear()
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Tells whether an Accept-Encoding request header allows gzip.
+
+    Args:
+        accept_encoding (str): The header, or None.
+
+    Returns:
+        bool: True unless gzip is missing or refused with q=0.
+    """
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip', '*'):
+            q = params.strip().lower().removeprefix('q=')
+            try:
+                return not params or float(q) > 0
+            except ValueError:
+                return True
+    return False
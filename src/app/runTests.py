@@ -1,20 +1,401 @@
 import subprocess
 import os
+from collections import deque
+import shutil
+import tempfile
+import json
+import queue
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+import config
+from build_history import (get_test_durations, log_test_durations, log_test_outcomes, save_coverage_map,
+                           get_coverage_map, count_selective_build)
+from ci_logging import get_logger
+from venv_cache import EnvCache, env_python, bin_dir
 
-def run_tests(tests_path) -> bool:
-        """
-        Runs automated tests using pytest and returns whether all tests pass.
+# Named so, since run_tests takes the build log as 'log'
+logger = get_logger('runTests')
 
-        Args:
-                tests_path (str): Base directory containing the 'src/test' subdirectory.
+# How often a running test suite checks whether its build was cancelled, in seconds
+CANCEL_POLL_SECONDS = 0.5
+# Assumed duration of a test file that has never been timed
+DEFAULT_DURATION = 1.0
 
-        Returns:
-                bool: True if all tests pass, False otherwise.
-        """
-        print("Running Tests")
-        result = subprocess.run(["pytest", "--tb=short", os.path.join(tests_path, 'src', 'test')], capture_output=True, text=True)
-        test_logs = result.stdout
-        return result.returncode == 0, test_logs
-        
+# Changed files with these extensions cannot affect the outcome of a test
+IGNORED_EXTENSIONS = ('.md', '.rst', '.png', '.jpg', '.svg')
 
+# Longest output line kept whole, longer ones are split
+MAX_LINE_CHARS = 10000
+# Output lines buffered between the pytest processes and the log
+OUTPUT_BUFFER_LINES = 1000
 
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pytest_plugins')
+
+# Where the copy of the test environment is made in the checkout, see venv_cache
+ENV_DIR = '.ci-venv'
+
+venv_cache = EnvCache(config.VENV_CACHE_PATH, config.VENV_CACHE_MAX_BYTES,
+                      extra_packages=config.VENV_EXTRA_PACKAGES) if config.VENV_CACHE_ENABLED else None
+
+
+def find_test_files(tests_dir):
+    """
+    Lists the test files pytest would collect in a directory.
+
+    Args:
+        tests_dir (str): Directory containing the tests.
+
+    Returns:
+        list: Paths relative to tests_dir of files named test_*.py or *_test.py.
+    """
+    test_files = []
+    for root, _, files in os.walk(tests_dir):
+        for file in files:
+            if file.endswith('.py') and (file.startswith('test_') or file.endswith('_test.py')):
+                test_files.append(os.path.relpath(os.path.join(root, file), tests_dir))
+    return sorted(test_files)
+
+
+def make_shards(test_files, count, durations):
+    """
+    Splits test files into shards of about the same expected duration.
+
+    Args:
+        test_files (list): Test files to split.
+        count (int): Number of shards.
+        durations (dict): Historical duration in seconds per test file. Files without
+            one are assumed to take as long as the average file.
+
+    Returns:
+        list: Non-empty lists of test files.
+    """
+    default = sum(durations.values()) / len(durations) if durations else DEFAULT_DURATION
+    shards = [[] for _ in range(count)]
+    totals = [0.0] * count
+    for test_file in sorted(test_files, key=lambda f: durations.get(f, default), reverse=True):
+        shortest = totals.index(min(totals))
+        shards[shortest].append(test_file)
+        totals[shortest] += durations.get(test_file, default)
+    return [shard for shard in shards if shard]
+
+
+def read_outcomes(junit_path, tests_dir, test_files):
+    """
+    Reads the outcome of each test from a pytest JUnit XML report.
+
+    Args:
+        junit_path (str): Report written with junit_family=xunit1.
+        tests_dir (str): Directory containing the tests.
+        test_files (list): Test files the report covers, relative to tests_dir.
+
+    Returns:
+        list: Dicts with the 'test_file' relative to tests_dir (None if the report
+            does not say), 'name', 'outcome' (passed, failed, error or skipped),
+            'seconds' and the failure 'message', if any.
+    """
+    try:
+        tree = ET.parse(junit_path)
+    except (OSError, ET.ParseError):
+        return []
+    by_path = {os.path.abspath(os.path.join(tests_dir, f)): f for f in test_files}
+    outcomes = []
+    for case in tree.iter('testcase'):
+        test_file = None
+        reported = case.get('file')
+        if reported:
+            for path, candidate in by_path.items():
+                if path.endswith(os.sep + os.path.normpath(reported)) or path == os.path.abspath(reported):
+                    test_file = candidate
+                    break
+        outcome, message = 'passed', None
+        for tag in ('failure', 'error', 'skipped'):
+            element = case.find(tag)
+            if element is not None:
+                outcome = 'failed' if tag == 'failure' else tag
+                message = element.get('message') or (element.text or '').strip() or None
+                break
+        name = case.get('name', '')
+        if case.get('classname'):
+            name = f"{case.get('classname')}::{name}"
+        outcomes.append({
+            'test_file': test_file, 'name': name, 'outcome': outcome,
+            'seconds': float(case.get('time') or 0), 'message': message
+        })
+    return outcomes
+
+
+def read_durations(junit_path, tests_dir, test_files):
+    """
+    Sums the test durations of a pytest JUnit XML report per test file.
+
+    Args:
+        junit_path (str): Report written with junit_family=xunit1.
+        tests_dir (str): Directory containing the tests.
+        test_files (list): Test files the report covers, relative to tests_dir.
+
+    Returns:
+        dict: Seconds per test file.
+    """
+    return durations_of(read_outcomes(junit_path, tests_dir, test_files))
+
+
+def durations_of(outcomes):
+    """Sums the durations of test outcomes, as read by read_outcomes, per test file."""
+    durations = {}
+    for outcome in outcomes:
+        if outcome['test_file']:
+            durations[outcome['test_file']] = durations.get(outcome['test_file'], 0.0) + outcome['seconds']
+    return durations
+
+
+def select_tests(repo, test_files, changed_files):
+    """
+    Picks the test files affected by a push from the coverage map of the repository.
+
+    A test file is affected if it changed or if it runs one of the changed files.
+    The whole suite runs instead when the changed files are unknown, the map is
+    missing or stale, or a changed file is neither known to the map nor a test
+    file (e.g. a new module or a configuration file).
+
+    Args:
+        repo (str): URL of the repository.
+        test_files (list): Test files relative to the checkout root.
+        changed_files (list): Changed files relative to the checkout root, or None.
+
+    Returns:
+        tuple: (list of affected test files, or None for the whole suite, reason).
+    """
+    if changed_files is None:
+        return None, "changed files unknown"
+    recorded = get_coverage_map(repo)
+    if recorded is None:
+        return None, "no coverage map"
+    coverage, recorded_at, builds_since = recorded
+    if builds_since >= config.TEST_FULL_RUN_EVERY:
+        return None, f"{builds_since} builds since the coverage map was recorded"
+    age = datetime.now() - datetime.strptime(recorded_at, '%Y-%m-%d %H:%M:%S')
+    if age.total_seconds() > config.TEST_MAP_MAX_AGE_HOURS * 3600:
+        return None, f"coverage map recorded {recorded_at}"
+
+    covered = set()
+    for sources in coverage.values():
+        covered.update(sources)
+    selected = set()
+    for changed in changed_files:
+        changed = os.path.normpath(changed)
+        if changed.endswith(IGNORED_EXTENSIONS):
+            continue
+        if changed in test_files:
+            selected.add(changed)
+        elif changed in covered:
+            selected.update(t for t, sources in coverage.items() if changed in sources and t in test_files)
+        else:
+            return None, f"{changed} is not in the coverage map"
+    return sorted(selected), f"{len(selected)} of {len(test_files)} test files affected"
+
+
+def read_coverage_maps(paths):
+    """Merges the coverage maps written by the ci_coverage_map plugin of each shard."""
+    coverage = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                shard = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for test_file, sources in shard.items():
+            coverage.setdefault(test_file, set()).update(sources)
+    return coverage
+
+
+def read_output(index, stream, lines):
+    """Puts the output lines of a shard on a queue, followed by None at the end."""
+    for line in iter(lambda: stream.readline(MAX_LINE_CHARS), ''):
+        lines.put((index, line))
+    stream.close()
+    lines.put((index, None))
+
+
+def stop_processes(processes, lines):
+    """
+    Kills pytest processes and waits for them and for the threads reading their output.
+
+    Args:
+        processes (list): (process, junit_path) of the shards started so far.
+        lines (queue.Queue): Queue their read_output threads put lines on.
+    """
+    for process, _ in processes:
+        process.kill()
+    for process, _ in processes:
+        process.wait()
+    # Drained, so no reader is stuck on a full queue before reaching the end of its output
+    finished = 0
+    while finished < len(processes):
+        _, line = lines.get()
+        if line is None:
+            finished += 1
+
+
+def run_tests(tests_path, shards=None, repo=None, changed_files=None, commit_id=None, log=None, build_id=None,
+              cancel=None, record_outcomes=None) -> bool:
+    """
+    Runs automated tests using pytest and returns whether all tests pass.
+
+    With more than one shard, the test files are spread over that many pytest
+    processes running side by side, balanced by the durations recorded for the
+    repository in earlier builds.
+
+    When the changed files are given, only the test files affected by them are
+    run (see select_tests). Runs of the whole suite record which source files each
+    test file runs, for later builds to select from.
+
+    Checkouts with dependency files are tested in a copy of their cached
+    virtualenv (see venv_cache.EnvCache), made in the checkout and removed after
+    the run. If their dependencies cannot be installed, the run fails.
+
+    Args:
+        tests_path (str): Base directory containing the 'src/test' subdirectory.
+        shards (int): Number of pytest processes, defaults to config.TEST_SHARDS.
+        repo (str): Repository URL the test durations and coverage map are recorded under.
+        changed_files (list): Files changed by the push, relative to tests_path.
+        commit_id (str): Commit being tested, recorded with the coverage map.
+        log: Object with a write(str) method the output is streamed to line by line,
+            e.g. a build_log.BuildLog. Lines of different shards are prefixed with
+            the shard number.
+        build_id (int): Build the outcome of each test is recorded under, if any.
+        record_outcomes: Callable given the outcome of each test, as read by
+            read_outcomes, instead of recording them under build_id.
+        cancel (threading.Event): Once set, the pytest processes are killed and the
+            run fails without recording anything.
+
+    Returns:
+        bool: True if all tests pass, False otherwise.
+        str: The last config.TEST_LOG_TAIL_LINES lines of the output.
+    """
+    logger.info("Running tests", tests_path=tests_path)
+    tests_dir = os.path.join(tests_path, 'src', 'test')
+    shards = shards or config.TEST_SHARDS
+    test_files = find_test_files(tests_dir) if os.path.isdir(tests_dir) else []
+
+    selected = None
+    if repo and config.TEST_IMPACT_ANALYSIS:
+        rel_tests_dir = os.path.relpath(tests_dir, tests_path)
+        selected, reason = select_tests(repo, [os.path.join(rel_tests_dir, f) for f in test_files], changed_files)
+        logger.info("Test selection", reason=reason)
+        if selected is not None:
+            selected = [os.path.relpath(f, rel_tests_dir) for f in selected]
+            count_selective_build(repo)
+            if not selected:
+                if log is not None:
+                    log.write("No tests affected by the changed files\n")
+                return True, "No tests affected by the changed files\n"
+    record_coverage = bool(repo and config.TEST_IMPACT_ANALYSIS and selected is None)
+
+    if shards > 1 and len(selected if selected is not None else test_files) > 1:
+        groups = make_shards(selected if selected is not None else test_files, shards, get_test_durations(repo or ''))
+        targets = [[os.path.join(tests_dir, f) for f in group] for group in groups]
+    elif selected is not None:
+        groups = [selected]
+        targets = [[os.path.join(tests_dir, f) for f in selected]]
+    else:
+        groups = [test_files]
+        targets = [[tests_dir]]
+
+    env = os.environ.copy()
+    command = ["pytest"]
+    env_dir = None
+    if venv_cache is not None:
+        try:
+            shutil.rmtree(os.path.join(tests_path, ENV_DIR), ignore_errors=True)
+            env_dir = venv_cache.copy_for(tests_path, os.path.join(tests_path, ENV_DIR))
+        except subprocess.CalledProcessError as e:
+            output = f"===== Could not install the dependencies =====\n{e.stdout or ''}{e.stderr or ''}"
+            if log is not None:
+                log.write(output)
+            return False, output
+        if env_dir is not None:
+            command = [env_python(env_dir), "-m", "pytest"]
+            env['VIRTUAL_ENV'] = env_dir
+            env['PATH'] = os.pathsep.join([bin_dir(env_dir), env.get('PATH', '')])
+            env.pop('PYTHONHOME', None)
+    plugin_args = []
+    if record_coverage:
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PLUGIN_DIR, env.get('PYTHONPATH')]))
+        env['CI_COVERAGE_ROOT'] = os.path.abspath(tests_path)
+        plugin_args = ['-p', 'ci_coverage_map']
+
+    report_dir = tempfile.mkdtemp(prefix='ci-junit-')
+    cancelled = False
+    try:
+        processes = []
+        coverage_paths = []
+        # Bounded, so a chatty suite is held back instead of filling up memory
+        lines = queue.Queue(maxsize=OUTPUT_BUFFER_LINES)
+        for i, target in enumerate(targets):
+            junit_path = os.path.join(report_dir, f'shard-{i}.xml')
+            env['CI_COVERAGE_MAP'] = os.path.join(report_dir, f'coverage-{i}.json')
+            coverage_paths.append(env['CI_COVERAGE_MAP'])
+            try:
+                process = subprocess.Popen(
+                    [*command, "--tb=short", f"--junitxml={junit_path}", "-o", "junit_family=xunit1", *plugin_args, *target],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace', env=env
+                )
+            except BaseException:
+                stop_processes(processes, lines)
+                raise
+            threading.Thread(target=read_output, args=(i, process.stdout, lines), daemon=True).start()
+            processes.append((process, junit_path))
+
+        tail = deque(maxlen=config.TEST_LOG_TAIL_LINES)
+
+        def emit(line):
+            tail.append(line)
+            if log is not None:
+                log.write(line)
+
+        if len(processes) > 1:
+            for i, group in enumerate(groups):
+                emit(f"===== shard {i + 1}/{len(processes)}: {len(group)} test files =====\n")
+        running = len(processes)
+        while running:
+            if cancel is not None and cancel.is_set() and not cancelled:
+                cancelled = True
+                for process, _ in processes:
+                    process.kill()
+            try:
+                i, line = lines.get(timeout=CANCEL_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if line is None:
+                running -= 1
+            elif len(processes) > 1:
+                emit(f"[{i + 1}/{len(processes)}] {line}")
+            else:
+                emit(line)
+
+        passed = True
+        outcomes = []
+        for i, (process, junit_path) in enumerate(processes):
+            passed = process.wait() == 0 and passed
+            outcomes.extend(read_outcomes(junit_path, tests_dir, groups[i]))
+        durations = durations_of(outcomes)
+        coverage = read_coverage_maps(coverage_paths) if record_coverage else {}
+    finally:
+        shutil.rmtree(report_dir, ignore_errors=True)
+        if env_dir is not None:
+            shutil.rmtree(env_dir, ignore_errors=True)
+
+    if cancelled:
+        emit("===== Tests cancelled =====\n")
+        return False, ''.join(tail)
+
+    if record_outcomes is not None and outcomes:
+        record_outcomes(outcomes)
+    elif build_id is not None and outcomes:
+        log_test_outcomes(build_id, outcomes)
+    if repo and durations:
+        log_test_durations(repo, durations)
+    if coverage:
+        save_coverage_map(repo, commit_id, coverage)
+    return passed, ''.join(tail)
@@ -0,0 +1,324 @@
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+import requests
+import config
+from build_queue import BuildCancelled
+from clone import workspace_pool
+from ci_logging import get_logger, build_context, setup_logging
+from coordinator import LeaseLost
+from notify import github_client, backoff_delay, RETRY_STATUSES
+from syntax_check import lint_service
+
+log = get_logger('runner')
+
+# Output buffered before it is sent to the coordinator
+LOG_FLUSH_BYTES = 64 * 1024
+
+
+class CoordinatorClient:
+    """
+    Sends the requests of a runner to the /runners/ endpoints of the coordinator.
+
+    Connection errors, timeouts and the responses of RETRY_STATUSES, such as the
+    503 of a busy coordinator, are retried with exponential backoff and jitter,
+    honoring Retry-After, so a restart of the coordinator or a short network
+    outage does not fail the builds in progress. The coordinator records a result
+    sent twice only once, a log chunk whose response was lost may show up twice.
+    """
+
+    def __init__(self, url, runner_id, token=None, timeout=30, max_retries=5, backoff_base=0.5, backoff_max=30.0):
+        """
+        Args:
+            url (str): Base URL of the coordinator, e.g. http://ci.example.com:8008.
+            runner_id (str): Id the runner is known by.
+            token (str): Sent as a bearer token when set, see config.RUNNER_TOKEN.
+            timeout (float): Seconds to wait for each response.
+            max_retries (int): Retries of a failed request before giving up.
+            backoff_base (float): Delay before the first retry in seconds, doubled on each retry.
+            backoff_max (float): Longest delay between two attempts in seconds.
+        """
+        self.url = url.rstrip('/')
+        self.runner_id = runner_id
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._session = requests.Session()
+        if token:
+            self._session.headers['Authorization'] = f"Bearer {token}"
+        # The build and heartbeat threads share the connection, the lock is not held between attempts
+        self._lock = threading.Lock()
+
+    def post(self, path, data=None):
+        """
+        Sends a request to the coordinator, retrying failed attempts.
+
+        Args:
+            path (str): Path below /runners/, e.g. 'claim' or '12/heartbeat'.
+            data (dict): Body of the request, the runner id is added to it.
+
+        Returns:
+            dict: The response body, or None for 204 No Content.
+
+        Raises:
+            LeaseLost: If the coordinator answered 409.
+            requests.RequestException: If the coordinator cannot be reached or
+                answered with an error after all retries, or with an error not worth retrying.
+        """
+        url = f"{self.url}/runners/{path}"
+        body = {**(data or {}), 'runner': self.runner_id}
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._lock:
+                    response = self._session.post(url, json=body, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error, delay = e, backoff_delay(attempt, self.backoff_base, self.backoff_max)
+            else:
+                if response.status_code == 409:
+                    raise LeaseLost(response.json().get('message'))
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return None if response.status_code == 204 else response.json()
+                error = requests.exceptions.HTTPError(
+                    f"{response.status_code} Error: {response.reason} for url: {url}", response=response
+                )
+                delay = self._retry_delay(response, attempt)
+            if attempt == self.max_retries:
+                raise error
+            log.warning("Coordinator request failed, retrying", path=path, attempt=attempt + 1, error=str(error))
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+
+    def _retry_delay(self, response, attempt):
+        try:
+            return min(float(response.headers['Retry-After']), self.backoff_max)
+        except (KeyError, ValueError):
+            return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def close(self):
+        self._session.close()
+
+
+class RemoteBuildLog:
+    """
+    Build log streamed to the coordinator.
+
+    Output is buffered and sent once LOG_FLUSH_BYTES are waiting, and by the
+    heartbeat of the runner, so followers of GET /<id>/log see it within a
+    heartbeat. Output the coordinator could not be reached for is sent with the
+    next flush; once the lease of the build is lost it is dropped.
+    """
+
+    def __init__(self, client, build_id):
+        self.client = client
+        self.build_id = build_id
+        self.path = f"{client.url}/{build_id}/log"
+        self.lost = False
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            if self.lost:
+                return
+            self._buffer.append(text)
+            self._size += len(text)
+            full = self._size >= LOG_FLUSH_BYTES
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Sends the buffered output to the coordinator."""
+        with self._lock:
+            if not self._buffer or self.lost:
+                return
+            text = ''.join(self._buffer)
+            try:
+                self.client.post(f"{self.build_id}/log", {'text': text})
+            except LeaseLost:
+                self.lost = True
+            except requests.RequestException as e:
+                log.warning("Error streaming build log", build_id=self.build_id, error=str(e))
+                return
+            self._buffer = []
+            self._size = 0
+
+    def close(self):
+        """Sends what is left, the coordinator closes the log when the build is completed."""
+        self.flush()
+
+
+class RemoteRecorder:
+    """Sends the results of a build to the coordinator, which records them in the build history."""
+
+    def __init__(self, client, build_id):
+        self.client = client
+        self.build_id = build_id
+
+    def stage(self, stage, seconds):
+        self._record('stage', stage=stage, seconds=seconds)
+
+    def lint_messages(self, messages):
+        self._record('lint_messages', messages=messages)
+
+    def test_outcomes(self, outcomes):
+        self._record('test_outcomes', outcomes=outcomes)
+
+    def finish(self, commit_id, logs, status):
+        self._record('finish', commit_id=commit_id, logs=logs, status=status)
+
+    def _record(self, kind, **data):
+        self.client.post(f"{self.build_id}/record", {'kind': kind, 'data': data})
+
+
+class Runner:
+    """
+    Runs builds handed out by a coordinator, one at a time.
+
+    The runner asks the coordinator for a build, runs it with the same pipeline as
+    the workers of the server, streaming its log and results back, and sends a
+    heartbeat while it runs. It stops the build when the coordinator says it was
+    superseded or that its lease was lost. Start as many runners as there are
+    machines, or cores, to spare.
+
+    Only the log and the results shown in the build history (stage durations,
+    lint messages, test outcomes and the final status) go to the coordinator.
+    What a build learns for later builds of the repository (the test durations
+    shards are balanced by, the coverage map of test impact analysis, the lint
+    cache and the clone timings) is kept in the database of the runner, config.DB_PATH
+    on its machine, so each runner learns them from the builds it ran itself.
+    """
+
+    def __init__(self, coordinator_url, runner_id=None, token=None, poll_seconds=2, handler=None):
+        """
+        Args:
+            coordinator_url (str): Base URL of the CI server coordinating the runners.
+            runner_id (str): Id of the runner, the host name and process id by default.
+            token (str): Token the coordinator expects, see config.RUNNER_TOKEN.
+            poll_seconds (float): Time to wait before asking again when no build is waiting.
+            handler: Callable taking (build_id, payload, build_log, cancel, recorder)
+                that runs one build, CIServer.process_build by default.
+        """
+        self.runner_id = runner_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.client = CoordinatorClient(
+            coordinator_url, self.runner_id, token, max_retries=config.RUNNER_MAX_RETRIES,
+            backoff_base=config.RUNNER_BACKOFF_BASE, backoff_max=config.RUNNER_BACKOFF_MAX
+        )
+        self.poll_seconds = poll_seconds
+        if handler is None:
+            from CIServer import process_build as handler
+        self.handler = handler
+        self._stopping = threading.Event()
+
+    def run_forever(self):
+        """Runs builds until stop is called."""
+        log.info("Runner started", runner=self.runner_id, coordinator=self.client.url)
+        while not self._stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except requests.RequestException as e:
+                log.warning("Coordinator unreachable", error=str(e))
+            self._stopping.wait(self.poll_seconds)
+        self.client.close()
+        log.info("Runner stopped", runner=self.runner_id)
+
+    def stop(self):
+        """Stops the runner once the build it is running is done."""
+        self._stopping.set()
+
+    def run_once(self):
+        """
+        Claims a build and runs it.
+
+        Returns:
+            bool: False if no build was waiting.
+        """
+        job = self.client.post('claim')
+        if job is None:
+            return False
+        build_id, payload = job['build_id'], job['payload']
+        log.info("Running build", build_id=build_id, runner=self.runner_id)
+        build_log = RemoteBuildLog(self.client, build_id)
+        cancel = threading.Event()
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(build_id, job['heartbeat_seconds'], build_log, cancel, done),
+            name=f"heartbeat-{build_id}", daemon=True
+        )
+        heartbeat.start()
+
+        status, message = 'success', None
+        try:
+            with build_context(build_id):
+                self.handler(build_id, payload, build_log, cancel, RemoteRecorder(self.client, build_id))
+        except BuildCancelled as e:
+            status, message = 'cancelled', str(e)
+        except Exception as e:
+            status, message = 'failure', str(e)
+        finally:
+            done.set()
+            heartbeat.join()
+            build_log.close()
+
+        if build_log.lost:
+            log.warning("Build lease lost, result dropped", build_id=build_id)
+            return True
+        try:
+            self.client.post(f"{build_id}/complete", {'status': status, 'message': message})
+        except LeaseLost:
+            log.warning("Build lease lost, result dropped", build_id=build_id)
+        log.info("Build done", build_id=build_id, status=status)
+        return True
+
+    def _heartbeat(self, build_id, interval, build_log, cancel, done):
+        while not done.wait(interval):
+            build_log.flush()
+            try:
+                if self.client.post(f"{build_id}/heartbeat")['cancel']:
+                    cancel.set()
+            except LeaseLost:
+                build_log.lost = True
+                cancel.set()
+            except requests.RequestException as e:
+                log.warning("Heartbeat failed", build_id=build_id, error=str(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run builds handed out by a CI server.")
+    parser.add_argument('--coordinator', default=config.COORDINATOR_URL, help="base URL of the CI server")
+    parser.add_argument('--id', help="runner id, the host name and process id by default")
+    parser.add_argument('--poll-seconds', type=float, default=config.RUNNER_POLL_SECONDS,
+                        help="time to wait before asking again when no build is waiting")
+    parser.add_argument('--log-level', default=config.LOG_LEVEL, help="lowest level logged, e.g. DEBUG or WARNING")
+    parser.add_argument('--log-format', choices=('json', 'text'), default=config.LOG_FORMAT)
+    args = parser.parse_args()
+    if not config.RUNNER_TOKEN:
+        parser.error("CI_RUNNER_TOKEN must be set, the coordinator refuses runners without it")
+    setup_logging(args.log_level, args.log_format)
+
+    runner = Runner(args.coordinator, args.id, config.RUNNER_TOKEN, args.poll_seconds)
+    signal.signal(signal.SIGINT, lambda signum, frame: runner.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+    workspace_pool.reap_leaked(startup=True)
+    if config.LINT_SERVICE_ENABLED:
+        lint_service.start()
+    github_client.start()
+    try:
+        runner.run_forever()
+    finally:
+        lint_service.stop()
+        workspace_pool.drain(timeout=30)
+        github_client.flush(timeout=5)
+        github_client.stop(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
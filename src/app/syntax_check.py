@@ -1,15 +1,341 @@
+import ast
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pylint.lint
 import json
 from io import StringIO
 from pylint.reporters import JSONReporter
+import config
+from lint_cache import LintCache, blob_sha
+from compile_check import compile_files
+from lint_worker import LintService, LintServiceStopped, invalidate_project_modules
+from ci_logging import get_logger
 
-def syntax_check(directory):
+log = get_logger('syntax_check')
+
+ENABLED_CHECKS = 'syntax-error,undefined-variable'
+# Checks left to pylint once compile_check has ruled out syntax errors
+PYLINT_CHECKS = 'undefined-variable'
+
+# Fewest files worth starting a separate pylint process for
+MIN_FILES_PER_JOB = 50
+# Fewest files per batch sent to a warm lint worker, which costs only a round trip
+MIN_FILES_PER_BATCH = 10
+
+lint_cache = LintCache(config.DB_PATH, max_entries=config.LINT_CACHE_MAX_ENTRIES) if config.LINT_CACHE_ENABLED else None
+
+def module_name(path, directory):
+    """
+    Returns the dotted module name of a Python file relative to the checkout root.
+
+    Args:
+        path (str): Path of the Python file.
+        directory (str): Root of the checkout.
+
+    Returns:
+        str: e.g. 'src.app.clone' for src/app/clone.py, 'src.app' for src/app/__init__.py.
+    """
+    parts = os.path.relpath(path, directory)[:-len('.py')].split(os.sep)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def imported_modules(path, directory, source):
+    """
+    Lists the modules a Python file imports, including every parent package.
+
+    Relative imports are resolved to their dotted name from the checkout root.
+
+    Args:
+        path (str): Path of the Python file.
+        directory (str): Root of the checkout.
+        source (str): Contents of the file.
+
+    Returns:
+        set: Dotted module names. Empty if the file does not parse.
+    """
+    try:
+        tree = ast.parse(source, filename=path)
+    except (SyntaxError, ValueError):
+        return set()
+
+    package = module_name(path, directory).split('.')
+    if not path.endswith('__init__.py'):
+        package = package[:-1]
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package[:len(package) - (node.level - 1)]
+                module = '.'.join(base + ([node.module] if node.module else []))
+            else:
+                module = node.module
+            names.add(module)
+            # 'from package import module' imports a submodule
+            names.update(f"{module}.{alias.name}" for alias in node.names if alias.name != '*')
+
+    modules = set()
+    for name in names:
+        parts = name.split('.')
+        modules.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return modules
+
+
+def select_changed_files(directory, python_files, changed_files):
+    """
+    Narrows the files to lint down to the changed ones and their direct importers.
+
+    An import matches a changed module when it names the module by its full dotted
+    path from the checkout root or by any trailing part of it, since the import
+    root of a project (e.g. src/ or src/app/) is not known.
+
+    Args:
+        directory (str): Root of the checkout.
+        python_files (list): Every Python file in the checkout.
+        changed_files (list): Paths relative to the checkout root that were added,
+            modified or removed by the push.
+
+    Returns:
+        list: The Python files to lint, in the order of python_files.
+    """
+    changed = {
+        os.path.normpath(os.path.join(directory, path))
+        for path in changed_files if path.endswith('.py')
+    }
+    changed_modules = {module_name(path, directory) for path in changed}
+    if not changed_modules:
+        return []
+    short_names = {name.split('.')[-1] for name in changed_modules}
+
+    def imports_changed_module(path):
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                source = f.read()
+        except OSError:
+            return False
+        # Cheap text search first, most files cannot import a changed module
+        if not any(name in source for name in short_names):
+            return False
+        for imported in imported_modules(path, directory, source):
+            for module in changed_modules:
+                if module == imported or module.endswith('.' + imported):
+                    return True
+        return False
+
+    return [
+        path for path in python_files
+        if os.path.normpath(path) in changed or imports_changed_module(path)
+    ]
+
+
+def cache_key(path):
+    """
+    Returns the lint cache key of a file, or None if its messages must not be cached.
+
+    Files with a star import are not cached, since names they use may be defined
+    in other files.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if b'import *' in data:
+        return None
+    return blob_sha(data)
+
+
+def lint_shard(python_files, checks):
+    """
+    Runs pylint in the current process.
+
+    Args:
+        python_files (list): Paths of the files to lint.
+        checks (str): Comma separated pylint checks to enable, all others are disabled.
+
+    Returns:
+        list: Pylint JSON messages.
+    """
+    # The server lints reused workspaces in the same process, see invalidate_project_modules
+    invalidate_project_modules()
+    output = StringIO()
+    reporter = JSONReporter(output)
+    pylint.lint.Run(['--disable=all', f'--enable={checks}', *python_files], reporter=reporter, exit=False)
+    return json.loads(output.getvalue())
+
+
+def make_shards(python_files, count):
+    """
+    Splits files into shards of about the same total size, largest files first.
+
+    Args:
+        python_files (list): Paths of the files to split.
+        count (int): Number of shards.
+
+    Returns:
+        list: Non-empty lists of paths.
+    """
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    shards = [[] for _ in range(count)]
+    totals = [0] * count
+    for path in sorted(python_files, key=size, reverse=True):
+        smallest = totals.index(min(totals))
+        shards[smallest].append(path)
+        totals[smallest] += size(path)
+    return [shard for shard in shards if shard]
+
+
+def resolve_jobs(jobs=None):
+    """Returns the number of worker processes to use, defaulting to config.SYNTAX_CHECK_JOBS or the number of CPUs."""
+    return jobs or config.SYNTAX_CHECK_JOBS or os.cpu_count() or 1
+
+
+# Started by the server and runners, see CIServer.run_server
+lint_service = LintService(config.LINT_SERVICE_WORKERS, PYLINT_CHECKS, config.LINT_WORKER_MAX_BATCHES)
+
+
+def sort_messages(messages):
+    """Sorts pylint JSON messages by path and position."""
+    messages.sort(key=lambda m: (m.get('path', ''), m.get('line') or 0, m.get('column') or 0))
+    return messages
+
+
+def run_pylint(python_files, checks, jobs=None):
+    """
+    Runs pylint on files, on the warm workers of lint_service when it is running.
+
+    Otherwise, or once it is stopped, e.g. while the server shuts down, the files are sharded across a new pool of processes when there are
+    enough of them. Each of those gets at least MIN_FILES_PER_JOB files, since
+    starting pylint in a new process costs about as much as linting a few dozen files.
+
+    Args:
+        python_files (list): Paths of the files to lint.
+        checks (str): Comma separated pylint checks to enable, all others are disabled.
+        jobs (int): Maximum number of worker processes, see resolve_jobs.
+
+    Returns:
+        list: Pylint JSON messages of all shards.
+    """
+    jobs = resolve_jobs(jobs)
+    if lint_service.running:
+        count = max(1, min(jobs, lint_service.workers, len(python_files) // MIN_FILES_PER_BATCH))
+        try:
+            return sort_messages(lint_service.lint(make_shards(python_files, count), checks))
+        except LintServiceStopped:
+            log.info("Lint workers stopped, linting without them", files=len(python_files))
+
+    count = min(jobs, len(python_files) // MIN_FILES_PER_JOB)
+    if count <= 1:
+        return lint_shard(python_files, checks)
+
+    shards = make_shards(python_files, count)
+    log.info("Linting in parallel", files=len(python_files), processes=len(shards))
+    # Forking a threaded server is unsafe, start the workers from scratch instead
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('spawn')) as pool:
+        results = pool.map(lint_shard, shards, [checks] * len(shards))
+        messages = [message for result in results for message in result]
+    return sort_messages(messages)
+
+
+def lint_files(python_files, checks=ENABLED_CHECKS, cache=None, jobs=None):
+    """
+    Runs pylint on files, taking the messages of files seen before from the cache.
+
+    Args:
+        python_files (list): Paths of the files to lint.
+        checks (str): Comma separated pylint checks to enable, all others are disabled.
+        cache (LintCache): Cache of messages per file content, or None.
+        jobs (int): Maximum number of pylint processes, see run_pylint.
+
+    Returns:
+        list: Pylint JSON messages of all files.
+    """
+    keys = {}
+    cached = {}
+    if cache is not None:
+        for path in python_files:
+            key = cache_key(path)
+            if key:
+                keys[path] = key
+        cached = cache.get_many(list(keys.values()), pylint.__version__, checks)
+
+    errors = []
+    to_lint = []
+    for path in python_files:
+        if keys.get(path) in cached:
+            errors.extend(dict(message, path=path) for message in cached[keys[path]])
+        else:
+            to_lint.append(path)
+    if not to_lint:
+        return errors
+
+    fresh = run_pylint(to_lint, checks, jobs)
+    errors.extend(fresh)
+
+    if cache is not None:
+        by_file = {os.path.abspath(path): [] for path in to_lint if path in keys}
+        for message in fresh:
+            messages = by_file.get(os.path.abspath(message.get('path', '')))
+            if messages is not None:
+                messages.append({k: v for k, v in message.items() if k != 'path'})
+        cache.put_many(
+            {keys[path]: by_file[os.path.abspath(path)] for path in to_lint if path in keys},
+            pylint.__version__, checks
+        )
+    return errors
+
+
+def flatten_details(details, directory):
+    """
+    Lists the messages of a syntax check result, with paths relative to the checkout.
+
+    Args:
+        details: The 'details' of a syntax_check result, a list of pylint JSON
+            messages or a dict of messages per file.
+        directory (str): The directory that was checked.
+
+    Returns:
+        list: Pylint JSON messages.
+    """
+    if isinstance(details, dict):
+        details = [dict(message, path=path) for path, messages in details.items() for message in messages]
+    root = os.path.abspath(directory)
+    messages = []
+    for message in details:
+        if not isinstance(message, dict):
+            continue
+        path = message.get('path') or ''
+        # pylint reports paths relative to the working directory
+        if os.path.abspath(path).startswith(root + os.sep):
+            path = os.path.relpath(os.path.abspath(path), root)
+        messages.append(dict(message, path=path.replace(os.sep, '/')))
+    return messages
+
+
+def syntax_check(directory, changed_files=None, jobs=None):
     """
     Checks Python files in a directory for syntax errors using Pylint.
 
+    Every file is first compiled with the builtin compiler, and the check fails
+    right away if any of them has a syntax error. Otherwise pylint looks for
+    undefined variables.
+
     Args:
         directory (str): Path to the directory containing Python files.
+        changed_files (list): Paths relative to directory changed by the push. When
+            given, only those files and the files importing them are checked.
+            None checks every file.
+        jobs (int): Maximum number of worker processes, see resolve_jobs.
 
     Returns:
         dict: Contains status ("success", "error", or "warning"), a message, 
@@ -20,6 +346,21 @@ def syntax_check(directory):
         for file in files:
             if file.endswith('.py'):
                 python_files.append(os.path.join(root, file))
+
+    if python_files and changed_files is not None:
+        python_files = select_changed_files(directory, python_files, changed_files)
+        if not python_files:
+            return {
+                "status": "success",
+                "message": "No changed Python files to check",
+                "repository": {
+                    "url": "repo_url",
+                    "branch": "branch_name"
+                },
+                "files_checked": [],
+                "error_count": 0,
+                "details": {}
+            }
     
     if not python_files:
         return {
@@ -34,19 +375,26 @@ def syntax_check(directory):
             "details": {}
         }
     
-    output = StringIO()
-    reporter = JSONReporter(output)
-    
-    pylint_opts = [
-        '--disable=all', 
-        '--enable=syntax-error,undefined-variable', 
-        *python_files
-    ]
-    
+    # Fast path: the builtin compiler finds syntax errors in milliseconds, and a
+    # file that does not parse fails the check whatever pylint would say about it
+    syntax_errors = compile_files(python_files, resolve_jobs(jobs))
+    if syntax_errors:
+        return {
+            "status": "error",
+            "message": "Syntax errors found",
+            "repository": {
+                "url": "repo_url",
+                "branch": "branch_name"
+            },
+            "files_checked": python_files,
+            "error_count": len(syntax_errors),
+            "details": syntax_errors
+        }
+
     try:
-        pylint.lint.Run(pylint_opts, reporter=reporter, exit=False)
-        result = output.getvalue()
-        errors = json.loads(result)
+        errors = lint_files(python_files, checks=PYLINT_CHECKS, cache=lint_cache, jobs=jobs)
+        if lint_cache is not None:
+            log.debug("Lint cache", hits=lint_cache.hits, misses=lint_cache.misses)
         if len(errors) > 0:
             return {
                 "status": "error",
@@ -0,0 +1,386 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from metrics import dir_size
+from ci_logging import get_logger
+from workspace_pool import handle_remove_readonly
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: the dependencies of pyproject.toml are not installed
+    tomllib = None
+
+log = get_logger('venv_cache')
+
+# Files of a checkout whose contents decide its environment
+DEPENDENCY_PATTERNS = ('requirements*.txt', 'pyproject.toml')
+# Optional dependency groups of pyproject.toml installed for the tests
+TEST_EXTRAS = ('test', 'tests', 'testing')
+# Written into an environment once it is fully built
+COMPLETE_FILE = 'ci-env-complete'
+LAST_USED_FILE = 'ci-last-used'
+# Size and modification time of every file of a built environment, checked before it is copied
+MANIFEST_FILE = 'ci-env-manifest.json'
+# Lines of a requirements file naming another one, e.g. '-r base.txt' or '--constraint=pins.txt'
+INCLUDE_RE = re.compile(r'^(?:-[rc]\s*|--(?:requirement|constraint)(?:\s*=\s*|\s+))(\S+)')
+# Directories of an environment copied rather than linked, as Python and pip write into them
+WRITABLE_DIRS = ('__pycache__',)
+
+
+def dependency_files(checkout):
+    """Returns the dependency files at the root of a checkout, sorted by name."""
+    return sorted(
+        path for pattern in DEPENDENCY_PATTERNS for path in glob.glob(os.path.join(checkout, pattern))
+        if os.path.isfile(path)
+    )
+
+
+def requirement_files(path):
+    """
+    Returns a requirements file and the ones it includes with -r or -c, recursively.
+
+    Includes are resolved relative to the file naming them, as pip does. Ones
+    that do not exist are returned as well, URLs are left out.
+
+    Args:
+        path (str): Path of the requirements file.
+
+    Returns:
+        list: Absolute paths, path first, each one once.
+    """
+    found = []
+    pending = [os.path.abspath(path)]
+    while pending:
+        path = pending.pop(0)
+        if path in found:
+            continue
+        found.append(path)
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            match = INCLUDE_RE.match(re.sub(r'(^|\s)#.*', '', line).strip())
+            if match and '://' not in match.group(1):
+                pending.append(os.path.join(os.path.dirname(path), match.group(1)))
+    return found
+
+
+def bin_dir(env_dir):
+    """Returns the directory holding the executables of a virtualenv."""
+    return os.path.join(env_dir, 'Scripts' if os.name == 'nt' else 'bin')
+
+
+def env_python(env_dir):
+    """Returns the Python interpreter of a virtualenv."""
+    return os.path.join(bin_dir(env_dir), 'python.exe' if os.name == 'nt' else 'python')
+
+
+class EnvCache:
+    """
+    Virtualenvs for running the tests of a checkout, built once per set of
+    dependencies and copied for every build.
+
+    An environment is keyed by a hash of the checkout's requirements*.txt and
+    pyproject.toml, the Python it is made with and the extra packages, so builds
+    whose dependencies did not change share it and need no network. Each build
+    gets its own copy made of hard links, which takes a fraction of a second.
+    The files of the bin and __pycache__ directories are copied instead, with the
+    scripts naming the cached environment rewritten in the copy, never in place.
+    The linked files are made read-only, and their sizes and modification times
+    are checked before every copy: an environment a build wrote into through its
+    links anyway, e.g. running as root, is built again. The least recently used
+    environments are evicted once the cache grows beyond its disk budget; copies
+    still in use keep their files through the links.
+    """
+
+    def __init__(self, root, max_bytes, python=None, extra_packages=('pytest',)):
+        """
+        Args:
+            root (str): Directory holding the environments.
+            max_bytes (int): Disk budget of the cache in bytes.
+            python (str): Interpreter the environments are made with, defaults to
+                the one running the server.
+            extra_packages (tuple): Packages installed besides the dependencies of
+                the checkout, pytest to run the tests with.
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.python = python or sys.executable
+        self.extra_packages = tuple(extra_packages)
+        self.hits = 0
+        self.misses = 0
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def key(self, checkout):
+        """
+        Hashes what the environment of a checkout depends on.
+
+        Requirements files are hashed with the files they include with -r or -c.
+
+        Args:
+            checkout (str): Directory of the checkout.
+
+        Returns:
+            str: The key, or None if the checkout has no dependency files.
+        """
+        files = dependency_files(checkout)
+        if not files:
+            return None
+        digest = hashlib.sha256()
+        digest.update(f"{os.path.realpath(self.python)}\0{sys.version}\0{self.extra_packages}\0".encode())
+        for name in files:
+            for path in requirement_files(name) if name.endswith('.txt') else [name]:
+                digest.update(os.path.relpath(path, checkout).encode() + b"\0")
+                try:
+                    with open(path, 'rb') as f:
+                        digest.update(hashlib.sha256(f.read()).digest())
+                except OSError:
+                    digest.update(b"missing\0")
+        return digest.hexdigest()[:16]
+
+    def env_path(self, key):
+        """Returns the directory of a cached environment."""
+        return os.path.join(self.root, key)
+
+    def copy_for(self, checkout, dest):
+        """
+        Makes the environment of a checkout at dest, building it first if it is
+        not cached.
+
+        Args:
+            checkout (str): Directory of the checkout, its dependency files are installed.
+            dest (str): Directory to make the environment in, must not exist.
+
+        Returns:
+            str: dest, or None if the checkout has no dependency files and its
+                tests run in the environment of the server.
+
+        Raises:
+            subprocess.CalledProcessError: If installing the dependencies failed.
+        """
+        key = self.key(checkout)
+        if key is None:
+            return None
+        path = self.env_path(key)
+        built = False
+        with self._lock(path):
+            if self._intact(path):
+                self.hits += 1
+            else:
+                if os.path.exists(os.path.join(path, COMPLETE_FILE)):
+                    log.warning("Cached test environment was changed, building it again", path=path)
+                self.misses += 1
+                self._build(checkout, path)
+                built = True
+            started = time.monotonic()
+            link_tree(path, dest, replace=(path.encode(), os.path.abspath(dest).encode()))
+            _touch(path)
+        log.info("Test environment ready", key=key, cached=not built, copy_seconds=time.monotonic() - started)
+        if built:
+            self.evict(keep=path)
+        return dest
+
+    def size(self):
+        """Returns the disk usage of all environments in bytes."""
+        return sum(dir_size(path) for path in self._envs())
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used environments until the cache fits its disk budget.
+
+        Args:
+            keep (str): Environment never evicted, the one just built.
+        """
+        envs = sorted(self._envs(), key=_last_used)
+        sizes = {path: dir_size(path) for path in envs}
+        total = sum(sizes.values())
+        for path in envs:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            with self._lock(path):
+                log.info("Evicting test environment", path=path)
+                shutil.rmtree(path, onerror=handle_remove_readonly)
+            total -= sizes[path]
+
+    def _build(self, checkout, path):
+        log.info("Building test environment", path=path, files=[os.path.basename(f) for f in dependency_files(checkout)])
+        shutil.rmtree(path, onerror=handle_remove_readonly)
+        subprocess.run([self.python, '-m', 'venv', path], check=True, capture_output=True)
+        install = [env_python(path), '-m', 'pip', 'install', '--disable-pip-version-check', '--quiet']
+        packages = list(self.extra_packages)
+        for name in dependency_files(checkout):
+            if os.path.basename(name) == 'pyproject.toml':
+                packages += pyproject_dependencies(name)
+            else:
+                packages += ['-r', name]
+        try:
+            subprocess.run(install + packages, check=True, capture_output=True, text=True, cwd=checkout)
+        except subprocess.CalledProcessError as e:
+            shutil.rmtree(path, onerror=handle_remove_readonly)
+            log.error("Could not build test environment", path=path, output=e.stdout + e.stderr)
+            raise
+        manifest = {}
+        for file in _env_files(path):
+            st = os.stat(file)
+            # The copies share these files, so they must not write into them
+            os.chmod(file, stat.S_IMODE(st.st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            manifest[os.path.relpath(file, path)] = [st.st_size, st.st_mtime_ns]
+        with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+        open(os.path.join(path, COMPLETE_FILE), 'w').close()
+
+    def _intact(self, path):
+        if not os.path.exists(os.path.join(path, COMPLETE_FILE)):
+            return False
+        try:
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            for name, (size, mtime_ns) in manifest.items():
+                st = os.stat(os.path.join(path, name))
+                if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                    return False
+        except (OSError, ValueError):
+            return False
+        return True
+
+    @contextmanager
+    def _lock(self, path):
+        with self._locks_guard:
+            thread_lock = self._locks.setdefault(path, threading.Lock())
+        with thread_lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(path + '.lock', 'w') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _envs(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name))
+        ]
+
+
+def pyproject_dependencies(path):
+    """
+    Reads the dependencies of a pyproject.toml, with those of its test extras.
+
+    The project itself is not installed: its tests run from the checkout.
+
+    Args:
+        path (str): Path of the pyproject.toml.
+
+    Returns:
+        list: Requirement strings.
+    """
+    if tomllib is None:
+        log.warning("tomllib is not available, pyproject.toml dependencies not installed", path=path)
+        return []
+    with open(path, 'rb') as f:
+        project = tomllib.load(f).get('project', {})
+    dependencies = list(project.get('dependencies', []))
+    for extra in TEST_EXTRAS:
+        dependencies += project.get('optional-dependencies', {}).get(extra, [])
+    return dependencies
+
+
+def link_tree(src, dest, replace=None):
+    """
+    Copies a directory tree as hard links.
+
+    Files that cannot be linked, e.g. across file systems, are copied, and so are
+    the files of the bin directory and of WRITABLE_DIRS, writable in the copy.
+    Symbolic links are recreated as they are. Small files in the bin directory
+    containing replace[0] are written anew with it replaced by replace[1], so the
+    scripts of a copied virtualenv name the copy.
+
+    Args:
+        src (str): Directory to copy.
+        dest (str): Directory to create.
+        replace (tuple): (old, new) bytes replaced in the scripts.
+    """
+    scripts = bin_dir(src)
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        writable = root == scripts or os.path.basename(root) in WRITABLE_DIRS
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            copy = os.path.join(target, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), copy)
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in dirs or name in (COMPLETE_FILE, LAST_USED_FILE, MANIFEST_FILE):
+                continue
+            elif replace and root == scripts and os.path.getsize(source) < 1024 ** 2 and _contains(source, replace[0]):
+                with open(source, 'rb') as f:
+                    data = f.read().replace(*replace)
+                with open(copy, 'wb') as f:
+                    f.write(data)
+                _copy_mode_writable(source, copy)
+            elif writable:
+                shutil.copy2(source, copy)
+                _copy_mode_writable(source, copy)
+            else:
+                try:
+                    os.link(source, copy)
+                except OSError:
+                    shutil.copy2(source, copy)
+
+
+def _env_files(path):
+    """Yields the regular files of an environment, without the files the cache keeps in it."""
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file = os.path.join(root, name)
+            if not os.path.islink(file) and (root != path or name not in (COMPLETE_FILE, LAST_USED_FILE, MANIFEST_FILE)):
+                yield file
+
+
+def _copy_mode_writable(source, copy):
+    shutil.copymode(source, copy)
+    os.chmod(copy, stat.S_IMODE(os.stat(copy).st_mode) | stat.S_IWUSR)
+
+
+def _contains(path, data):
+    with open(path, 'rb') as f:
+        return data in f.read()
+
+
+def _touch(path):
+    with open(os.path.join(path, LAST_USED_FILE), 'w') as f:
+        f.write(str(time.time()))
+
+
+def _last_used(path):
+    try:
+        return os.path.getmtime(os.path.join(path, LAST_USED_FILE))
+    except OSError:
+        return 0
@@ -0,0 +1,293 @@
+import errno
+import os
+import shutil
+import socket
+import stat
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from metrics import dir_size
+from ci_logging import get_logger
+
+log = get_logger('workspace_pool')
+
+# Workspaces being deleted are renamed with this prefix first
+RETIRED_PREFIX = '.retired-'
+# Next to each workspace, names the host and process using it
+OWNER_SUFFIX = '.owner'
+
+
+class WorkspacePool:
+    """
+    Checkouts kept between builds, so the next build of a repository resets one
+    with git instead of cloning it again and deleting it afterwards.
+
+    A workspace is leased to a build by create or acquire and handed back with
+    release. Up to max_idle of them are kept, within max_bytes of disk; the others
+    are retired: renamed out of the way at once and deleted by a background
+    thread, so removing a large checkout never holds up a build.
+
+    Every workspace has an owner file naming the process using it. reap_leaked
+    retires the workspaces whose process is gone, left behind by crashed builds
+    or servers. Run with startup=True before the first build, it also retires
+    the workspaces naming this process, which no build of it can be using yet.
+    """
+
+    def __init__(self, root, max_idle=4, max_bytes=5 * 1024 ** 3, leak_seconds=3600, on_retire=None):
+        """
+        Args:
+            root (str): Directory holding the workspaces.
+            max_idle (int): Workspaces kept for the next builds, 0 to always retire them.
+            max_bytes (int): Disk budget of the idle workspaces in bytes.
+            leak_seconds (float): Age after which a workspace without an owner file
+                is considered leaked, and how often release looks for leaks.
+            on_retire: Callable given the path of each retired workspace, e.g. to
+                release the mirror it borrows objects from.
+        """
+        self.root = os.path.abspath(root)
+        self.max_idle = max_idle
+        self.max_bytes = max_bytes
+        self.leak_seconds = leak_seconds
+        self.on_retire = on_retire
+        self.reused = 0
+        self.created = 0
+        self._owner = f"{socket.gethostname()} {os.getpid()}"
+        self._idle = OrderedDict()
+        self._leased = {}
+        self._retiring = []
+        self._pending = 0
+        self._last_scan = time.monotonic()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._reaper = None
+
+    def create(self, repo_url):
+        """
+        Creates an empty workspace for a repository and leases it.
+
+        Args:
+            repo_url (str): Repository that will be checked out into it.
+
+        Returns:
+            str: Path of the new directory.
+        """
+        os.makedirs(self.root, mode=0o755, exist_ok=True)
+        path = os.path.join(self.root, str(uuid.uuid4()))
+        with self._lock:
+            self._leased[path] = repo_url
+            self.created += 1
+        with open(path + OWNER_SUFFIX, 'w') as f:
+            f.write(self._owner)
+        os.makedirs(path, mode=0o755)
+        return path
+
+    def acquire(self, repo_url):
+        """
+        Leases the most recently used idle workspace of a repository.
+
+        Args:
+            repo_url (str): URL of the repository.
+
+        Returns:
+            str: Path of the workspace, still holding the checkout of an earlier
+                build, or None if there is none.
+        """
+        with self._lock:
+            for path in reversed(self._idle):
+                if self._idle[path][0] == repo_url:
+                    del self._idle[path]
+                    self._leased[path] = repo_url
+                    self.reused += 1
+                    return path
+        return None
+
+    def release(self, path, reusable=True):
+        """
+        Hands back a leased workspace.
+
+        It is kept for the next build of its repository if there is room, and
+        retired otherwise. Paths the pool does not know are retired.
+
+        Args:
+            path (str): Workspace returned by create or acquire.
+            reusable (bool): False if the checkout is broken and must not be reset.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            repo_url = self._leased.pop(path, None)
+        if repo_url is not None and reusable and self.max_idle > 0 and os.path.isdir(path):
+            size = dir_size(path)
+            with self._lock:
+                self._idle[path] = (repo_url, size)
+                evicted = []
+                total = sum(size for _, size in self._idle.values())
+                while self._idle and (len(self._idle) > self.max_idle or total > self.max_bytes):
+                    old_path, (_, old_size) = self._idle.popitem(last=False)
+                    evicted.append(old_path)
+                    total -= old_size
+            for old_path in evicted:
+                self.retire(old_path)
+        else:
+            self.retire(path)
+        if time.monotonic() - self._last_scan >= self.leak_seconds:
+            self.reap_leaked()
+
+    def retire(self, path):
+        """
+        Deletes a workspace in the background.
+
+        The directory is renamed first, so its path is free again right away.
+
+        Args:
+            path (str): Path of the workspace.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._leased.pop(path, None)
+            self._idle.pop(path, None)
+        if self.on_retire is not None:
+            self.on_retire(path)
+        target = os.path.join(os.path.dirname(path), RETIRED_PREFIX + os.path.basename(path))
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            target = None
+        except OSError as e:
+            log.warning("Could not rename workspace, deleting it in place", path=path, error=str(e))
+            target = path
+        _remove(path + OWNER_SUFFIX)
+        if target is not None:
+            self._schedule(target)
+
+    def reap_leaked(self, startup=False):
+        """
+        Retires the workspaces of processes that are gone, and finishes deleting
+        the ones a previous process retired.
+
+        Args:
+            startup (bool): True for the scan before this process made any
+                workspace. Only then are the workspaces naming this process id
+                leaked, left by a crashed process whose id was given to this one,
+                as happens to the first process of a container.
+
+        Returns:
+            list: Paths of the leaked workspaces.
+        """
+        self._last_scan = time.monotonic()
+        if not os.path.isdir(self.root):
+            return []
+        with self._lock:
+            known = set(self._idle) | set(self._leased) | set(self._retiring)
+        candidates = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path in known or not os.path.isdir(path):
+                continue
+            if name.startswith(RETIRED_PREFIX):
+                self._schedule(path)
+            elif self._is_leaked(path, startup):
+                candidates.append(path)
+        leaked = []
+        for path in candidates:
+            with self._lock:
+                # Made by create since the scan started
+                if path in self._leased or path in self._idle:
+                    continue
+            log.warning("Retiring leaked workspace", path=path)
+            self.retire(path)
+            leaked.append(path)
+        return leaked
+
+    def drain(self, timeout=None):
+        """
+        Waits until the retired workspaces are deleted.
+
+        Returns:
+            bool: False if some are still being deleted after timeout seconds.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def counts(self):
+        """Returns the number of workspaces by state: idle, leased and retiring."""
+        with self._lock:
+            return {'idle': len(self._idle), 'leased': len(self._leased), 'retiring': self._pending}
+
+    def _is_leaked(self, path, startup=False):
+        try:
+            with open(path + OWNER_SUFFIX) as f:
+                host, _, pid = f.read().partition(' ')
+            pid = int(pid)
+        except (OSError, ValueError):
+            # Made before workspaces had owners, its owner file was removed, or it is
+            # empty or cut short because its process died while writing it
+            return time.time() - os.path.getmtime(path) > self.leak_seconds
+        if host != socket.gethostname():
+            return False
+        if pid == os.getpid():
+            return startup
+        return not _pid_alive(pid)
+
+    def _schedule(self, path):
+        with self._cond:
+            if path in self._retiring:
+                return
+            self._retiring.append(path)
+            self._pending += 1
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._reap, name='workspace-reaper', daemon=True)
+                self._reaper.start()
+            self._cond.notify_all()
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self._retiring, timeout=60):
+                    self._reaper = None
+                    return
+                path = self._retiring[0]
+            shutil.rmtree(path, onerror=handle_remove_readonly)
+            with self._cond:
+                self._retiring.remove(path)
+                self._pending -= 1
+                self._cond.notify_all()
+
+
+def handle_remove_readonly(func, path, exc):
+    """
+    Handles removal of read-only files by modifying permissions.
+
+    Args:
+        func: Function that triggered the error
+        path: File path causing the issue
+        exc: Exception details
+    """
+    # Change permissions to writeable if needed
+    excvalue = exc[1]
+    if func in (os.rmdir, os.remove, os.unlink) and excvalue.errno == errno.EACCES:
+        # Ensure the item is writeable
+        os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        func(path)  # Retry the removal
+    elif not isinstance(excvalue, FileNotFoundError):
+        log.warning("Could not remove", path=path, error=str(excvalue))
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,126 @@
+"""
+Throughput of concurrent build history writers and readers.
+
+Runs writer threads logging builds against reader threads listing pages of the
+build history, once with a new rollback-journal connection per call (how
+build_history worked before BuildHistoryStore) and once with the pooled WAL store.
+
+Usage: python src/benchmarks/bench_build_history.py [--writers 4] [--readers 8] [--seconds 5]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+import build_history  # noqa: E402
+
+logger = logging.getLogger('ci.build_history')
+logger.propagate = False
+
+
+class PerCallStore:
+    """Opens a new connection with the default rollback journal for every call."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    @contextmanager
+    def connection(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class ErrorCounter(logging.Handler):
+    """Counts the 'database is locked' errors build_history logs."""
+
+    def __init__(self):
+        super().__init__()
+        self.locked = 0
+
+    def emit(self, record):
+        if 'database is locked' in str(getattr(record, 'error', '')):
+            self.locked += 1
+
+
+def run(store, writers, readers, seconds):
+    build_history.store = store
+    build_history.create_database()
+    for i in range(1000):
+        build_history.log_build(f"{i:040x}", "seed logs " * 50)
+
+    stop = time.perf_counter() + seconds
+    counts = {'write': [], 'read': []}
+
+    def writer():
+        latencies = []
+        i = 0
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            build_id = build_history.create_build(f"{i:040x}")
+            build_history.log_build(f"{i:040x}", "test output\n" * 100, build_id=build_id)
+            latencies.append(time.perf_counter() - started)
+            i += 1
+        counts['write'].extend(latencies)
+
+    def reader():
+        latencies = []
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            page = build_history.get_logs(limit=50, descending=True)
+            if page:
+                build_history.get_log(page[0][0])
+            latencies.append(time.perf_counter() - started)
+        counts['read'].extend(latencies)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def p95(latencies):
+    return sorted(latencies)[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.readers} readers, {args.seconds:.0f}s per run")
+    print(f"{'store':>10} {'writes/s':>10} {'p95 ms':>8} {'reads/s':>10} {'p95 ms':>8} {'locked':>7}")
+    with tempfile.TemporaryDirectory(prefix='bench-history-') as root:
+        stores = {
+            'per-call': PerCallStore(os.path.join(root, 'per_call.db')),
+            'pooled': build_history.BuildHistoryStore(os.path.join(root, 'pooled.db')),
+        }
+        for name, store in stores.items():
+            errors = ErrorCounter()
+            logger.addHandler(errors)
+            try:
+                counts = run(store, args.writers, args.readers, args.seconds)
+            finally:
+                logger.removeHandler(errors)
+            writes, reads = counts['write'], counts['read']
+            print(f"{name:>10} {len(writes) / args.seconds:>10.0f} {p95(writes):>8.1f} "
+                  f"{len(reads) / args.seconds:>10.0f} {p95(reads):>8.1f} {errors.locked:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Per-build pylint latency with and without the warm lint workers of lint_worker.
+
+Generates a synthetic repository and simulates builds that each rewrite a few
+files and lint the whole checkout, with the lint cache off. Cold builds start
+pylint afresh as syntax_check did before the service: a new process pool when
+sharded, a new linter otherwise. Warm builds send the files to a LintService
+started once, as the server does.
+
+Usage: python src/benchmarks/bench_lint_service.py [--files 300] [--builds 5] [--jobs 4]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+import syntax_check  # noqa: E402
+from bench_syntax_check import make_repo  # noqa: E402
+
+
+def push(files, build):
+    """Rewrites a few files in place, as a reset workspace would, one of them with an undefined name."""
+    for path in files[build % len(files)::max(1, len(files) // 3)][:3]:
+        with open(path, 'a') as f:
+            f.write(f"\n\ndef added_{build}():\n    return undefined_{build}\n")
+
+
+def time_builds(files, builds, jobs, offset):
+    seconds = []
+    for build in range(builds):
+        push(files, offset + build)
+        started = time.perf_counter()
+        messages = syntax_check.lint_files(files, checks=syntax_check.PYLINT_CHECKS, cache=None, jobs=jobs)
+        seconds.append(time.perf_counter() - started)
+        assert len({m['message'] for m in messages}) == offset + build + 1, "stale lint results"
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--builds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=syntax_check.resolve_jobs())
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-lint-service-')
+    service = syntax_check.lint_service
+    service.workers = args.jobs
+    try:
+        files = sorted(make_repo(root, args.files))
+        print(f"{len(files)} files, {args.builds} builds, {args.jobs} jobs")
+        cold = time_builds(files, args.builds, args.jobs, 0)
+
+        started = time.perf_counter()
+        service.start()
+        # Waits for the workers to be spawned and warmed up, which the server does once at startup
+        service.lint([[files[0]]] * args.jobs, syntax_check.PYLINT_CHECKS)
+        startup = time.perf_counter() - started
+        warm = time_builds(files, args.builds, args.jobs, args.builds)
+    finally:
+        service.stop()
+        shutil.rmtree(root)
+
+    print(f"{'':>6} {'first':>8} {'median':>8} {'max':>8}  (seconds per build)")
+    for name, seconds in (('cold', cold), ('warm', warm)):
+        print(f"{name:>6} {seconds[0]:>8.2f} {statistics.median(seconds):>8.2f} {max(seconds):>8.2f}")
+    print(f"warm workers started once in {startup:.2f}s, "
+          f"builds {statistics.median(cold) / statistics.median(warm):.2f}x faster")
+
+
+if __name__ == '__main__':
+    main()
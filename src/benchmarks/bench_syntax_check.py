@@ -0,0 +1,84 @@
+"""
+Wall-clock scaling of the sharded pylint run in syntax_check.
+
+Generates a synthetic repository and lints it with an increasing number of
+worker processes, with the lint cache off.
+
+Usage: python src/benchmarks/bench_syntax_check.py [--files 5000] [--jobs 1 2 4 8]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from syntax_check import lint_files  # noqa: E402
+
+MODULE_TEMPLATE = '''import os
+from collections import defaultdict
+
+
+class Model{i}:
+    """Synthetic class {i}."""
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.index = defaultdict(list)
+
+    def build(self):
+        for position, value in enumerate(self.values):
+            self.index[value % 7].append(position)
+        return self.index
+
+    def total(self):
+        return sum(value * {i} for value in self.values)
+
+
+def helper_{i}(path):
+    if os.path.exists(path):
+        return Model{i}(range(len(path))).total()
+    return 0
+'''
+
+
+def make_repo(root, count):
+    """Writes count modules spread over packages of 100 files each."""
+    for i in range(count):
+        package = os.path.join(root, 'src', f'pkg{i // 100}')
+        os.makedirs(package, exist_ok=True)
+        with open(os.path.join(package, f'module{i}.py'), 'w') as f:
+            f.write(MODULE_TEMPLATE.format(i=i))
+    return [
+        os.path.join(dirpath, name)
+        for dirpath, _, names in os.walk(root) for name in names if name.endswith('.py')
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        default=sorted({1, 2, 4, 8, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-syntax-')
+    try:
+        files = make_repo(root, args.files)
+        print(f"{len(files)} files, {os.cpu_count()} CPUs")
+        print(f"{'jobs':>6} {'seconds':>10} {'speedup':>8}")
+        baseline = None
+        for jobs in args.jobs:
+            started = time.perf_counter()
+            messages = lint_files(files, cache=None, jobs=jobs)
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            print(f"{jobs:>6} {elapsed:>10.2f} {baseline / elapsed:>7.2f}x  ({len(messages)} messages)")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Space saved by storing build logs compressed in log_blobs.
+
+Copies a build history database, moves its inline logs into log_blobs the way
+create_database does, and compares the file sizes after a VACUUM. The original
+database is not modified. With --synthetic, an empty database in the old inline
+schema is filled with that many builds carrying pytest-like logs instead.
+
+Usage: python src/benchmarks/report_log_storage.py [--db build_history.db] [--synthetic 2000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+import build_history  # noqa: E402
+
+
+def fake_logs(rng):
+    """Syntax check and pytest output shaped like what run_pipeline records."""
+    lines = ["Syntax Check Logs: {} ", "Test Logs: ============================= test session starts ============================="]
+    files = rng.randint(5, 40)
+    for i in range(files):
+        results = ''.join(rng.choice('....F.s') for _ in range(rng.randint(1, 30)))
+        lines.append(f"src/test/test_module_{i}.py {results}")
+    if rng.random() < 0.3:
+        lines.append("=================================== FAILURES ===================================")
+        lines.extend(f"E       assert {rng.randint(0, 99)} == {rng.randint(0, 99)}" for _ in range(rng.randint(1, 20)))
+    lines.append(f"======================== {rng.randint(10, 900)} passed in {rng.uniform(1, 90):.2f}s ========================")
+    return '\n'.join(lines)
+
+
+def fill_inline(path, count):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS builds (
+            id INTEGER PRIMARY KEY, commit_id TEXT, build_date TEXT,
+            build_logs TEXT, github_commit_url TEXT, status TEXT
+        )
+    ''')
+    rng = random.Random(0)
+    conn.executemany(
+        "INSERT INTO builds (commit_id, build_date, build_logs, github_commit_url, status) VALUES (?, ?, ?, ?, ?)",
+        [(f"{rng.getrandbits(160):040x}", "2025-01-01 00:00:00", fake_logs(rng), "", "success") for _ in range(count)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def vacuumed_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='build_history.db')
+    parser.add_argument('--synthetic', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='log-storage-') as root:
+        path = os.path.join(root, 'build_history.db')
+        if args.synthetic:
+            fill_inline(path, args.synthetic)
+        elif os.path.exists(args.db):
+            shutil.copy(args.db, path)
+
+        conn = sqlite3.connect(path)
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(builds)")]
+        inline_rows, inline_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(build_logs AS BLOB))), 0) FROM builds WHERE build_logs IS NOT NULL"
+        ).fetchone() if 'build_logs' in columns else (0, 0)
+        conn.close()
+        before = vacuumed_size(path)
+
+        build_history.store = build_history.BuildHistoryStore(path)
+        build_history.create_database()
+        build_history.store.close()
+
+        conn = sqlite3.connect(path)
+        blobs, raw, stored, codecs = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0), GROUP_CONCAT(DISTINCT codec) FROM log_blobs"
+        ).fetchone()
+        conn.close()
+        after = vacuumed_size(path)
+
+    print(f"database: {f'{args.synthetic} synthetic builds' if args.synthetic else args.db}")
+    print(f"builds with inline logs: {inline_rows} ({inline_bytes} bytes)")
+    print(f"log blobs: {blobs} ({raw} bytes of text, {stored} bytes stored, codec {codecs or '-'})")
+    if raw:
+        print(f"compression ratio: {raw / stored:.1f}x")
+    print(f"file size after VACUUM: {before} -> {after} bytes ({(after / before - 1) * 100 if before else 0:+.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
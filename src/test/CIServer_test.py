@@ -19,7 +19,7 @@ sys.path.extend([
 from app.CIServer import run_server
 from app.clone import clone_check
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from app.CIServer import SimpleHandler
+from app.CIServer import SimpleHandler, build_queue
 
 port = 8009
 
@@ -64,8 +64,10 @@ def test_do_POST_success(start_server):
             patch('app.CIServer.remove_temp_folder'):
 
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 200
-        mock_send_commit_status.assert_called_with("success", "Tests passed", "commit_sha", "1")
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "success"
+        mock_send_commit_status.assert_called_with("success", "Tests passed", "commit_sha", str(build_id))
 
 def test_do_POST_clone_check_failure(start_server):
     """Test the do_POST method for a failure flow in clone_check"""
@@ -85,8 +87,10 @@ def test_do_POST_clone_check_failure(start_server):
             patch('app.CIServer.GithubNotification.send_commit_status') as mock_send_commit_status:
 
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 500
-        mock_send_commit_status.assert_called_with("failure", "Tests failed", "commit_sha", "1")
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "failure"
+        mock_send_commit_status.assert_called_with("failure", "Tests failed", "commit_sha", str(build_id))
 
 
 
@@ -186,10 +190,12 @@ def test_set_commit_status_success(start_server):
          patch('app.CIServer.remove_temp_folder'):
 
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 200
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "success"
         
         # Verify if the send_commit_status function was called with 'success' status
-        mock_send_commit_status.assert_called_with("success", "Tests passed", "commit_sha", "1")
+        mock_send_commit_status.assert_called_with("success", "Tests passed", "commit_sha", str(build_id))
 
 def test_set_commit_status_test_failure(start_server):
     """Test setting commit status to 'failure' after failing tests"""
@@ -223,10 +229,12 @@ def test_set_commit_status_test_failure(start_server):
          patch('app.CIServer.remove_temp_folder'):
 
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 500
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "failure"
         
         # Verify if the send_commit_status function was called with 'failure' status due to test failure
-        mock_send_commit_status.assert_called_with("failure", "Tests failed", "commit_sha", "1")
+        mock_send_commit_status.assert_called_with("failure", "Tests failed", "commit_sha", str(build_id))
 
 def test_notification_both_success(start_server):
     payload = {
@@ -258,7 +266,8 @@ def test_notification_both_success(start_server):
          patch('app.CIServer.remove_temp_folder'):
         
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 200
+        assert response.status_code == 202
+        assert build_queue.wait(response.json()["build_id"], timeout=10)["status"] == "success"
         
         calls = mock_send_status.call_args_list
         assert len(calls) == 2
@@ -295,9 +304,11 @@ def test_notification_syntax_failure(start_server):
          patch('app.CIServer.remove_temp_folder'):
         
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 500
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "failure"
         
-        mock_send_status.assert_called_with("failure", "Syntax check failed", "commit_sha", "1")
+        mock_send_status.assert_called_with("failure", "Syntax check failed", "commit_sha", str(build_id))
         assert mock_send_status.call_count == 1
 
 def test_notification_network_error(start_server):
@@ -331,7 +342,8 @@ def test_notification_network_error(start_server):
         
         try:
             response = requests.post(f"http://localhost:{port}/", json=payload)
-            assert response.status_code == 500
+            assert response.status_code == 202
+            assert build_queue.wait(response.json()["build_id"], timeout=10)["status"] == "failure"
         except requests.exceptions.ConnectionError:
             pytest.fail("Server connection failed")
 
@@ -352,5 +364,313 @@ def test_notification_invalid_repo(start_server):
          patch('app.CIServer.GithubNotification.send_commit_status') as mock_send_status:
         
         response = requests.post(f"http://localhost:{port}/", json=payload)
-        assert response.status_code == 500
-        mock_send_status.assert_called_with("failure", "Tests failed", "commit_sha", "1")
\ No newline at end of file
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.wait(build_id, timeout=10)["status"] == "failure"
+        mock_send_status.assert_called_with("failure", "Tests failed", "commit_sha", str(build_id))
+
+def test_do_POST_invalid_payload(start_server):
+    """Test that a payload without the push fields is rejected without queueing a build"""
+    with patch('app.CIServer.build_queue.enqueue') as mock_enqueue:
+        response = requests.post(f"http://localhost:{port}/", json={"zen": "Keep it logically awesome."})
+        assert response.status_code == 400
+        assert response.json()["status"] == "error"
+        mock_enqueue.assert_not_called()
+
+def test_do_POST_replies_before_build_finishes(start_server):
+    """Test that the webhook is answered while the build is still running"""
+    payload = {
+        "repository": {
+            "clone_url": "https://github.com/DD2480Group8/DD2480-CI.git",
+            "name": "DD2480-CI"
+        },
+        "ref": "refs/heads/main",
+        "organization": {
+            "login": "DD2480Group8"
+        },
+        "after": "commit_sha"
+    }
+    release = threading.Event()
+
+    def slow_clone(*args):
+        release.wait(10)
+        raise Exception("Clone failed")
+
+    with patch('app.CIServer.clone_check', side_effect=slow_clone), \
+         patch('app.CIServer.GithubNotification.send_commit_status'):
+        response = requests.post(f"http://localhost:{port}/", json=payload, timeout=5)
+        assert response.status_code == 202
+        build_id = response.json()["build_id"]
+        assert build_queue.get(build_id)["status"] in ("queued", "running")
+        release.set()
+        assert build_queue.wait(build_id, timeout=10)["status"] == "failure"
+
+@pytest.fixture
+def threaded_server():
+    with patch('app.CIServer.config.LINT_SERVICE_ENABLED', False):
+        server = run_server(8010, mode='threaded', max_workers=4, max_in_flight=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def test_threaded_server_serves_requests_concurrently(threaded_server):
+    """Test that a slow request does not block other clients in threaded mode"""
+    def slow_get_log(*args):
+        time.sleep(2)
+        return None
+
+    with patch('app.CIServer.get_log', side_effect=slow_get_log), \
+         patch('app.CIServer.get_logs', return_value=[]):
+        slow = threading.Thread(target=requests.get, args=("http://localhost:8010/1",))
+        slow.start()
+        time.sleep(0.2)
+        started = time.monotonic()
+        response = requests.get("http://localhost:8010/")
+        elapsed = time.monotonic() - started
+        slow.join()
+
+    assert response.status_code == 200
+    assert response.json() == []
+    assert elapsed < 1
+
+def test_threaded_server_keeps_connections_alive(threaded_server):
+    """Test that several requests can be sent over one connection in threaded mode"""
+    import http.client
+    with patch('app.CIServer.get_logs', return_value=[]):
+        conn = http.client.HTTPConnection("localhost", 8010)
+        for _ in range(3):
+            conn.request("GET", "/")
+            response = conn.getresponse()
+            assert response.status == 200
+            assert response.read() == b"[]"
+        conn.close()
+
+def test_threaded_server_rejects_requests_over_cap(threaded_server):
+    """Test that requests beyond max_in_flight get a 503"""
+    def slow_get_log(*args):
+        time.sleep(1)
+        return None
+
+    with patch('app.CIServer.get_log', side_effect=slow_get_log):
+        slow = [threading.Thread(target=requests.get, args=(f"http://localhost:8010/{i}",)) for i in range(2)]
+        for thread in slow:
+            thread.start()
+        time.sleep(0.2)
+        response = requests.get("http://localhost:8010/")
+        for thread in slow:
+            thread.join()
+    assert response.status_code == 503
+
+def test_idle_keep_alive_connections_do_not_hold_workers():
+    """Test that a request is answered at once while more idle keep-alive connections than workers are open"""
+    import http.client
+    from app.CIServer import PooledHTTPServer, KeepAliveHandler
+    server = PooledHTTPServer(('localhost', 0), KeepAliveHandler, max_workers=2, max_in_flight=8)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = f"http://localhost:{server.server_address[1]}/"
+    try:
+        with patch('app.CIServer.get_logs', return_value=[]):
+            idle = [http.client.HTTPConnection("localhost", server.server_address[1]) for _ in range(4)]
+            for conn in idle:
+                conn.request("GET", "/")
+                assert conn.getresponse().read() == b"[]"
+
+            started = time.monotonic()
+            response = requests.post(url, data=b"not json", timeout=5)
+            assert response.status_code == 400
+            assert time.monotonic() - started < 1
+
+            # The idle connections are served again once they send their next request
+            for conn in idle:
+                conn.request("GET", "/")
+                assert conn.getresponse().read() == b"[]"
+                conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_idle_keep_alive_connections_are_closed_after_timeout():
+    """Test that a keep-alive connection without a new request is closed once idle for the handler's timeout"""
+    import socket
+    from app.CIServer import PooledHTTPServer, KeepAliveHandler
+
+    class QuickHandler(KeepAliveHandler):
+        timeout = 0.3
+
+    server = PooledHTTPServer(('localhost', 0), QuickHandler, max_workers=1, max_in_flight=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        sock = socket.create_connection(server.server_address)
+        sock.settimeout(5)
+        sock.sendall(b"GET /nowhere HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        started = time.monotonic()
+        received = b""
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            received += data
+        assert received.startswith(b"HTTP/1.1 404")
+        assert 0.2 < time.monotonic() - started < 3
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_get_build_log(threaded_server, tmp_path):
+    """Test that a build log is served from disk, and followed while it is written"""
+    from app.CIServer import BuildLog, config
+    from app.build_history import create_build
+    build_id = create_build("commit_sha")
+    with patch.object(config, 'BUILD_LOG_PATH', str(tmp_path)), \
+         patch.object(config, 'LOG_FOLLOW_POLL_SECONDS', 0.05):
+        assert requests.get(f"http://localhost:8010/{build_id}/log").status_code == 404
+
+        log = BuildLog(str(tmp_path), build_id, max_bytes=10000, chunk_bytes=16)
+        log.write("first line of output\n")
+        response = requests.get(f"http://localhost:8010/{build_id}/log")
+        assert response.status_code == 200
+        assert response.text == "first line of output\n"
+
+        followed = {}
+        def follow():
+            followed['response'] = requests.get(f"http://localhost:8010/{build_id}/log?follow=1", timeout=10)
+        follower = threading.Thread(target=follow)
+        follower.start()
+        time.sleep(0.3)
+        log.write("second line\n")
+        log.close()
+        follower.join()
+
+    assert followed['response'].headers['Transfer-Encoding'] == 'chunked'
+    assert followed['response'].text == "first line of output\nsecond line\n"
+
+def test_follow_build_log_refused_in_single_mode(start_server, tmp_path):
+    """Test that following a log is refused when the server serves one request at a time"""
+    from app.CIServer import BuildLog, config
+    from app.build_history import create_build
+    build_id = create_build("commit_sha")
+    with patch.object(config, 'BUILD_LOG_PATH', str(tmp_path)):
+        log = BuildLog(str(tmp_path), build_id, max_bytes=10000, chunk_bytes=16)
+        log.write("still running\n")
+        response = requests.get(f"http://localhost:{port}/{build_id}/log?follow=1", timeout=5)
+        assert response.status_code == 400
+        assert requests.get(f"http://localhost:{port}/{build_id}/log", timeout=5).text == "still running\n"
+        log.close()
+
+def test_requests_are_logged_through_structured_logging(start_server, capsys):
+    """Test that answered requests are structured records instead of lines on stderr"""
+    import io, logging
+    from app.ci_logging import setup_logging, flush_logging
+    output = io.StringIO()
+    setup_logging('INFO', 'json', output)
+    try:
+        requests.get(f"http://localhost:{port}/does-not-exist", timeout=5)
+        flush_logging()
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+    finally:
+        flush_logging()
+        logging.getLogger('ci').handlers = []
+    (record,) = [r for r in records if r["logger"] == "ci.http"]
+    assert record["msg"] == "Request" and record["level"] == "INFO"
+    assert record["method"] == "GET" and record["path"] == "/does-not-exist" and record["status"] == 404
+    assert capsys.readouterr().err == ""
+
+def test_get_builds_paginated(start_server):
+    """Test that GET / returns pages of build summaries with a link to the next page"""
+    from app.build_history import log_build
+    import uuid
+    prefix = uuid.uuid4().hex[:12]
+    for i in range(3):
+        log_build(f"{prefix}{i:028x}", "long logs", status="success")
+
+    response = requests.get(f"http://localhost:{port}/?commit={prefix}&limit=2")
+    assert response.status_code == 200
+    builds = response.json()
+    assert len(builds) == 2 and "build_logs" not in builds[0]
+    assert response.links["next"]["url"].endswith(f"after_id={builds[-1]['id']}")
+
+    response = requests.get(f"http://localhost:{port}{response.links['next']['url']}")
+    assert len(response.json()) == 1 and "next" not in response.links
+
+    response = requests.get(f"http://localhost:{port}/?commit={prefix}&fields=id,build_logs&order=desc")
+    assert [build["build_logs"] for build in response.json()] == ["long logs"] * 3
+
+    assert requests.get(f"http://localhost:{port}/?limit=0").status_code == 400
+    assert requests.get(f"http://localhost:{port}/?fields=password").status_code == 400
+
+def test_get_builds_cached(start_server):
+    """Test that polls are answered from the cache with 304s until a build is written"""
+    from app.CIServer import log_build  # bumps the history version the server reads
+    import uuid
+    prefix = uuid.uuid4().hex[:12]
+    log_build(f"{prefix}{0:028x}", "logs " * 500, status="success")
+    url = f"http://localhost:{port}/?commit={prefix}&fields=id,build_logs"
+
+    first = requests.get(url)
+    assert first.status_code == 200 and first.headers["Content-Encoding"] == "gzip"
+    assert first.json()[0]["build_logs"] == "logs " * 500
+    etag = first.headers["ETag"]
+
+    with patch('app.CIServer.get_logs', side_effect=AssertionError("should be cached")):
+        again = requests.get(url, headers={"If-None-Match": etag})
+        assert again.status_code == 304 and again.headers["ETag"] == etag and again.content == b""
+        since = requests.get(url, headers={"If-Modified-Since": first.headers["Last-Modified"]})
+        assert since.status_code == 304
+        plain = requests.get(url, headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in plain.headers and plain.json() == first.json()
+
+    log_build(f"{prefix}{1:028x}", "new logs", status="success")
+    changed = requests.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert len(changed.json()) == 2
+
+def test_cancelled_build_stops_after_stage(tmp_path):
+    """Test that a superseded build stops after the current stage and removes its checkout"""
+    from app.CIServer import process_build, BuildCancelled, config
+    payload = {
+        "repository": {"clone_url": "https://github.com/DD2480Group8/DD2480-CI.git", "name": "DD2480-CI"},
+        "ref": "refs/heads/main",
+        "organization": {"login": "DD2480Group8"},
+        "after": "commit_sha"
+    }
+    cancel = threading.Event()
+    cancel.set()
+    with patch.object(config, 'BUILD_LOG_PATH', str(tmp_path)), \
+         patch('app.CIServer.build_queue.cancel_event', return_value=cancel), \
+         patch('app.CIServer.clone_check', return_value=('commit_id_value', '/tmp/repo_path')), \
+         patch('app.CIServer.syntax_check') as mock_syntax_check, \
+         patch('app.CIServer.log_build') as mock_log_build, \
+         patch('app.CIServer.remove_temp_folder') as mock_remove:
+        with pytest.raises(BuildCancelled):
+            process_build(123, payload)
+    mock_syntax_check.assert_not_called()
+    mock_remove.assert_called_once_with('/tmp/repo_path')
+    assert mock_log_build.call_args.kwargs == {"build_id": 123, "status": "cancelled"}
+
+def test_metrics_endpoint(start_server):
+    """Test that GET /metrics exposes the latency histograms and the gauges"""
+    requests.post(f"http://localhost:{port}/", data="not json")
+    response = requests.get(f"http://localhost:{port}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-type"].startswith("text/plain")
+    text = response.text
+    assert "# TYPE ci_webhook_seconds histogram" in text
+    assert 'ci_webhook_seconds_bucket{le="+Inf"}' in text
+    assert "ci_db_query_seconds_count" in text
+    for gauge in ("ci_build_queue_depth", "ci_builds_in_flight", "ci_github_outbox_depth"):
+        assert f"\n{gauge} " in text
+    # Disk usage is measured in the background, and shows up once the first sample is taken
+    deadline = time.monotonic() + 10
+    while "\nci_tmp_dir_bytes " not in text:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+        text = requests.get(f"http://localhost:{port}/metrics").text
+    assert 'ci_cache_requests_total{cache="response",result="miss"}' in text
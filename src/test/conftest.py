@@ -0,0 +1,34 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+import pytest
+
+# The app modules import each other by their plain names, as they do when the
+# server is started from src/app, so both src and src/app have to be importable.
+sys.path.extend([
+    str(Path(__file__).parent.parent),
+    str(Path(__file__).parent.parent / 'app')
+])
+
+# The database, logs, workspaces and caches of the app go to a directory of the
+# test session, so a run leaves nothing in the tree and sees nothing of an earlier
+# one. Set before the tests import the app, whose module-level instances open them.
+SESSION_ROOT = tempfile.mkdtemp(prefix='ci-tests-')
+for name, path in (('CI_DB_PATH', 'build_history.db'), ('CI_BUILD_LOG_PATH', 'logs'), ('CI_TMP_PATH', 'tmp'),
+                   ('CI_MIRROR_CACHE_PATH', os.path.join('cache', 'mirrors')),
+                   ('CI_VENV_CACHE_PATH', os.path.join('cache', 'envs'))):
+    os.environ[name] = os.path.join(SESSION_ROOT, path)
+
+import config  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def build_log_path(tmp_path, monkeypatch):
+    """Builds run by a test write their logs under its own tmp_path"""
+    monkeypatch.setattr(config, 'BUILD_LOG_PATH', str(tmp_path / 'logs'))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(SESSION_ROOT, ignore_errors=True)
@@ -1,6 +1,11 @@
 import pytest
 import sqlite3
-from app.build_history import create_database, get_github_commit_url, log_build
+import config
+import threading
+import uuid
+from app.build_history import (create_database, get_github_commit_url, log_build, get_logs, get_log, BuildHistoryStore,
+                               SUMMARY_FIELDS, create_build, set_build_status, record_stage, log_test_outcomes,
+                               get_test_outcomes, log_lint_messages, get_lint_messages, get_failure_rates)
 
 @pytest.fixture(scope="module")
 def setup_db():
@@ -8,7 +13,7 @@ def setup_db():
     create_database('test_builds')  
     yield
     # Cleanup after tests
-    conn = sqlite3.connect('build_history.db')
+    conn = sqlite3.connect(config.DB_PATH)
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS test_builds")
     conn.commit()
@@ -16,7 +21,7 @@ def setup_db():
 
 def test_create_database(setup_db):
     """Test if the 'test_builds' table is created in the database."""
-    conn = sqlite3.connect('build_history.db')
+    conn = sqlite3.connect(config.DB_PATH)
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     tables = cursor.fetchall()
@@ -36,7 +41,7 @@ def test_log_build(setup_db):
     build_logs = "Test passed"
     
     log_build(commit_id, build_logs, 'test_builds')
-    conn = sqlite3.connect('build_history.db')
+    conn = sqlite3.connect(config.DB_PATH)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM test_builds WHERE commit_id = ?", (commit_id,))
     result = cursor.fetchone()
@@ -44,4 +49,135 @@ def test_log_build(setup_db):
 
     assert result is not None, "The build should be logged in the database."
     assert result[1] == commit_id, f"Expected commit_id {commit_id}, got {result[1]}"
-    assert result[2] == build_logs or "No logs available", f"Expected logs '{build_logs}', got '{result[2]}'"
\ No newline at end of file
+    assert result[2] == build_logs or "No logs available", f"Expected logs '{build_logs}', got '{result[2]}'"
+
+def test_get_logs_pages_and_filters(setup_db):
+    """Test keyset pagination, filters and the summary projection of get_logs."""
+    create_database()
+    prefix = uuid.uuid4().hex[:12]
+    for i, status in enumerate(["success", "failure", "success", "success"]):
+        log_build(f"{prefix}{i:028x}", f"logs {i}", status=status)
+
+    first = get_logs(limit=2, commit_id=prefix)
+    assert [row[1][-1] for row in first] == ["0", "1"]
+    assert len(first[0]) == len(SUMMARY_FIELDS), "build_logs should be left out by default"
+    second = get_logs(limit=2, after_id=first[-1][0], commit_id=prefix)
+    assert [row[1][-1] for row in second] == ["2", "3"]
+    assert get_logs(limit=2, after_id=second[-1][0], commit_id=prefix) == []
+
+    newest = get_logs(limit=10, commit_id=prefix, descending=True, fields=["commit_id", "build_logs"])
+    assert [logs for _, logs in newest] == ["logs 3", "logs 2", "logs 1", "logs 0"]
+    assert len(get_logs(commit_id=prefix, statuses=["failure"])) == 1
+    assert get_logs(commit_id=prefix, until="2000-01-01") == []
+    assert len(get_logs(commit_id=prefix, since="2000-01-01")) == 4
+
+
+def test_store_pools_wal_connections(tmp_path):
+    """Test that the store reuses a bounded number of WAL connections across threads."""
+    store = BuildHistoryStore(str(tmp_path / "history.db"), pool_size=2)
+    with store.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+        conn.execute("CREATE TABLE items (value INTEGER)")
+
+    errors = []
+    def work(i):
+        try:
+            for j in range(50):
+                with store.connection() as conn:
+                    conn.execute("INSERT INTO items VALUES (?)", (i * 100 + j,))
+                with store.connection() as conn:
+                    conn.execute("SELECT COUNT(*) FROM items").fetchone()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert store._opened <= 2
+    with store.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM items").fetchone() == (300,)
+    store.close()
+
+
+def test_logs_are_stored_compressed(setup_db):
+    """Test that logs live compressed in log_blobs and inline logs are migrated."""
+    from app.build_history import get_log
+    create_database()
+    logs = "collected 200 items\n" + "test_module.py::test_case PASSED\n" * 500
+    log_build("c0ffee", logs, 'test_builds')
+
+    conn = sqlite3.connect(config.DB_PATH)
+    build_logs, ref = conn.execute(
+        "SELECT build_logs, logs_ref FROM test_builds WHERE commit_id = 'c0ffee'"
+    ).fetchone()
+    size, stored = conn.execute("SELECT size, length(data) FROM log_blobs WHERE sha256 = ?", (ref,)).fetchone()
+    conn.execute(
+        "INSERT INTO builds (commit_id, build_date, build_logs, status) VALUES ('dec0de', '2020-01-01 00:00:00', ?, 'success')",
+        (logs,)
+    )
+    conn.commit()
+    (build_id,) = conn.execute("SELECT MAX(id) FROM builds").fetchone()
+    conn.close()
+    assert build_logs is None
+    assert size == len(logs) and stored < size / 10
+
+    create_database()
+    conn = sqlite3.connect(config.DB_PATH)
+    assert conn.execute("SELECT build_logs, logs_ref FROM builds WHERE id = ?", (build_id,)).fetchone() == (None, ref)
+    conn.close()
+    assert get_log(build_id)[3] == logs
+    assert get_log(build_id, ["id", "status"]) == (build_id, "success")
+
+def test_structured_build_records(setup_db):
+    """Test that a build records its repository, branch, stage timings, tests and lint messages."""
+    create_database()
+    repo = f"https://github.com/owner/{uuid.uuid4().hex}.git"
+    build_id = create_build("abc123", repo_url=repo, branch="main")
+    set_build_status(build_id, "running")
+    for stage, seconds in (("clone", 1.5), ("lint", 0.5), ("test", 3.0), ("notify", 0.25)):
+        record_stage(build_id, stage, seconds)
+    with pytest.raises(ValueError):
+        record_stage(build_id, "deploy", 1.0)
+    log_test_outcomes(build_id, [
+        {"test_file": "test_a.py", "name": "test_a::test_ok", "outcome": "passed", "seconds": 0.1, "message": None},
+        {"test_file": "test_a.py", "name": "test_a::test_bad", "outcome": "failed", "seconds": 0.2, "message": "x" * 5000},
+    ])
+    log_lint_messages(build_id, [{"path": "app/main.py", "line": 3, "column": 0, "symbol": "undefined-variable",
+                                  "message-id": "E0602", "type": "error", "message": "Undefined variable 'foo'"}])
+    log_build("abc123", "logs", build_id=build_id, status="failure")
+
+    fields = ["repo_url", "branch", "started_at", "finished_at", "clone_seconds", "lint_seconds", "test_seconds", "notify_seconds"]
+    build = get_log(build_id, fields)
+    assert build[:2] == (repo, "main")
+    assert build[2] and build[3] and build[2] <= build[3]
+    assert build[4:] == (1.5, 0.5, 3.0, 0.25)
+
+    failed = get_test_outcomes(build_id, ["failed", "error"])
+    assert [(name, outcome) for _, name, outcome, _, _ in failed] == [("test_a::test_bad", "failed")]
+    assert len(failed[0][4]) == 2000, "long failure messages are truncated"
+    assert len(get_test_outcomes(build_id)) == 2
+    assert get_lint_messages(build_id) == [("app/main.py", 3, 0, "undefined-variable", "E0602", "error", "Undefined variable 'foo'")]
+
+    assert [row[0] for row in get_logs(repo_url=repo, branch="main")] == [build_id]
+    assert get_logs(repo_url=repo, branch="other") == []
+    rates = [row for row in get_failure_rates() if row[0] == repo]
+    assert rates == [(repo, "main", 1, 1.0, 1.5, 0.5, 3.0, 0.25)]
+
+def test_old_builds_table_is_migrated(tmp_path, monkeypatch):
+    """Test that create_database adds the structured columns to a table of an earlier version."""
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE builds (id INTEGER PRIMARY KEY, commit_id TEXT, build_date TEXT, github_commit_url TEXT)")
+    conn.execute("INSERT INTO builds (commit_id, build_date) VALUES ('abc', '2024-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+
+    store = BuildHistoryStore(path)
+    monkeypatch.setattr("app.build_history.store", store)
+    create_database()
+    assert get_log(1, ["commit_id", "repo_url", "clone_seconds"]) == ("abc", None, None)
+    store.close()
@@ -0,0 +1,55 @@
+from app.build_log import BuildLog, read_log, log_size, is_complete, log_exists
+
+
+def test_log_is_split_into_chunks(tmp_path):
+    """Test that a log spans chunk files and reads back from any offset"""
+    log = BuildLog(str(tmp_path), 1, max_bytes=10000, chunk_bytes=10)
+    log.write("0123456789abcdef\n")
+    log.write("ghij\n")
+    assert not is_complete(str(tmp_path), 1)
+    log.close()
+
+    assert is_complete(str(tmp_path), 1)
+    assert len(list((tmp_path / "1").glob("*.log"))) == 3
+    assert log_size(str(tmp_path), 1) == 22
+    assert read_log(str(tmp_path), 1, 0, 100) == b"0123456789abcdef\nghij\n"
+    assert read_log(str(tmp_path), 1, 8, 5) == b"89abc"
+    assert read_log(str(tmp_path), 1, 22, 5) == b""
+
+
+def test_log_is_truncated_at_size_cap(tmp_path):
+    """Test that output beyond the cap is dropped and marked"""
+    log = BuildLog(str(tmp_path), 2, max_bytes=1024, chunk_bytes=100)
+    for i in range(100):
+        log.write(f"line {i:04d}\n")
+    log.close()
+
+    text = read_log(str(tmp_path), 2, 0, 10000).decode()
+    assert log_size(str(tmp_path), 2) <= 1024
+    assert text.startswith("line 0000\n")
+    assert "[... log truncated at" in text
+    assert text.endswith(" bytes omitted ...]\n")
+    assert "line 0099" not in text
+
+
+def test_missing_log(tmp_path):
+    """Test that a build without a log reads as empty"""
+    assert not log_exists(str(tmp_path), 3)
+    assert log_size(str(tmp_path), 3) == 0
+    assert read_log(str(tmp_path), 3, 0, 100) == b""
+
+
+def test_reopened_log_starts_over(tmp_path):
+    """Test that running a build id again replaces its old log, unless the log is resumed"""
+    old = BuildLog(str(tmp_path), 4, max_bytes=10000, chunk_bytes=10)
+    old.write("===== Build 4: first run =====\n")
+    old.close()
+
+    log = BuildLog(str(tmp_path), 4, max_bytes=10000, chunk_bytes=10)
+    assert not is_complete(str(tmp_path), 4)
+    assert log_size(str(tmp_path), 4) == 0
+    log.write("second run\n")
+    resumed = BuildLog(str(tmp_path), 4, max_bytes=10000, chunk_bytes=10, resume=True)
+    resumed.write("more\n")
+    resumed.close()
+    assert read_log(str(tmp_path), 4, 0, 100) == b"second run\nmore\n"
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import threading
+import time
+from unittest.mock import patch
+import pytest
+import config
+from app.build_history import create_database
+from app.build_queue import BuildQueue, BuildCancelled, QueueStopped
+from build_history import get_log  # the module build_queue records the builds with
+
+payload = {
+    "repository": {
+        "clone_url": "https://github.com/DD2480Group8/DD2480-CI.git",
+        "name": "DD2480-CI"
+    },
+    "ref": "refs/heads/main",
+    "organization": {
+        "login": "DD2480Group8"
+    },
+    "after": "queue_sha"
+}
+
+create_database()
+
+
+def test_enqueue_runs_handler_in_background(tmp_path):
+    """Test that queued payloads are handed to the handler by a worker"""
+    seen = []
+    queue = BuildQueue(lambda build_id, data: seen.append((build_id, data["after"])), workers=2, db_path=str(tmp_path / "queue.db"))
+    try:
+        build_id = queue.enqueue(payload)
+        job = queue.wait(build_id, timeout=10)
+        assert job["status"] == "success"
+        assert (build_id, "queue_sha") in seen
+    finally:
+        queue.stop(timeout=5)
+
+
+def test_failed_handler_marks_job_failed(tmp_path):
+    """Test that an exception raised by the handler is recorded on the job"""
+    def handler(build_id, data):
+        raise Exception("Tests failed")
+
+    queue = BuildQueue(handler, workers=1, db_path=str(tmp_path / "queue.db"))
+    try:
+        build_id = queue.enqueue(payload)
+        job = queue.wait(build_id, timeout=10)
+        assert job["status"] == "failure"
+        assert job["message"] == "Tests failed"
+    finally:
+        queue.stop(timeout=5)
+
+
+def test_interrupted_jobs_are_requeued_on_start(tmp_path):
+    """Test that a job left running by a crashed server is built again on the next start"""
+    db_path = str(tmp_path / "queue.db")
+    BuildQueue(None, db_path=db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "INSERT INTO build_queue (build_id, payload, status, enqueued_at) VALUES (?, ?, 'running', ?)",
+        (999999999, json.dumps(payload), "2025-02-12 10:00:00")
+    )
+    conn.commit()
+    conn.close()
+
+    seen = []
+    restarted = BuildQueue(lambda build_id, data: seen.append(build_id), workers=1, db_path=db_path)
+    try:
+        restarted.start()
+        assert restarted.wait(999999999, timeout=10)["status"] == "success"
+        assert seen == [999999999]
+    finally:
+        restarted.stop(timeout=5)
+
+
+
+def test_interrupted_builds_are_shown_queued_until_claimed(tmp_path):
+    """Test that the build of a re-queued job stops being reported as running before a worker claims it"""
+    db_path = str(tmp_path / "history.db")
+    BuildQueue(None, db_path=db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE builds (id INTEGER PRIMARY KEY, status TEXT, started_at TEXT)")
+    conn.execute("INSERT INTO builds VALUES (7, 'running', '2025-02-12 10:00:00')")
+    conn.execute(
+        "INSERT INTO build_queue (build_id, payload, status, enqueued_at) VALUES (7, ?, 'running', ?)",
+        (json.dumps(payload), "2025-02-12 10:00:00")
+    )
+    conn.commit()
+    conn.close()
+
+    BuildQueue(None, workers=0, db_path=db_path).start()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT status, started_at FROM builds WHERE id = 7").fetchone() == ("queued", None)
+    assert conn.execute("SELECT status FROM build_queue WHERE build_id = 7").fetchone() == ("queued",)
+    conn.close()
+
+def branch_payload(sha, branch="main"):
+    return dict(payload, after=sha, ref=f"refs/heads/{branch}")
+
+
+def test_queued_builds_of_a_branch_are_superseded(tmp_path):
+    """Test that only the newest queued build of a branch runs"""
+    release = threading.Event()
+    seen = []
+
+    def handler(build_id, data):
+        release.wait(10)
+        seen.append(data["after"])
+
+    queue = BuildQueue(handler, workers=1, db_path=str(tmp_path / "queue.db"), supersede=True)
+    try:
+        repo = payload["repository"]["clone_url"]
+        running = queue.enqueue(branch_payload("sha0"), repo_url=repo, branch="main")
+        time.sleep(0.5)  # the worker is busy with sha0
+        older = queue.enqueue(branch_payload("sha1"), repo_url=repo, branch="main")
+        other = queue.enqueue(branch_payload("sha2", "dev"), repo_url=repo, branch="dev")
+        newest = queue.enqueue(branch_payload("sha3"), repo_url=repo, branch="main")
+        assert queue.get(older)["status"] == "cancelled"
+        assert queue.get(older)["message"] == f"Superseded by build {newest}"
+        release.set()
+        assert queue.wait(newest, timeout=10)["status"] == "success"
+        assert queue.wait(other, timeout=10)["status"] == "success"
+        # sha0 was running when it was superseded, but its handler ignored the cancellation
+        assert queue.get(running)["status"] == "success"
+        assert seen == ["sha0", "sha2", "sha3"]
+        assert get_log(older, ["status"]) == ("cancelled",)
+    finally:
+        queue.stop(timeout=5)
+
+
+def test_running_build_is_asked_to_stop(tmp_path):
+    """Test that a newer build of the branch sets the cancel event of the running one"""
+    queue = None
+
+    def handler(build_id, data):
+        if data["after"] == "old" and queue.cancel_event(build_id).wait(10):
+            raise BuildCancelled("superseded")
+
+    queue = BuildQueue(handler, workers=2, db_path=str(tmp_path / "queue.db"), supersede=True)
+    try:
+        repo = payload["repository"]["clone_url"]
+        old = queue.enqueue(branch_payload("old"), repo_url=repo, branch="main")
+        time.sleep(0.5)
+        new = queue.enqueue(branch_payload("new"), repo_url=repo, branch="main")
+        assert queue.wait(old, timeout=10)["status"] == "cancelled"
+        assert queue.wait(new, timeout=10)["status"] == "success"
+    finally:
+        queue.stop(timeout=5)
+
+
+def test_worker_survives_database_errors(tmp_path):
+    """Test that a worker whose claim fails, e.g. on a locked database, logs it and keeps draining the queue"""
+    queue = BuildQueue(lambda build_id, data: None, workers=1, db_path=str(tmp_path / "queue.db"))
+    claim = queue._claim
+    failures = []
+
+    def locked_once(*args, **kwargs):
+        if not failures:
+            failures.append(True)
+            raise sqlite3.OperationalError("database is locked")
+        return claim(*args, **kwargs)
+
+    with patch.object(queue, '_claim', side_effect=locked_once):
+        try:
+            build_id = queue.enqueue(payload)
+            assert queue.wait(build_id, timeout=10)["status"] == "success"
+        finally:
+            queue.stop(timeout=5)
+    assert failures
+
+
+def test_build_is_not_reserved_when_its_job_cannot_be_queued():
+    """Test that the build row and the queue entry are written in one transaction"""
+    queue = BuildQueue(None, workers=0, db_path=config.DB_PATH)
+    with pytest.raises(TypeError):
+        queue.enqueue({**payload, "after": "unqueued_sha", "unserializable": {1, 2}})
+    conn = sqlite3.connect(config.DB_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM builds WHERE commit_id = 'unqueued_sha'").fetchone()[0] == 0
+    conn.close()
+
+
+def test_stopped_queue_refuses_builds(tmp_path):
+    """Test that a queue does not start its workers again for a build queued after stop"""
+    queue = BuildQueue(lambda build_id, data: None, workers=1, db_path=str(tmp_path / "queue.db"))
+    queue.start()
+    queue.stop(timeout=5)
+    with pytest.raises(QueueStopped):
+        queue.enqueue(payload)
+    assert queue._threads == []
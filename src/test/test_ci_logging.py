@@ -0,0 +1,69 @@
+import io
+import json
+import logging
+import queue
+import pytest
+from app.ci_logging import (get_logger, setup_logging, flush_logging, build_context, truncate,
+                            DroppingQueueHandler)
+
+
+@pytest.fixture
+def output():
+    stream = io.StringIO()
+    yield stream
+    flush_logging()
+    logging.getLogger('ci').handlers = []
+
+
+def records(stream):
+    flush_logging()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_records_are_json_with_build_id(output):
+    """Test that records carry their fields and the id of the current build"""
+    setup_logging('INFO', 'json', output)
+    log = get_logger('test')
+    log.info("Queued build", commit_id="abc", branch="main")
+    with build_context(42):
+        log.warning("Build failed", error="Tests failed")
+    log.debug("Not logged", rows=[1, 2, 3])
+
+    first, second = records(output)
+    assert first["msg"] == "Queued build" and first["level"] == "INFO" and first["logger"] == "ci.test"
+    assert first["commit_id"] == "abc" and first["branch"] == "main" and "build_id" not in first
+    assert second["build_id"] == 42 and second["error"] == "Tests failed"
+
+
+def test_large_fields_are_truncated(output):
+    """Test that payload-sized fields are cut before they are queued"""
+    setup_logging('INFO', 'json', output)
+    get_logger('test').info("Build logged", logs="x" * 5000, rows=list(range(100)))
+    (record,) = records(output)
+    assert record["logs"].endswith("...[3000 chars truncated]") and len(record["logs"]) < 2100
+    assert len(record["rows"]) == 21 and record["rows"][-1] == "... 80 more items"
+
+
+def test_text_format(output):
+    """Test the readable format"""
+    setup_logging('INFO', 'text', output)
+    with build_context(7):
+        get_logger('test').info("Cloning", strategy="mirror")
+    flush_logging()
+    assert output.getvalue().rstrip().endswith("INFO ci.test [build 7] Cloning strategy='mirror'")
+
+
+def test_full_queue_drops_records():
+    """Test that logging never blocks on a full queue"""
+    handler = DroppingQueueHandler(queue.Queue(1))
+    for _ in range(3):
+        handler.handle(logging.LogRecord('ci.test', logging.INFO, __file__, 1, "message", None, None))
+    assert handler.queue.qsize() == 1
+    assert handler.dropped == 2
+
+
+def test_truncate():
+    """Test that nested values are shortened and small ones kept as they are"""
+    assert truncate({"a": "b" * 10, "n": 1}, 4, 5) == {"a": "bbbb...[6 chars truncated]", "n": 1}
+    assert truncate(("x", None, 2.5), 4, 5) == ["x", None, 2.5]
+    assert truncate(object(), 1000, 5).startswith("<object object")
@@ -0,0 +1,146 @@
+import os
+import shutil
+import pytest
+from unittest.mock import patch
+from git import Repo, Actor
+from app.build_history import create_database, get_clone_timings
+from app.clone import clone_check, clone_repo, choose_strategy, get_changed_files, CLONE_STRATEGIES
+from app.mirror_cache import MirrorCache
+from app.workspace_pool import WorkspacePool
+
+author = Actor("CI Test", "ci@example.com")
+
+create_database()
+
+
+@pytest.fixture(autouse=True)
+def mirror_cache(tmp_path):
+    """Keep the mirrors made by these tests out of the real cache"""
+    with patch('app.clone.mirror_cache', MirrorCache(str(tmp_path / "mirrors"), max_bytes=10 ** 9)):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def workspace_pool(tmp_path):
+    """Keep the checkouts made by these tests out of the real workspace pool"""
+    pool = WorkspacePool(str(tmp_path / "workspaces"), max_idle=2)
+    with patch('app.clone.workspace_pool', pool):
+        yield pool
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """A repository with two commits on 'main', served over file:// so depth and filters apply"""
+    repo = Repo.init(tmp_path / "origin", initial_branch='main')
+    repo.git.config('uploadpack.allowFilter', 'true')
+    repo.git.config('uploadpack.allowAnySHA1InWant', 'true')
+    for name in ("app.py", "README.md", os.path.join("src", "test", "data.txt"), os.path.join("docs", "guide.md")):
+        path = os.path.join(repo.working_tree_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f"{name}\n")
+        repo.index.add([name])
+    repo.index.commit("Initial commit", author=author, committer=author)
+    with open(os.path.join(repo.working_tree_dir, "app.py"), 'w') as f:
+        f.write("print('second')\n")
+    repo.index.add(["app.py"])
+    repo.index.commit("Second commit", author=author, committer=author)
+    return repo
+
+
+@pytest.mark.parametrize("strategy", CLONE_STRATEGIES)
+def test_clone_repo_checks_out_tip(origin, tmp_path, strategy):
+    """Test that every strategy checks out the tip of the branch"""
+    repo = clone_repo(f"file://{origin.working_tree_dir}", "main", str(tmp_path / "clone"), strategy=strategy)
+    assert repo.head.commit.hexsha == origin.head.commit.hexsha
+    assert os.path.exists(tmp_path / "clone" / "app.py")
+
+
+def test_shallow_clone_has_only_tip_commit(origin, tmp_path):
+    """Test that the shallow strategy fetches a single commit"""
+    repo = clone_repo(f"file://{origin.working_tree_dir}", "main", str(tmp_path / "clone"), strategy='shallow')
+    assert len(list(repo.iter_commits())) == 1
+
+
+def test_sparse_clone_only_checks_out_needed_paths(origin, tmp_path):
+    """Test that the sparse strategy leaves out files the pipeline does not read"""
+    clone_repo(f"file://{origin.working_tree_dir}", "main", str(tmp_path / "clone"), strategy='sparse')
+    assert os.path.exists(tmp_path / "clone" / "app.py")
+    assert os.path.exists(tmp_path / "clone" / "src" / "test" / "data.txt")
+    assert not os.path.exists(tmp_path / "clone" / "README.md")
+    assert not os.path.exists(tmp_path / "clone" / "docs")
+
+
+@pytest.mark.parametrize("strategy", ['shallow', 'sparse'])
+def test_shallow_clone_of_older_commit(origin, tmp_path, strategy):
+    """Test that the pushed commit is checked out even if the branch moved on since"""
+    pushed = origin.head.commit.parents[0].hexsha
+    repo = clone_repo(f"file://{origin.working_tree_dir}", "main", str(tmp_path / "clone"), pushed, strategy)
+    assert repo.head.commit.hexsha == pushed
+
+
+def test_clone_check_records_timing(origin):
+    """Test that clone_check records how long the strategy took"""
+    url = f"file://{origin.working_tree_dir}"
+    commit_id, path = clone_check(url, "main", strategy='shallow')
+    try:
+        assert commit_id == origin.head.commit.hexsha
+        count, average = get_clone_timings(url)['shallow']
+        assert count == 1
+        assert average >= 0
+    finally:
+        shutil.rmtree(path)
+
+
+def test_choose_strategy_explores_then_picks_fastest():
+    """Test that 'auto' tries untimed strategies first and then the fastest one"""
+    timings = {strategy: (3, 10.0) for strategy in CLONE_STRATEGIES}
+    with patch('app.clone.get_clone_timings', return_value={'mirror': (3, 1.0)}):
+        assert choose_strategy("url") == 'full'
+    timings['blobless'] = (3, 2.0)
+    with patch('app.clone.get_clone_timings', return_value=timings):
+        assert choose_strategy("url") == 'blobless'
+
+
+def test_get_changed_files_diffs_pushed_commits(origin, tmp_path):
+    """Test that the changed files come from a diff of the before and after commits"""
+    before = origin.head.commit.parents[0].hexsha
+    after = origin.head.commit.hexsha
+    clone_repo(f"file://{origin.working_tree_dir}", "main", str(tmp_path / "clone"), strategy='shallow')
+    assert get_changed_files(str(tmp_path / "clone"), before, after) == ["app.py"]
+
+
+def test_get_changed_files_falls_back_to_payload_commits(tmp_path):
+    """Test that the payload's file lists are used when the commits cannot be diffed"""
+    commits = [{"added": ["new.py"], "removed": [], "modified": ["app.py"]}]
+    assert get_changed_files(str(tmp_path / "missing"), "a" * 40, "b" * 40, commits) == ["app.py", "new.py"]
+
+
+def test_get_changed_files_of_new_branch():
+    """Test that a new branch has no known set of changed files"""
+    assert get_changed_files("/tmp/repo_path", "0" * 40, "b" * 40) is None
+
+
+@pytest.mark.parametrize("strategy", ['mirror', 'shallow'])
+def test_clone_check_resets_released_workspace(origin, workspace_pool, strategy):
+    """Test that the next build of a repository gets the previous checkout back, cleaned and up to date"""
+    url = f"file://{origin.working_tree_dir}"
+    first_commit, path = clone_check(url, "main", strategy=strategy)
+    with open(os.path.join(path, "app.py"), 'w') as f:
+        f.write("modified by the build\n")
+    os.makedirs(os.path.join(path, "build"))
+    with open(os.path.join(path, "build", "output.txt"), 'w') as f:
+        f.write("left behind\n")
+    workspace_pool.release(path)
+
+    with open(os.path.join(origin.working_tree_dir, "app.py"), 'w') as f:
+        f.write("print('third')\n")
+    origin.index.add(["app.py"])
+    pushed = origin.index.commit("Third commit", author=author, committer=author).hexsha
+
+    commit_id, reused = clone_check(url, "main", pushed, strategy=strategy)
+    assert (commit_id, reused) == (pushed, path)
+    with open(os.path.join(path, "app.py")) as f:
+        assert f.read() == "print('third')\n"
+    assert not os.path.exists(os.path.join(path, "build"))
+    assert get_clone_timings(url)['reset'][0] == 1
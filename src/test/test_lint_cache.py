@@ -0,0 +1,91 @@
+import subprocess
+import threading
+from unittest.mock import patch
+import config
+from build_history import store  # the module the cache takes its connections from
+from app.lint_cache import LintCache, blob_sha
+from app.syntax_check import lint_files
+
+
+def test_blob_sha_matches_git(tmp_path):
+    """Test that the cache key is the id git gives the file"""
+    path = tmp_path / "a.py"
+    path.write_text("print('hello')\n")
+    expected = subprocess.run(["git", "hash-object", str(path)], capture_output=True, text=True).stdout.strip()
+    assert blob_sha(path.read_bytes()) == expected
+
+
+def test_lint_files_reuses_cached_messages(tmp_path):
+    """Test that unchanged files are not linted again and keep their messages"""
+    cache = LintCache(str(tmp_path / "cache.db"))
+    good = tmp_path / "good.py"
+    good.write_text("x = 1\n")
+    bad = tmp_path / "bad.py"
+    bad.write_text("print(foo)\n")
+
+    first = lint_files([str(good), str(bad)], cache=cache)
+    assert [m["symbol"] for m in first] == ["undefined-variable"]
+    assert cache.stats() == {"hits": 0, "misses": 2, "entries": 2}
+
+    with patch('pylint.lint.Run') as mock_run:
+        second = lint_files([str(good), str(bad)], cache=cache)
+    mock_run.assert_not_called()
+    assert second == first
+    assert cache.stats()["hits"] == 2
+
+
+def test_lint_files_only_lints_cache_misses(tmp_path):
+    """Test that only changed files are handed to pylint"""
+    cache = LintCache(str(tmp_path / "cache.db"))
+    same = tmp_path / "same.py"
+    same.write_text("x = 1\n")
+    lint_files([str(same)], cache=cache)
+    changed = tmp_path / "changed.py"
+    changed.write_text("y = 2\n")
+
+    with patch('pylint.lint.Run') as mock_run, \
+         patch('app.syntax_check.StringIO') as mock_stringio:
+        mock_stringio.return_value.getvalue.return_value = '[]'
+        lint_files([str(same), str(changed)], cache=cache)
+    args = mock_run.call_args[0][0]
+    assert str(changed) in args
+    assert str(same) not in args
+
+
+def test_lint_files_does_not_cache_star_imports(tmp_path):
+    """Test that files whose names come from other modules are always linted"""
+    cache = LintCache(str(tmp_path / "cache.db"))
+    star = tmp_path / "star.py"
+    star.write_text("from os.path import *\nprint(join)\n")
+    lint_files([str(star)], cache=cache)
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    """Test that the cache stays within its size bound"""
+    cache = LintCache(str(tmp_path / "cache.db"), max_entries=2)
+    cache.put_many({"a": []}, "1.0", "checks")
+    cache.put_many({"b": []}, "1.0", "checks")
+    cache.get_many(["a"], "1.0", "checks")
+    cache.put_many({"c": []}, "1.0", "checks")
+    assert set(cache.get_many(["a", "b", "c"], "1.0", "checks")) == {"a", "c"}
+
+
+def test_cache_shares_the_pooled_store(tmp_path):
+    """Test that the cache goes through a WAL-mode connection pool, so concurrent builds do not lock each other out"""
+    assert LintCache(config.DB_PATH).store is store
+    cache = LintCache(str(tmp_path / "cache.db"))
+    with cache.store.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    def put(i):
+        for j in range(20):
+            cache.put_many({f"{i}-{j}": []}, "1.0", "checks")
+            cache.get_many([f"{i}-{j}"], "1.0", "checks")
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.stats()["entries"] == 160
@@ -0,0 +1,99 @@
+import os
+from unittest.mock import patch
+import pytest
+import app.syntax_check
+from app.lint_worker import ResidentLinter, LintService, LintServiceStopped, is_library
+from app.syntax_check import lint_shard, make_shards, run_pylint
+
+
+def write(root, name, content):
+    path = os.path.join(root, name)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def symbols(messages):
+    return sorted((os.path.basename(m["path"]), m["symbol"]) for m in messages)
+
+
+def test_resident_linter_matches_a_fresh_run(tmp_path):
+    """Test that a reused linter reports the same messages as a new pylint run"""
+    linter = ResidentLinter('undefined-variable')
+    first = [write(str(tmp_path), "a.py", "import os\nprint(os.sep, missing_a)\n")]
+    second = [write(str(tmp_path), "b.py", "x = 1\n"), write(str(tmp_path), "c.py", "print(missing_c)\n")]
+    assert linter.lint(first) == lint_shard(first, 'undefined-variable')
+    assert linter.lint(second) == lint_shard(second, 'undefined-variable')
+    assert symbols(linter.lint(second)) == [("c.py", "undefined-variable")]
+    assert linter.batches == 3
+
+
+def test_changed_file_at_same_path_is_linted_again(tmp_path):
+    """Test that a file rewritten in place, as in a reset workspace, is not linted from astroid's cache"""
+    linter = ResidentLinter('undefined-variable')
+    path = write(str(tmp_path), "module.py", "print(value)\n")
+    assert symbols(linter.lint([path])) == [("module.py", "undefined-variable")]
+    write(str(tmp_path), "module.py", "value = 1\nprint(value)\n")
+    assert linter.lint([path]) == []
+    write(str(tmp_path), "module.py", "print(other)\n")
+    assert [m["message"] for m in linter.lint([path])] == ["Undefined variable 'other'"]
+    assert is_library(os.__file__) and not is_library(path)
+
+
+def test_lint_service_lints_batches_on_warm_workers(tmp_path):
+    """Test that the service merges the messages of batches linted by its worker processes"""
+    files = [write(str(tmp_path), f"m{i}.py", f"print(missing_{i})\n" if i % 2 else "x = 1\n") for i in range(6)]
+    service = LintService(workers=2, checks='undefined-variable', max_batches=2)
+    service.start()
+    try:
+        assert service.running
+        for _ in range(3):
+            messages = service.lint(make_shards(files, 2), 'undefined-variable')
+            assert symbols(messages) == [(f"m{i}.py", "undefined-variable") for i in (1, 3, 5)]
+    finally:
+        service.stop()
+    assert not service.running
+
+
+def test_stopped_lint_service_does_not_start_workers_again(tmp_path):
+    """Test that linting after stop is refused instead of spawning new worker processes"""
+    files = [write(str(tmp_path), "m.py", "print(missing)\n")]
+    service = LintService(workers=1, checks='undefined-variable')
+    with pytest.raises(LintServiceStopped):
+        service.lint([files], 'undefined-variable')
+    service.start()
+    service.stop()
+    with pytest.raises(LintServiceStopped):
+        service.lint([files], 'undefined-variable')
+    assert not service.running and service._executor is None
+
+
+def test_run_pylint_lints_in_process_once_the_service_stopped(tmp_path):
+    """Test that a build linting while the service stops falls back to linting without it"""
+    files = [write(str(tmp_path), "m.py", "print(missing)\n")]
+    # syntax_check catches the LintServiceStopped of the lint_worker module it imported
+    service_class = app.syntax_check.LintService
+    service = service_class(workers=1, checks='undefined-variable')
+    # Stopped between run_pylint's check and its call to lint
+    with patch.object(service_class, 'running', True), patch('app.syntax_check.lint_service', service):
+        messages = run_pylint(files, 'undefined-variable', jobs=1)
+    assert symbols(messages) == [("m.py", "undefined-variable")]
+    assert service._executor is None
+
+
+def test_lint_service_stopped_while_linting_is_reported_as_stopped(tmp_path):
+    """Test that a stop between lint taking the executor and submitting to it raises LintServiceStopped"""
+    files = [write(str(tmp_path), "m.py", "print(missing)\n")]
+    service = LintService(workers=1, checks='undefined-variable')
+    service.start()
+    executor = service._executor
+    submit_batches = executor.map
+
+    def stop_then_map(*args, **kwargs):
+        service.stop()
+        return submit_batches(*args, **kwargs)
+
+    executor.map = stop_then_map
+    with pytest.raises(LintServiceStopped):
+        service.lint([files], 'undefined-variable')
+    assert service._executor is None
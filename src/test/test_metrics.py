@@ -0,0 +1,72 @@
+import threading
+import time
+from app.metrics import Histogram, Registry, Sampled, dir_size
+
+
+def test_histogram_renders_cumulative_buckets():
+    """Test that observations land in cumulative buckets per label set"""
+    histogram = Histogram("ci_test_seconds", "Test latency.", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, stage="lint")
+    histogram.observe(0.5, stage="lint")
+    histogram.observe(5, stage="lint")
+    with histogram.time(stage="test"):
+        pass
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP ci_test_seconds Test latency.", "# TYPE ci_test_seconds histogram"]
+    assert 'ci_test_seconds_bucket{stage="lint",le="0.1"} 1' in lines
+    assert 'ci_test_seconds_bucket{stage="lint",le="1.0"} 2' in lines
+    assert 'ci_test_seconds_bucket{stage="lint",le="+Inf"} 3' in lines
+    assert 'ci_test_seconds_sum{stage="lint"} 5.55' in lines
+    assert 'ci_test_seconds_count{stage="test"} 1' in lines
+    assert histogram.count(stage="lint") == 3
+
+
+def test_registry_reads_callbacks_at_scrape_time():
+    """Test that gauges are read when rendered and a failing one is left out"""
+    registry = Registry()
+    depth = [3]
+    registry.register("ci_depth", "Queue depth.", "gauge", lambda: depth[0])
+    registry.register("ci_hits_total", "Cache hits.", "counter", lambda: {(("cache", 'li"nt'),): 7})
+    registry.register("ci_broken", "Broken.", "gauge", lambda: 1 / 0)
+    depth[0] = 5
+    text = registry.render()
+    assert "ci_depth 5\n" in text
+    assert '# TYPE ci_hits_total counter\nci_hits_total{cache="li\\"nt"} 7\n' in text
+    assert "ci_broken" not in text
+
+
+def test_dir_size(tmp_path):
+    """Test that dir_size adds up the files of nested directories"""
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "f").write_bytes(b"x" * 10)
+    (tmp_path / "g").write_bytes(b"x" * 5)
+    assert dir_size(str(tmp_path)) == 15
+    assert dir_size(str(tmp_path / "missing")) == 0
+
+
+def test_sampled_metric_never_blocks_a_scrape():
+    """Test that a slow gauge is served from its last sample while a new one is taken in the background"""
+    release = threading.Event()
+    calls = []
+
+    def slow_size():
+        release.wait(10)
+        calls.append(1)
+        return len(calls) * 100
+
+    registry = Registry()
+    registry.register("ci_disk_bytes", "Disk used.", "gauge", Sampled(slow_size, max_age=0.2))
+    started = time.monotonic()
+    assert "ci_disk_bytes" not in registry.render()
+    assert time.monotonic() - started < 1
+    release.set()
+    deadline = time.monotonic() + 10
+    while "ci_disk_bytes 100\n" not in registry.render():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    time.sleep(0.3)
+    registry.render()  # stale: served as is, sampled again in the background
+    deadline = time.monotonic() + 10
+    while "ci_disk_bytes 200\n" not in registry.render():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
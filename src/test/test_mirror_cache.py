@@ -0,0 +1,76 @@
+import os
+from git import Repo, Actor
+from app.mirror_cache import MirrorCache
+
+author = Actor("CI Test", "ci@example.com")
+
+
+def make_origin(path):
+    """Create a repository with a 'main' branch holding one commit"""
+    origin = Repo.init(path, initial_branch='main')
+    commit_file(origin, "app.py", "print('hello')\n")
+    return origin
+
+
+def commit_file(repo, name, content):
+    with open(os.path.join(repo.working_tree_dir, name), 'w') as f:
+        f.write(content)
+    repo.index.add([name])
+    return repo.index.commit(f"Update {name}", author=author, committer=author).hexsha
+
+
+def test_checkout_shares_objects_with_mirror(tmp_path):
+    """Test that a checkout borrows the objects of the bare mirror"""
+    origin = make_origin(tmp_path / "origin")
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=10 ** 9)
+    dest = str(tmp_path / "build1")
+
+    repo = cache.checkout(str(tmp_path / "origin"), "main", dest)
+
+    assert repo.head.commit.hexsha == origin.head.commit.hexsha
+    assert os.path.exists(os.path.join(dest, "app.py"))
+    alternates = os.path.join(dest, ".git", "objects", "info", "alternates")
+    assert os.path.exists(alternates)
+    assert os.path.exists(os.path.join(cache.mirror_path(str(tmp_path / "origin")), "HEAD"))
+
+
+def test_checkout_fetches_new_commits_into_existing_mirror(tmp_path):
+    """Test that a second build reuses the mirror and sees the newly pushed commit"""
+    origin = make_origin(tmp_path / "origin")
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=10 ** 9)
+    first = cache.checkout(str(tmp_path / "origin"), "main", str(tmp_path / "build1"))
+    sha = commit_file(origin, "app.py", "print('hello again')\n")
+
+    second = cache.checkout(str(tmp_path / "origin"), "main", str(tmp_path / "build2"), sha)
+
+    assert second.head.commit.hexsha == sha
+    assert second.head.commit.hexsha != first.head.commit.hexsha
+    assert len(os.listdir(tmp_path / "mirrors")) == 2  # the mirror and its lock file
+
+
+def test_checkout_of_older_commit(tmp_path):
+    """Test that the commit from the webhook is checked out even if the branch moved on"""
+    origin = make_origin(tmp_path / "origin")
+    pushed = origin.head.commit.hexsha
+    commit_file(origin, "app.py", "print('newer')\n")
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=10 ** 9)
+
+    repo = cache.checkout(str(tmp_path / "origin"), "main", str(tmp_path / "build"), pushed)
+
+    assert repo.head.commit.hexsha == pushed
+
+
+def test_evict_removes_least_recently_used_unleased_mirror(tmp_path):
+    """Test that eviction keeps mirrors backing a checkout and drops the oldest others"""
+    make_origin(tmp_path / "origin1")
+    make_origin(tmp_path / "origin2")
+    cache = MirrorCache(str(tmp_path / "mirrors"), max_bytes=10 ** 9)
+    cache.checkout(str(tmp_path / "origin1"), "main", str(tmp_path / "build1"))
+    cache.checkout(str(tmp_path / "origin2"), "main", str(tmp_path / "build2"))
+    cache.release(str(tmp_path / "build1"))
+
+    cache.max_bytes = 1
+    cache.evict()
+
+    assert not os.path.exists(cache.mirror_path(str(tmp_path / "origin1")))
+    assert os.path.exists(cache.mirror_path(str(tmp_path / "origin2")))
@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import requests
+from app.notify import GithubClient, GithubNotification
+
+
+class StubGithub(BaseHTTPRequestHandler):
+    """Stub of the commit status API answering with the scripted responses first."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.requests.append((self.path, body, self.client_address[1], self.headers['Authorization']))
+        time.sleep(server.delay)
+        code, headers = server.script.pop(0) if server.script else (201, {})
+        reply = b'{}'
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(reply)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('localhost', 0), StubGithub)
+    server.requests = []
+    server.script = []
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+clients = []
+
+
+def make_client(stub, db_path, **kwargs):
+    client = GithubClient(f"http://localhost:{stub.server_port}", backoff_base=0.01, db_path=str(db_path), **kwargs)
+    clients.append(client)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def stop_clients():
+    yield
+    while clients:
+        clients.pop().stop(timeout=5)
+
+
+def status(state, context="ci/tests"):
+    return {"state": state, "target_url": "http://ci/1", "description": state, "context": context}
+
+
+def test_statuses_reuse_one_connection(stub, tmp_path):
+    """Test that statuses are sent over a kept-alive connection"""
+    client = make_client(stub, tmp_path / "ci.db")
+    for i in range(3):
+        client.send("owner", "repo", f"sha{i}", "token", status("success"))
+    assert [path for path, *_ in stub.requests] == [f"/repos/owner/repo/statuses/sha{i}" for i in range(3)]
+    assert len({port for _, _, port, _ in stub.requests}) == 1
+    assert stub.requests[0][3] == "token token"
+
+
+def test_server_errors_are_retried(stub, tmp_path):
+    """Test that 5xx responses are retried until one succeeds"""
+    stub.script = [(502, {}), (503, {})]
+    client = make_client(stub, tmp_path / "ci.db")
+    assert client.send("owner", "repo", "sha", "token", status("success")).status_code == 201
+    assert len(stub.requests) == 3
+    assert client.stats['retries'] == 2
+
+
+def test_retries_give_up(stub, tmp_path):
+    """Test that the error is raised once the retries are used up"""
+    stub.script = [(500, {})] * 3
+    client = make_client(stub, tmp_path / "ci.db", max_retries=2)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.send("owner", "repo", "sha", "token", status("success"))
+    assert len(stub.requests) == 3
+
+
+def test_client_errors_are_not_retried(stub, tmp_path):
+    """Test that a 422 fails right away"""
+    stub.script = [(422, {})]
+    client = make_client(stub, tmp_path / "ci.db")
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.send("owner", "repo", "sha", "token", status("success"))
+    assert len(stub.requests) == 1
+
+
+def test_rate_limit_reset_is_honored(stub, tmp_path):
+    """Test that a rate-limited request waits for the reset before retrying"""
+    reset = time.time() + 1
+    stub.script = [(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)})]
+    client = make_client(stub, tmp_path / "ci.db")
+    client.send("owner", "repo", "sha", "token", status("success"))
+    assert time.time() >= reset - 0.05
+    assert len(stub.requests) == 2
+
+
+def test_retry_after_is_honored(stub, tmp_path):
+    """Test that Retry-After sets the delay of the retry"""
+    stub.script = [(429, {'Retry-After': '1'})]
+    client = make_client(stub, tmp_path / "ci.db")
+    started = time.monotonic()
+    client.send("owner", "repo", "sha", "token", status("success"))
+    assert time.monotonic() - started >= 1
+
+
+def test_statuses_for_same_commit_are_coalesced(stub, tmp_path):
+    """Test that queued statuses for a commit and context collapse into the latest"""
+    stub.delay = 0.3
+    client = make_client(stub, tmp_path / "ci.db")
+    notification = GithubNotification("owner", "repo", "token", "http://ci", "ci/tests", client=client)
+    notification.send_commit_status("pending", "pending", "sha", "1")
+    time.sleep(0.1)  # the first status is being sent
+    for state in ("failure", "error", "success"):
+        notification.send_commit_status(state, state, "sha", "1")
+    notification.send_commit_status("pending", "pending", "other", "2")
+    assert client.flush(timeout=10)
+
+    assert [(path.rsplit('/', 1)[1], body["state"]) for path, body, *_ in stub.requests] == [
+        ("sha", "pending"), ("sha", "success"), ("other", "pending")
+    ]
+    # The status being sent stays in the outbox until GitHub accepted it, so it is replaced too
+    assert client.stats['coalesced'] == 3
+
+    notification.send_commit_status("success", "success", "sha", "1")
+    assert client.flush(timeout=10)
+    assert len(stub.requests) == 3
+    assert client.stats['skipped'] == 1
+
+
+def test_failed_statuses_stay_in_outbox(stub, tmp_path):
+    """Test that a status GitHub did not accept is retried later until it is sent"""
+    stub.script = [(500, {})] * 3
+    client = make_client(stub, tmp_path / "ci.db", max_retries=0)
+    client.post_status("owner", "repo", "sha", "token", status("success"))
+    assert client.flush(timeout=10)
+    assert len(stub.requests) == 4
+    assert client.stats['failed'] == 3 and client.stats['sent'] == 1
+
+
+def test_outbox_survives_restart(stub, tmp_path):
+    """Test that statuses queued before a restart are sent by the next dispatcher"""
+    down = GithubClient("http://localhost:1", max_retries=0, backoff_base=0.01, db_path=str(tmp_path / "ci.db"))
+    clients.append(down)
+    down.post_status("owner", "repo", "sha", "token", status("success"))
+    assert not down.flush(timeout=1)
+    down.stop(timeout=5)
+
+    client = make_client(stub, tmp_path / "ci.db", token="restarted")
+    assert client.outbox.count() == 1
+    client.start()
+    assert client.flush(timeout=10)
+    assert [(path, body["state"], auth) for path, body, _, auth in stub.requests] == [
+        ("/repos/owner/repo/statuses/sha", "success", "token restarted")
+    ]
+
+
+def test_permanent_failures_are_dropped(stub, tmp_path):
+    """Test that a status GitHub rejects for good is not retried"""
+    stub.script = [(422, {})]
+    client = make_client(stub, tmp_path / "ci.db")
+    client.post_status("owner", "repo", "sha", "token", status("success"))
+    assert client.flush(timeout=10)
+    assert len(stub.requests) == 1
@@ -0,0 +1,45 @@
+import gzip
+from app.response_cache import ResponseCache, accepts_gzip
+
+
+def test_entries_are_stale_after_a_write():
+    """Test that an entry is only served at the version it was read at"""
+    cache = ResponseCache(max_entries=2)
+    cache.put("/", 1, 0.0, b"[]")
+    assert cache.get("/", 1).body == b"[]"
+    assert cache.get("/", 2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_dropped():
+    """Test that the cache keeps at most max_entries responses"""
+    cache = ResponseCache(max_entries=2)
+    for key in ("/1", "/2"):
+        cache.put(key, 1, 0.0, b"{}")
+    cache.get("/1", 1)
+    cache.put("/3", 1, 0.0, b"{}")
+    assert cache.get("/2", 1) is None
+    assert cache.get("/1", 1) is not None and cache.get("/3", 1) is not None
+
+
+def test_validators():
+    """Test the ETag and Last-Modified comparisons of conditional requests"""
+    entry = ResponseCache().put("/", 1, 1700000000.5, b'{"id": 1}')
+    assert entry.not_modified(entry.etag, None)
+    assert entry.not_modified(f'"other", W/{entry.etag}', None)
+    assert entry.not_modified("*", None)
+    assert not entry.not_modified('"other"', entry.last_modified)
+    assert entry.not_modified(None, entry.last_modified)
+    assert not entry.not_modified(None, "Tue, 14 Nov 2023 22:13:19 GMT")
+    assert not entry.not_modified(None, "not a date")
+    assert gzip.decompress(entry.gzipped()) == entry.body
+
+
+def test_accepts_gzip():
+    """Test the parsing of Accept-Encoding"""
+    assert accepts_gzip("gzip, deflate, br")
+    assert accepts_gzip("br;q=1.0, gzip;q=0.8")
+    assert accepts_gzip("*")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip(None)
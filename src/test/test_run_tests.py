@@ -0,0 +1,248 @@
+import os
+import sqlite3
+import config
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import patch
+import pytest
+import app.runTests
+from app.build_history import create_database, get_test_durations, get_coverage_map, get_test_outcomes
+from app.runTests import run_tests, make_shards, find_test_files
+
+create_database()
+
+
+def make_checkout(root, failing=False):
+    tests_dir = os.path.join(root, "src", "test")
+    os.makedirs(tests_dir)
+    for name in ("test_a.py", "test_b.py", "c_test.py"):
+        with open(os.path.join(tests_dir, name), 'w') as f:
+            f.write("def test_ok():\n    assert True\n")
+    with open(os.path.join(tests_dir, "helpers.py"), 'w') as f:
+        f.write("def test_not_collected():\n    assert False\n")
+    if failing:
+        with open(os.path.join(tests_dir, "test_fail.py"), 'w') as f:
+            f.write("def test_fail():\n    assert False\n")
+    return tests_dir
+
+
+def test_find_test_files(tmp_path):
+    """Test that only files pytest collects by default are sharded"""
+    tests_dir = make_checkout(str(tmp_path))
+    assert find_test_files(tests_dir) == ["c_test.py", "test_a.py", "test_b.py"]
+
+
+def test_make_shards_balances_durations():
+    """Test that shards are balanced by historical durations"""
+    durations = {"slow.py": 10.0, "medium.py": 6.0, "fast.py": 4.0}
+    shards = make_shards(["fast.py", "medium.py", "slow.py", "new.py"], 2, durations)
+    # new.py has no history and counts as the average file
+    assert shards == [["slow.py", "fast.py"], ["new.py", "medium.py"]]
+
+
+def test_run_tests_sharded_passes(tmp_path):
+    """Test that sharded runs merge their logs and record durations"""
+    make_checkout(str(tmp_path))
+    repo = f"file://{tmp_path}"
+    passed, logs = run_tests(str(tmp_path), shards=2, repo=repo)
+    assert passed
+    assert "shard 1/2" in logs and "shard 2/2" in logs
+    assert logs.count("passed") == 2
+    assert set(get_test_durations(repo)) == {"c_test.py", "test_a.py", "test_b.py"}
+
+
+def test_run_tests_sharded_fails_if_any_shard_fails(tmp_path):
+    """Test that one failing shard fails the whole run"""
+    make_checkout(str(tmp_path), failing=True)
+    passed, logs = run_tests(str(tmp_path), shards=3)
+    assert not passed
+    assert "test_fail" in logs
+
+
+def test_run_tests_single_process(tmp_path):
+    """Test that one shard runs the test directory in a single pytest process"""
+    make_checkout(str(tmp_path))
+    passed, logs = run_tests(str(tmp_path), shards=1)
+    assert passed
+    assert "===== shard" not in logs
+    assert "3 passed" in logs
+
+
+def make_covered_checkout(root):
+    os.makedirs(os.path.join(root, "src", "app"))
+    for name in ("alpha", "beta"):
+        with open(os.path.join(root, "src", "app", f"{name}.py"), 'w') as f:
+            f.write(f"def {name}():\n    return True\n")
+    tests_dir = os.path.join(root, "src", "test")
+    os.makedirs(tests_dir)
+    with open(os.path.join(tests_dir, "conftest.py"), 'w') as f:
+        f.write("import os, sys\nsys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))\n")
+    for name in ("alpha", "beta"):
+        with open(os.path.join(tests_dir, f"test_{name}.py"), 'w') as f:
+            f.write(f"from {name} import {name}\n\ndef test_{name}():\n    assert {name}()\n")
+
+
+def test_full_run_records_coverage_map(tmp_path):
+    """Test that a full run records which source files each test file runs"""
+    make_covered_checkout(str(tmp_path))
+    repo = f"file://{tmp_path}"
+    passed, logs = run_tests(str(tmp_path), repo=repo, commit_id="abc")
+    assert passed
+    coverage, _, builds_since = get_coverage_map(repo)
+    assert "src/app/alpha.py" in coverage["src/test/test_alpha.py"]
+    assert "src/app/alpha.py" not in coverage["src/test/test_beta.py"]
+    assert builds_since == 0
+
+
+def test_only_affected_tests_run(tmp_path):
+    """Test that only the test files running a changed file are selected"""
+    make_covered_checkout(str(tmp_path))
+    repo = f"file://{tmp_path}"
+    run_tests(str(tmp_path), repo=repo, commit_id="abc")
+
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["src/app/beta.py", "README.md"])
+    assert passed
+    assert "1 passed" in logs
+    assert "test_beta.py" in logs and "test_alpha.py" not in logs
+    assert get_coverage_map(repo)[2] == 1
+
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["README.md"])
+    assert passed
+    assert logs == "No tests affected by the changed files\n"
+
+
+def test_unknown_or_stale_changes_run_everything(tmp_path):
+    """Test that the whole suite runs for files missing from the map or a stale map"""
+    make_covered_checkout(str(tmp_path))
+    repo = f"file://{tmp_path}"
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["src/app/alpha.py"])
+    assert "2 passed" in logs  # no map yet
+
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["src/app/gamma.py"])
+    assert "2 passed" in logs
+
+    conn = sqlite3.connect(config.DB_PATH)
+    conn.execute("UPDATE coverage_runs SET recorded_at = '2000-01-01 00:00:00' WHERE repo_url = ?", (repo,))
+    conn.commit()
+    conn.close()
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["src/app/alpha.py"])
+    assert "2 passed" in logs
+
+
+
+def test_shared_imports_and_fixtures_are_attributed_to_every_test_file(tmp_path):
+    """Test that code run once for several test files, on import or in a wide scoped fixture, maps to all of them"""
+    make_covered_checkout(str(tmp_path))
+    app_dir = os.path.join(str(tmp_path), "src", "app")
+    tests_dir = os.path.join(str(tmp_path), "src", "test")
+    with open(os.path.join(app_dir, "settings.py"), 'w') as f:
+        f.write("LIMIT = 3\n")
+    with open(os.path.join(app_dir, "seed.py"), 'w') as f:
+        f.write("def seed():\n    return [1, 2]\n")
+    with open(os.path.join(tests_dir, "conftest.py"), 'a') as f:
+        f.write("import pytest\n\n@pytest.fixture(scope='session')\ndef data():\n    from seed import seed\n    return seed()\n")
+    for name in ("one", "two"):
+        with open(os.path.join(tests_dir, f"test_{name}.py"), 'w') as f:
+            f.write(f"from settings import LIMIT\n\ndef test_{name}(data):\n    assert len(data) < LIMIT\n")
+    repo = f"file://{tmp_path}"
+    passed, logs = run_tests(str(tmp_path), repo=repo, commit_id="abc")
+    assert passed, logs
+    coverage = get_coverage_map(repo)[0]
+    for name in ("one", "two"):
+        assert {"src/app/settings.py", "src/app/seed.py"} <= set(coverage[f"src/test/test_{name}.py"])
+    assert "src/app/seed.py" not in coverage["src/test/test_alpha.py"]
+
+    passed, logs = run_tests(str(tmp_path), repo=repo, changed_files=["src/app/settings.py"])
+    assert "test_one.py" in logs and "test_two.py" in logs and "test_alpha.py" not in logs
+
+def test_run_tests_streams_output(tmp_path):
+    """Test that output is streamed to the log while only a tail is returned"""
+    make_checkout(str(tmp_path))
+    lines = []
+    log = type("Log", (), {"write": lambda self, text: lines.append(text)})()
+    with patch.object(app.runTests.config, "TEST_LOG_TAIL_LINES", 2):
+        passed, logs = run_tests(str(tmp_path), shards=2, log=log)
+    assert passed
+    assert lines[0].startswith("===== shard 1/2")
+    assert all(line.endswith("\n") for line in lines)
+    assert any(line.startswith("[2/2] ") for line in lines)
+    assert logs == ''.join(lines[-2:])
+
+
+def test_run_tests_records_outcomes(tmp_path):
+    """Test that the outcome of each test is recorded with the build"""
+    make_checkout(str(tmp_path), failing=True)
+    passed, _ = run_tests(str(tmp_path), shards=2, build_id=987654321)
+    assert not passed
+    outcomes = {(test_file, outcome) for test_file, _, outcome, _, _ in get_test_outcomes(987654321)}
+    assert outcomes == {("c_test.py", "passed"), ("test_a.py", "passed"), ("test_b.py", "passed"), ("test_fail.py", "failed")}
+    failed = get_test_outcomes(987654321, ["failed"])
+    assert failed[0][1].endswith("::test_fail") and "assert False" in failed[0][4]
+
+
+def test_cancelled_run_kills_pytest(tmp_path):
+    """Test that setting the cancel event stops the test processes"""
+    tests_dir = make_checkout(str(tmp_path))
+    with open(os.path.join(tests_dir, "test_slow.py"), 'w') as f:
+        f.write("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+    cancel = threading.Event()
+    threading.Timer(2, cancel.set).start()
+    started = time.monotonic()
+    passed, logs = run_tests(str(tmp_path), shards=1, cancel=cancel)
+    assert not passed
+    assert time.monotonic() - started < 30
+    assert logs.endswith("===== Tests cancelled =====\n")
+
+
+class FakeEnvCache:
+    """Makes 'environments' running the interpreter of the test suite"""
+
+    def copy_for(self, checkout, dest):
+        os.makedirs(os.path.join(dest, "bin"))
+        os.symlink(sys.executable, os.path.join(dest, "bin", "python"))
+        return dest
+
+
+def test_run_tests_in_test_environment(tmp_path):
+    """Test that the tests run in the copied environment of the checkout, removed afterwards"""
+    tests_dir = make_checkout(str(tmp_path))
+    with open(os.path.join(tests_dir, "test_env.py"), 'w') as f:
+        f.write("import os\n\ndef test_env():\n    assert os.environ['VIRTUAL_ENV'].endswith('.ci-venv')\n")
+    with patch('app.runTests.venv_cache', FakeEnvCache()):
+        passed, logs = run_tests(str(tmp_path), shards=1)
+    assert passed, logs
+    assert "4 passed" in logs
+    assert not os.path.exists(tmp_path / ".ci-venv")
+
+
+def test_run_tests_fails_when_dependencies_cannot_be_installed(tmp_path):
+    """Test that a checkout whose environment cannot be built fails with the installer's output"""
+    make_checkout(str(tmp_path))
+    error = subprocess.CalledProcessError(1, ["pip"], output="", stderr="No matching distribution found for nope\n")
+    with patch('app.runTests.venv_cache.copy_for', side_effect=error):
+        passed, logs = run_tests(str(tmp_path), shards=1)
+    assert not passed
+    assert "No matching distribution found for nope" in logs
+
+
+def test_failed_shard_start_stops_started_shards(tmp_path):
+    """Test that the shards already running are killed when the next one cannot be started"""
+    tests_dir = make_checkout(str(tmp_path))
+    with open(os.path.join(tests_dir, "test_slow.py"), 'w') as f:
+        f.write("import time\n\ndef test_slow():\n    time.sleep(60)\n")
+    started = []
+
+    def popen(*args, **kwargs):
+        if started:
+            raise OSError(24, "Too many open files")
+        started.append(subprocess_popen(*args, **kwargs))
+        return started[-1]
+
+    subprocess_popen = subprocess.Popen
+    with patch('app.runTests.subprocess.Popen', side_effect=popen):
+        with pytest.raises(OSError):
+            run_tests(str(tmp_path), shards=2)
+    assert started[0].returncode is not None
+    assert started[0].stdout.closed
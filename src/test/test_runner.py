@@ -0,0 +1,208 @@
+import threading
+import time
+import pytest
+import requests
+from unittest.mock import patch
+
+# The server and the runners share the flat modules, as when they are started from src/app
+import CIServer
+from CIServer import PooledHTTPServer, KeepAliveHandler
+from build_history import get_log, get_test_outcomes
+from build_log import read_log, is_complete
+from build_queue import BuildQueue, BuildCancelled
+from coordinator import Coordinator, LeaseLost
+from runner import Runner, CoordinatorClient
+
+
+TOKEN = 'runner-secret'
+
+
+def branch_payload(sha, branch):
+    return {
+        "repository": {"clone_url": "https://github.com/DD2480Group8/DD2480-CI.git", "name": "DD2480-CI"},
+        "ref": f"refs/heads/{branch}",
+        "organization": {"login": "DD2480Group8"},
+        "after": sha
+    }
+
+
+def enqueue(queue, sha, branch):
+    payload = branch_payload(sha, branch)
+    return queue.enqueue(payload, repo_url=payload["repository"]["clone_url"], branch=branch)
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+    """A coordinator without local workers, served on a free port"""
+    queue = BuildQueue(None, workers=0, db_path=str(tmp_path / "queue.db"), supersede=True)
+    coord = Coordinator(queue, str(tmp_path / "logs"), lease_seconds=1, heartbeat_seconds=0.1)
+    server = PooledHTTPServer(('localhost', 0), KeepAliveHandler)
+    with patch.object(CIServer, 'build_queue', queue), patch.object(CIServer, 'coordinator', coord), \
+         patch.object(CIServer.config, 'RUNNER_TOKEN', TOKEN):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield f"http://localhost:{server.server_address[1]}", queue, coord
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def start_runners(url, count, handler=None):
+    runners = [Runner(url, f"runner-{i}", token=TOKEN, poll_seconds=0.05, handler=handler) for i in range(count)]
+    threads = [threading.Thread(target=runner.run_forever) for runner in runners]
+    for thread in threads:
+        thread.start()
+    return runners, threads
+
+
+def stop_runners(runners, threads):
+    for runner in runners:
+        runner.stop()
+    for thread in threads:
+        thread.join(10)
+
+
+def fake_run_tests(path, log=None, record_outcomes=None, **kwargs):
+    log.write("test_app.py ....\n")
+    time.sleep(0.2)
+    record_outcomes([{"test_file": "test_app.py", "name": "test_app::test_ok", "outcome": "passed",
+                      "seconds": 0.01, "message": None}])
+    return True, "4 passed"
+
+
+def test_runners_run_builds_and_stream_results(coordinator):
+    """Test that several runners share the queued builds and send logs and results back"""
+    url, queue, coord = coordinator
+    with patch('CIServer.clone_check', return_value=('commit_id_value', '/tmp/repo_path')), \
+         patch('CIServer.syntax_check', return_value={'status': 'success', 'details': []}), \
+         patch('CIServer.run_tests', side_effect=fake_run_tests), \
+         patch('CIServer.GithubNotification.send_commit_status'), \
+         patch('CIServer.remove_temp_folder'):
+        build_ids = [enqueue(queue, f"sha{i}", f"branch-{i}") for i in range(4)]
+        runners, threads = start_runners(url, 2)
+        try:
+            jobs = [queue.wait(build_id, timeout=20) for build_id in build_ids]
+        finally:
+            stop_runners(runners, threads)
+
+    assert [job["status"] for job in jobs] == ["success"] * 4
+    for build_id in build_ids:
+        status, test_seconds = get_log(build_id, ["status", "test_seconds"])
+        assert status == "success"
+        assert test_seconds >= 0.2
+        assert [outcome[1] for outcome in get_test_outcomes(build_id)] == ["test_app::test_ok"]
+        assert is_complete(coord.log_root, build_id)
+        text = read_log(coord.log_root, build_id, 0, 1 << 20).decode()
+        assert "===== Tests =====" in text and "test_app.py ...." in text
+    assert coord.active_runners() == 2
+
+
+def test_expired_lease_is_run_by_another_runner(coordinator):
+    """Test that the build of a runner that stopped sending heartbeats is queued again"""
+    url, queue, coord = coordinator
+    build_id = enqueue(queue, "sha_dead", "main")
+    dead = CoordinatorClient(url, "dead-runner", token=TOKEN)
+    assert dead.post("claim")["build_id"] == build_id
+    dead.post(f"{build_id}/log", {"text": "output of the dead runner\n"})
+
+    time.sleep(1.2)
+    ran = []
+    runners, threads = start_runners(url, 1, handler=lambda build_id, payload, build_log, cancel, recorder: (
+        ran.append(build_id), build_log.write("output of the second attempt\n")
+    ))
+    try:
+        assert queue.wait(build_id, timeout=10)["status"] == "success"
+    finally:
+        stop_runners(runners, threads)
+
+    assert ran == [build_id]
+    with pytest.raises(LeaseLost):
+        dead.post(f"{build_id}/heartbeat")
+    dead.close()
+    assert read_log(coord.log_root, build_id, 0, 1 << 20) == b"output of the second attempt\n"
+
+
+def test_superseded_remote_build_is_cancelled(coordinator):
+    """Test that the heartbeat tells a runner to stop a build superseded by a newer one"""
+    url, queue, coord = coordinator
+    started = threading.Event()
+
+    def handler(build_id, payload, build_log, cancel, recorder):
+        if payload["after"] == "sha_old":
+            started.set()
+            if cancel.wait(10):
+                raise BuildCancelled("Superseded")
+
+    old_id = enqueue(queue, "sha_old", "main")
+    runners, threads = start_runners(url, 1, handler=handler)
+    try:
+        assert started.wait(10)
+        new_id = enqueue(queue, "sha_new", "main")
+        assert queue.wait(old_id, timeout=10)["status"] == "cancelled"
+        assert queue.wait(new_id, timeout=10)["status"] == "success"
+    finally:
+        stop_runners(runners, threads)
+
+
+def test_runner_requests_need_the_token(coordinator):
+    """Test that runners without the configured token are refused, and that without a token there are no runners"""
+    url, queue, coord = coordinator
+    build_id = enqueue(queue, "sha_secret", "main")
+    assert requests.post(f"{url}/runners/claim", json={"runner": "r"}).status_code == 401
+    wrong = {"Authorization": "Bearer guess"}
+    assert requests.post(f"{url}/runners/claim", json={"runner": "r"}, headers=wrong).status_code == 401
+    with patch.object(CIServer.config, 'RUNNER_TOKEN', ''):
+        assert requests.post(f"{url}/runners/claim", json={"runner": "r"}).status_code == 404
+        assert requests.post(f"{url}/runners/claim", json={"runner": "r"}, headers={"Authorization": "Bearer "}).status_code == 404
+    assert queue.get(build_id)["status"] == "queued"
+
+    client = CoordinatorClient(url, "r", token=TOKEN)
+    assert client.post("claim")["build_id"] == build_id
+    with pytest.raises(requests.HTTPError) as error:
+        client.post(f"{build_id}/record", {"kind": "finish", "data": {"commit_id": "sha_secret", "logs": "", "status": "hacked"}})
+    assert error.value.response.status_code == 400
+    client.close()
+
+
+def test_runner_retries_requests_the_coordinator_did_not_answer(coordinator):
+    """Test that failed requests are sent again and that results sent twice are recorded once"""
+    url, queue, coord = coordinator
+    session_post = requests.Session.post
+    failed = set()
+
+    def flaky_post(session, url, **kwargs):
+        path = url.split('/runners/', 1)[1]
+        if path.endswith('/record'):
+            path = f"{path}:{kwargs['json']['kind']}"
+        if path in failed:
+            return session_post(session, url, **kwargs)
+        failed.add(path)
+        if path.endswith(':test_outcomes'):
+            # The coordinator recorded them, but its answer is lost
+            session_post(session, url, **kwargs)
+            raise requests.exceptions.ConnectionError("Connection reset by peer")
+        if path == 'claim':
+            raise requests.exceptions.ConnectionError("Connection refused")
+        response = requests.Response()
+        response.status_code, response.reason = 503, "Service Unavailable"
+        response.headers['Retry-After'] = '0'
+        return response
+
+    with patch('CIServer.clone_check', return_value=('commit_id_value', '/tmp/repo_path')), \
+         patch('CIServer.syntax_check', return_value={'status': 'success', 'details': []}), \
+         patch('CIServer.run_tests', side_effect=fake_run_tests), \
+         patch('CIServer.GithubNotification.send_commit_status'), \
+         patch('CIServer.remove_temp_folder'), \
+         patch.object(CIServer.config, 'RUNNER_BACKOFF_BASE', 0.01), \
+         patch.object(requests.Session, 'post', flaky_post):
+        build_id = enqueue(queue, "sha_flaky", "main")
+        runners, threads = start_runners(url, 1)
+        try:
+            assert queue.wait(build_id, timeout=20)["status"] == "success"
+        finally:
+            stop_runners(runners, threads)
+
+    assert runners[0].client.retries >= 4
+    assert get_log(build_id, ["status"])[0] == "success"
+    assert [outcome[1] for outcome in get_test_outcomes(build_id)] == ["test_app::test_ok"]
+    assert "===== Tests =====" in read_log(coord.log_root, build_id, 0, 1 << 20).decode()
@@ -0,0 +1,135 @@
+import os
+from unittest.mock import patch
+from app.syntax_check import syntax_check, select_changed_files, imported_modules, make_shards, run_pylint
+from app.compile_check import compile_file
+
+
+def write(root, name, content):
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def make_project(root):
+    """A small project where main imports util, and test_util imports it through the package"""
+    return {
+        "util": write(root, "src/app/util.py", "def helper():\n    return 1\n"),
+        "main": write(root, "src/app/main.py", "from util import helper\nhelper()\n"),
+        "init": write(root, "src/app/__init__.py", ""),
+        "pkg_user": write(root, "src/app/pkg_user.py", "from . import util\n"),
+        "test": write(root, "src/test/test_util.py", "import app.util\n"),
+        "other": write(root, "src/app/other.py", "x = 1\n"),
+    }
+
+
+def test_imported_modules_resolves_relative_imports(tmp_path):
+    """Test that relative imports are resolved from the checkout root"""
+    files = make_project(str(tmp_path))
+    with open(files["pkg_user"]) as f:
+        modules = imported_modules(files["pkg_user"], str(tmp_path), f.read())
+    assert "src.app.util" in modules
+
+
+def test_select_changed_files_adds_direct_importers(tmp_path):
+    """Test that a changed module is linted with the files importing it, and nothing else"""
+    files = make_project(str(tmp_path))
+    selected = select_changed_files(str(tmp_path), list(files.values()), ["src/app/util.py", "README.md"])
+    assert set(selected) == {files["util"], files["main"], files["pkg_user"], files["test"]}
+
+
+def test_select_changed_files_keeps_importers_of_removed_module(tmp_path):
+    """Test that removing a module re-checks the files that imported it"""
+    files = make_project(str(tmp_path))
+    os.remove(files["util"])
+    del files["util"]
+    selected = select_changed_files(str(tmp_path), list(files.values()), ["src/app/util.py"])
+    assert set(selected) == {files["main"], files["pkg_user"], files["test"]}
+
+
+def test_syntax_check_incremental_lints_only_selected_files(tmp_path):
+    """Test that pylint only receives the changed files and their importers"""
+    files = make_project(str(tmp_path))
+    with patch('pylint.lint.Run') as mock_run, \
+         patch('app.syntax_check.lint_cache', None), \
+         patch('app.syntax_check.StringIO') as mock_stringio:
+        mock_stringio.return_value.getvalue.return_value = '[]'
+        result = syntax_check(str(tmp_path), ["src/app/main.py"])
+
+    assert result["status"] == "success"
+    assert result["files_checked"] == [files["main"]]
+    assert files["main"] in mock_run.call_args[0][0]
+    assert files["util"] not in mock_run.call_args[0][0]
+
+
+def test_syntax_check_incremental_without_python_changes(tmp_path):
+    """Test that a push touching no Python file skips pylint"""
+    make_project(str(tmp_path))
+    with patch('pylint.lint.Run') as mock_run:
+        result = syntax_check(str(tmp_path), ["README.md"])
+    assert result["status"] == "success"
+    assert result["files_checked"] == []
+    assert result["error_count"] == 0
+    mock_run.assert_not_called()
+
+
+def test_make_shards_balances_file_sizes(tmp_path):
+    """Test that shards hold about the same number of bytes"""
+    sizes = [900, 500, 400, 300, 200, 100]
+    files = [write(str(tmp_path), f"f{i}.py", "x" * size) for i, size in enumerate(sizes)]
+    shards = make_shards(files, 2)
+    totals = sorted(sum(os.path.getsize(path) for path in shard) for shard in shards)
+    assert totals == [1200, 1200]
+    assert sorted(path for shard in shards for path in shard) == sorted(files)
+
+
+def test_run_pylint_merges_shard_results(tmp_path):
+    """Test that messages from all worker processes are merged"""
+    files = [
+        write(str(tmp_path), "a.py", "print(undefined_a)\n"),
+        write(str(tmp_path), "b.py", "x = 1\n"),
+        write(str(tmp_path), "c.py", "print(undefined_c)\n"),
+    ]
+    with patch('app.syntax_check.MIN_FILES_PER_JOB', 1):
+        messages = run_pylint(files, 'syntax-error,undefined-variable', jobs=2)
+    assert [(os.path.basename(m["path"]), m["symbol"]) for m in messages] == [
+        ("a.py", "undefined-variable"),
+        ("c.py", "undefined-variable"),
+    ]
+
+
+def test_compile_file_reports_syntax_error(tmp_path):
+    """Test that the compiler fast path reports a pylint-style syntax error"""
+    path = write(str(tmp_path), "broken.py", "x = 1\ndef f(:\n    pass\n")
+    message = compile_file(path)
+    assert message["symbol"] == "syntax-error"
+    assert message["message-id"] == "E0001"
+    assert message["path"] == path
+    assert message["line"] == 2
+    assert compile_file(write(str(tmp_path), "fine.py", "x = 1\n")) is None
+
+
+def test_syntax_check_fails_fast_on_syntax_error(tmp_path):
+    """Test that a file that does not compile fails the check without starting pylint"""
+    broken = write(str(tmp_path), "broken.py", "def f(:\n")
+    write(str(tmp_path), "fine.py", "x = 1\n")
+    with patch('pylint.lint.Run') as mock_run:
+        result = syntax_check(str(tmp_path))
+    mock_run.assert_not_called()
+    assert result["status"] == "error"
+    assert result["error_count"] == 1
+    assert result["details"][0]["path"] == broken
+    assert len(result["files_checked"]) == 2
+
+
+def test_syntax_check_leaves_undefined_variables_to_pylint(tmp_path):
+    """Test that pylint only runs the undefined-variable check once every file compiles"""
+    write(str(tmp_path), "fine.py", "x = 1\n")
+    with patch('pylint.lint.Run') as mock_run, \
+         patch('app.syntax_check.lint_cache', None), \
+         patch('app.syntax_check.StringIO') as mock_stringio:
+        mock_stringio.return_value.getvalue.return_value = '[]'
+        result = syntax_check(str(tmp_path))
+    assert result["status"] == "success"
+    assert '--enable=undefined-variable' in mock_run.call_args[0][0]
@@ -0,0 +1,110 @@
+import os
+import subprocess
+import time
+import zipfile
+from app.venv_cache import EnvCache, env_python, bin_dir, LAST_USED_FILE
+
+
+def make_wheel(directory):
+    """Write a wheel of a one-module package, installable without network"""
+    path = os.path.join(directory, "ci_sample-1.0-py3-none-any.whl")
+    with zipfile.ZipFile(path, 'w') as wheel:
+        wheel.writestr("ci_sample.py", "VALUE = 42\n")
+        wheel.writestr("ci_sample-1.0.dist-info/METADATA", "Metadata-Version: 2.1\nName: ci-sample\nVersion: 1.0\n")
+        wheel.writestr("ci_sample-1.0.dist-info/WHEEL",
+                       "Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n")
+        wheel.writestr("ci_sample-1.0.dist-info/RECORD", "")
+    return path
+
+
+def make_checkout(path, wheel):
+    os.makedirs(path)
+    with open(os.path.join(path, "requirements.txt"), 'w') as f:
+        f.write(f"{wheel}\n")
+    return str(path)
+
+
+def test_key_follows_dependency_files(tmp_path):
+    """Test that checkouts share an environment only while their dependency files are the same"""
+    cache = EnvCache(str(tmp_path / "envs"), 10 ** 9)
+    first = make_checkout(tmp_path / "a", "requests==2.31.0")
+    second = make_checkout(tmp_path / "b", "requests==2.31.0")
+    assert cache.key(first) == cache.key(second)
+    with open(os.path.join(second, "pyproject.toml"), 'w') as f:
+        f.write("[project]\nname = 'b'\n")
+    assert cache.key(first) != cache.key(second)
+    os.makedirs(tmp_path / "plain")
+    assert cache.key(str(tmp_path / "plain")) is None
+    assert cache.copy_for(str(tmp_path / "plain"), str(tmp_path / "env")) is None
+
+
+def test_key_follows_included_requirements(tmp_path):
+    """Test that the files a requirements file includes with -r or -c are part of the key"""
+    cache = EnvCache(str(tmp_path / "envs"), 10 ** 9)
+    checkout = make_checkout(tmp_path / "a", "-r requirements/base.txt\n--constraint=pins.txt")
+    os.makedirs(tmp_path / "a" / "requirements")
+    (tmp_path / "a" / "requirements" / "base.txt").write_text("-c ../pins.txt  # shared pins\nrequests\n")
+    key = cache.key(checkout)
+    (tmp_path / "a" / "pins.txt").write_text("requests==2.31.0\n")
+    with_pins = cache.key(checkout)
+    assert with_pins != key
+    (tmp_path / "a" / "requirements" / "base.txt").write_text("-c ../pins.txt\nrequests\nidna\n")
+    assert cache.key(checkout) not in (key, with_pins)
+
+
+def test_environment_is_built_once_and_copied_as_links(tmp_path):
+    """Test that a second build with the same requirements gets a linked copy of the cached environment"""
+    wheel = make_wheel(str(tmp_path))
+    cache = EnvCache(str(tmp_path / "envs"), 10 ** 9, extra_packages=())
+    first = cache.copy_for(make_checkout(tmp_path / "a", wheel), str(tmp_path / "a" / ".ci-venv"))
+    started = time.monotonic()
+    second = cache.copy_for(make_checkout(tmp_path / "b", wheel), str(tmp_path / "b" / ".ci-venv"))
+    assert time.monotonic() - started < 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    output = subprocess.run([env_python(second), "-c", "import ci_sample, sys; print(ci_sample.VALUE, sys.prefix)"],
+                            capture_output=True, text=True, check=True).stdout.split()
+    assert output == ["42", second]
+    cached = cache.env_path(cache.key(str(tmp_path / "b")))
+    pip = os.path.join(bin_dir(second), "pip")
+    with open(pip) as f:
+        assert cached not in f.read()
+    config_file = os.path.join(second, "pyvenv.cfg")
+    assert os.stat(config_file).st_ino == os.stat(os.path.join(cached, "pyvenv.cfg")).st_ino
+    assert not os.access(config_file, os.W_OK) or os.geteuid() == 0
+    assert os.stat(pip).st_ino != os.stat(os.path.join(bin_dir(cached), "pip")).st_ino
+    assert os.access(pip, os.W_OK)
+    pycache = next(os.path.join(root, name) for root, dirs, files in os.walk(second)
+                   if os.path.basename(root) == "__pycache__" for name in files)
+    assert os.stat(pycache).st_ino != os.stat(os.path.join(cached, os.path.relpath(pycache, second))).st_ino
+    assert first != second and os.path.isdir(first)
+
+
+def test_environment_written_through_a_copy_is_built_again(tmp_path):
+    """Test that a cached environment changed through the links of a copy is not copied again"""
+    wheel = make_wheel(str(tmp_path))
+    cache = EnvCache(str(tmp_path / "envs"), 10 ** 9, extra_packages=())
+    first = cache.copy_for(make_checkout(tmp_path / "a", wheel), str(tmp_path / "a" / ".ci-venv"))
+    module = subprocess.run([env_python(first), "-c", "import ci_sample; print(ci_sample.__file__)"],
+                            capture_output=True, text=True, check=True).stdout.strip()
+    os.chmod(module, 0o644)
+    with open(module, 'a') as f:
+        f.write("VALUE = 0\n")
+
+    second = cache.copy_for(make_checkout(tmp_path / "b", wheel), str(tmp_path / "b" / ".ci-venv"))
+    assert (cache.hits, cache.misses) == (0, 2)
+    output = subprocess.run([env_python(second), "-c", "import ci_sample; print(ci_sample.VALUE)"],
+                            capture_output=True, text=True, check=True).stdout
+    assert output == "42\n"
+
+
+def test_evict_removes_least_recently_used_environments(tmp_path):
+    """Test that the oldest environments are removed once the cache is over its disk budget"""
+    cache = EnvCache(str(tmp_path / "envs"), max_bytes=2500)
+    for i, name in enumerate(["old", "recent", "new"]):
+        os.makedirs(tmp_path / "envs" / name)
+        (tmp_path / "envs" / name / "data.bin").write_bytes(b"x" * 1000)
+        (tmp_path / "envs" / name / LAST_USED_FILE).write_text("")
+        os.utime(tmp_path / "envs" / name / LAST_USED_FILE, (i, i))
+    cache.evict(keep=str(tmp_path / "envs" / "new"))
+    assert sorted(name for name in os.listdir(tmp_path / "envs") if not name.endswith(".lock")) == ["new", "recent"]
@@ -0,0 +1,113 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+from app.workspace_pool import WorkspacePool, OWNER_SUFFIX
+
+
+def fill(path, size):
+    with open(os.path.join(path, "data.bin"), 'wb') as f:
+        f.write(b"x" * size)
+
+
+def test_released_workspace_is_reused_for_same_repository(tmp_path):
+    """Test that a workspace handed back is leased again to the next build of its repository only"""
+    pool = WorkspacePool(str(tmp_path), max_idle=2)
+    path = pool.create("repo-a")
+    pool.release(path)
+    assert pool.acquire("repo-b") is None
+    assert pool.acquire("repo-a") == path
+    assert pool.counts() == {'idle': 0, 'leased': 1, 'retiring': 0}
+
+
+def test_workspaces_beyond_limits_are_retired_in_background(tmp_path):
+    """Test that the oldest idle workspaces are deleted once the pool is over its size or disk budget"""
+    retired = []
+    pool = WorkspacePool(str(tmp_path), max_idle=2, max_bytes=1500, on_retire=retired.append)
+    paths = [pool.create("repo") for _ in range(3)]
+    for path in paths:
+        fill(path, 1000)
+        pool.release(path)
+    assert pool.drain(timeout=10)
+    # Two fit the count, but only one fits the disk budget
+    assert retired == paths[:2]
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+    assert not os.path.exists(paths[0] + OWNER_SUFFIX)
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(paths[2]), os.path.basename(paths[2]) + OWNER_SUFFIX])
+
+
+def test_broken_workspace_is_not_kept(tmp_path):
+    """Test that a workspace released as not reusable is deleted"""
+    pool = WorkspacePool(str(tmp_path), max_idle=2)
+    path = pool.create("repo")
+    pool.release(path, reusable=False)
+    assert pool.drain(timeout=10)
+    assert not os.path.exists(path)
+    assert pool.acquire("repo") is None
+
+
+def test_reap_leaked_retires_workspaces_of_dead_processes(tmp_path):
+    """Test that workspaces whose process is gone, and half-deleted ones, are removed"""
+    dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    for name, owner in (("crashed", f"{socket.gethostname()} {dead.stdout.strip()}"),
+                        ("other-host", "elsewhere 1"),
+                        ("alive", f"{socket.gethostname()} {os.getppid()}")):
+        os.makedirs(tmp_path / name)
+        (tmp_path / (name + OWNER_SUFFIX)).write_text(owner)
+    os.makedirs(tmp_path / ".retired-old" / "sub")
+    pool = WorkspacePool(str(tmp_path))
+    in_use = pool.create("repo")
+
+    assert pool.reap_leaked() == [str(tmp_path / "crashed")]
+    assert pool.drain(timeout=10)
+    assert sorted(name for name in os.listdir(tmp_path) if not name.endswith(OWNER_SUFFIX)) == \
+        sorted(["other-host", "alive", os.path.basename(in_use)])
+
+
+def test_reap_leaked_spares_workspace_created_during_scan(tmp_path):
+    """Test that a workspace another thread creates while leaks are looked for is not retired"""
+    pool = WorkspacePool(str(tmp_path))
+    made = []
+    listdir = os.listdir
+
+    def create_then_listdir(path):
+        # Runs after reap_leaked took its snapshot of the known workspaces
+        made.append(pool.create("repo"))
+        return listdir(path)
+
+    with patch('app.workspace_pool.os.listdir', side_effect=create_then_listdir):
+        assert pool.reap_leaked() == []
+    assert pool.drain(timeout=10)
+    assert os.path.isdir(made[0])
+    assert pool.counts() == {'idle': 0, 'leased': 1, 'retiring': 0}
+
+
+def test_workspaces_of_this_process_id_are_only_leaked_at_startup(tmp_path):
+    """Test that a workspace naming this process id is left alone, except by the startup scan"""
+    os.makedirs(tmp_path / "before-restart")
+    (tmp_path / ("before-restart" + OWNER_SUFFIX)).write_text(f"{socket.gethostname()} {os.getpid()}")
+    pool = WorkspacePool(str(tmp_path))
+    assert pool.reap_leaked() == []
+    assert pool.reap_leaked(startup=True) == [str(tmp_path / "before-restart")]
+    assert pool.drain(timeout=10)
+    assert os.listdir(tmp_path) == []
+
+
+def test_workspace_with_unreadable_owner_is_leaked_by_age(tmp_path):
+    """Test that an empty or garbled owner file is treated like a missing one, by the workspace's age"""
+    for name, owner in (("empty", ""), ("garbled", f"{socket.gethostname()} not-a-pid")):
+        os.makedirs(tmp_path / name)
+        (tmp_path / (name + OWNER_SUFFIX)).write_text(owner)
+    pool = WorkspacePool(str(tmp_path), leak_seconds=60)
+    assert pool.reap_leaked() == []
+    assert pool.reap_leaked(startup=True) == []
+
+    old = time.time() - 120
+    os.utime(tmp_path / "empty", (old, old))
+    assert pool.reap_leaked() == [str(tmp_path / "empty")]
+    os.utime(tmp_path / "garbled", (old, old))
+    assert pool.reap_leaked(startup=True) == [str(tmp_path / "garbled")]
+    assert pool.drain(timeout=10)
+    assert os.listdir(tmp_path) == []